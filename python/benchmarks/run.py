@@ -0,0 +1,236 @@
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+from pathlib import Path
+from time import perf_counter, sleep, time
+
+"""
+benchmarks of example-main.py against benchmarks/synthetic_server.py
+
+    python benchmarks/run.py [--latency-ms 20] [--tif-files 20000] [--fuse] [--out benchmarks/results.jsonl]
+    python benchmarks/run.py --compare 5
+
+Starts the server on a free port and runs each scenario as its own process with a
+fresh cache directory (cold) and again on the filled one (warm):
+
+    parse_listing        parse_directory_html of the tifs listing, in process
+    list_*               list tifs/00001.tif (walk_path)
+    du_approximate_*     du_approximate of the whole tree
+    prefetch_slices      prefetch-slices tifs 0:<prefetch-files>, MiB/s
+    prefetch_big         prefetch big (one sparse file of big-gib), MiB/s
+    getattr_{fast,loop}_<n>t  bench-getattr tifs: getattr ops/s of 1, 8, 32 fusepy threads
+                         answered from memory (fast path) vs through wait_async, no mount
+    fuse_ls / fuse_read  with --fuse: ls -l of tifs and first 4 KiB reads through a fuse-mount
+    fuse_stat_<n>t       with --fuse: stat ops/s of the tifs by 1, 8, 32 threads
+
+Each run is appended as one json line (commit, server config, results) to --out so
+that commits can be compared with --compare.
+"""
+
+here = Path(__file__).resolve().parent
+main_py = here.parent / "example-main.py"
+sys.path.insert(0, str(here.parent))
+sys.path.insert(0, str(here))
+
+import synthetic_server
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def git_commit() -> tuple[str, bool]:
+    def git(*args):
+        return subprocess.run(["git", *args], cwd=here, capture_output=True, text=True).stdout.strip()
+    return git("rev-parse", "--short", "HEAD"), git("status", "--porcelain", "--untracked-files=no") != ""
+
+class Server:
+
+    def __init__(self, a: argparse.Namespace):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.p = subprocess.Popen([sys.executable, str(here / "synthetic_server.py"), f"--port={self.port}", *synthetic_server.config_args(a)],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        # waits for "serving on"
+        assert self.p.stdout
+        self.p.stdout.readline()
+
+    def stop(self):
+        self.p.terminate()
+        self.p.wait()
+
+def run_main(cache: Path, url: str, *argv: str) -> float:
+    """ wall seconds, raises if the command failed """
+    t = perf_counter()
+    r = subprocess.run([sys.executable, str(main_py), str(cache), url, *argv], capture_output=True, text=True)
+    took = perf_counter() - t
+    if r.returncode != 0 or "Traceback" in r.stdout or "Traceback" in r.stderr:
+        raise Exception(f"{argv} failed:\n{r.stdout[-2000:]}\n{r.stderr[-2000:]}")
+    return took
+
+def du_bytes(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file() and not f.name.startswith("."))
+
+def bench_parse_listing(c: synthetic_server.Config, repeat: int) -> float:
+    from filesystems.ash2txtorg_cached import parse_directory_html
+    tree = synthetic_server.Tree(c)
+    html = synthetic_server.listing_html("/tifs/", tree.node("/tifs"))
+    times = []
+    for _ in range(repeat):
+        t = perf_counter()
+        parsed = parse_directory_html(html)
+        times.append(perf_counter() - t)
+        assert len(parsed.files) == c.tif_files
+    return statistics.median(times)
+
+def cold_warm(results: dict, name: str, url: str, repeat: int, *argv: str):
+    with tempfile.TemporaryDirectory() as d:
+        results[f"{name}_cold"] = run_main(Path(d), url, *argv)
+        results[f"{name}_warm"] = statistics.median(run_main(Path(d), url, *argv) for _ in range(repeat))
+
+def throughput(results: dict, name: str, url: str, *argv: str):
+    with tempfile.TemporaryDirectory() as d:
+        took = run_main(Path(d), url, *argv)
+        size = du_bytes(Path(d))
+        results[f"{name}_seconds"] = took
+        results[f"{name}_mib_per_sec"] = size / 1024 / 1024 / took
+
+def bench_getattr(results: dict, url: str, seconds: float):
+    with tempfile.TemporaryDirectory() as d:
+        run_main(Path(d), url, "list", "tifs")
+        r = subprocess.run([sys.executable, str(main_py), d, url, "bench-getattr", "tifs", "--seconds", str(seconds), "--json"], capture_output=True, text=True)
+        if r.returncode != 0:
+            raise Exception(f"bench-getattr failed:\n{r.stdout[-2000:]}\n{r.stderr[-2000:]}")
+        line = next(l for l in r.stdout.splitlines() if l.startswith("{"))
+        results.update(json.loads(line))
+
+def stat_ops_per_sec(paths: list[Path], threads: int, seconds: float) -> float:
+    counts = [0] * threads
+    stop = threading.Event()
+    def worker(i: int):
+        k = i
+        while not stop.is_set():
+            os.stat(paths[k % len(paths)])
+            k += 1
+            counts[i] += 1
+    ts = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    t = perf_counter()
+    for x in ts:
+        x.start()
+    sleep(seconds)
+    stop.set()
+    for x in ts:
+        x.join()
+    return sum(counts) / (perf_counter() - t)
+
+def percentile(xs: list[float], p: float) -> float:
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))]
+
+def bench_fuse(results: dict, url: str, reads: int):
+    """ needs fusepy and libfuse, skipped (recorded as such) if the mount doesn't come up """
+    with tempfile.TemporaryDirectory() as d, tempfile.TemporaryDirectory() as mnt:
+        p = subprocess.Popen([sys.executable, str(main_py), d, url, "fuse-mount", "", mnt], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            for _ in range(100):
+                if os.path.ismount(mnt) or p.poll() != None:
+                    break
+                sleep(0.1)
+            if not os.path.ismount(mnt):
+                results["fuse"] = "skipped: mount failed"
+                return
+            for kind in ["cold", "warm"]:
+                t = perf_counter()
+                with os.scandir(Path(mnt) / "tifs") as it:
+                    entries = [e.stat() for e in it]
+                results[f"fuse_ls_{kind}"] = perf_counter() - t
+                results["fuse_ls_entries"] = len(entries)
+            # the kernel caches attributes (libfuse default attr_timeout 1s), so part of the stats never reach getattr
+            paths = [Path(mnt) / "tifs" / n for n in sorted(os.listdir(Path(mnt) / "tifs"))]
+            for n in [1, 8, 32]:
+                results[f"fuse_stat_{n}t"] = stat_ops_per_sec(paths, n, 2.0)
+            names = sorted(os.listdir(Path(mnt) / "tifs"))[:reads]
+            for kind in ["cold", "warm"]:
+                latencies = []
+                for n in names:
+                    t = perf_counter()
+                    with open(Path(mnt) / "tifs" / n, "rb") as f:
+                        f.read(4096)
+                    latencies.append(perf_counter() - t)
+                results[f"fuse_read_{kind}_p50"] = percentile(latencies, 0.5)
+                results[f"fuse_read_{kind}_p95"] = percentile(latencies, 0.95)
+        finally:
+            if os.path.ismount(mnt):
+                subprocess.run(["fusermount", "-u", mnt], capture_output=True)
+            p.terminate()
+            p.wait()
+
+def compare(out: Path, n: int):
+    records = [json.loads(l) for l in out.read_text().splitlines() if l.strip()][-n:]
+    if not records:
+        print(f"no results in {out}")
+        return
+    names = list(dict.fromkeys(k for r in records for k in r["results"]))
+    def fmt(v):
+        return f"{v:.4f}" if isinstance(v, float) else str(v)
+    head = [f"{r['commit']}{'+' if r['dirty'] else ''}" for r in records]
+    print(f"{'':30}" + "".join(f"{h:>14}" for h in head))
+    for k in names:
+        print(f"{k:30}" + "".join(f"{fmt(r['results'].get(k, '-')):>14}" for r in records))
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmarks against the synthetic server")
+    synthetic_server.config_argparser(parser)
+    parser.set_defaults(big_gib=1.0)
+    parser.add_argument("--repeat", type=int, default=3, help="warm runs, the median is recorded")
+    parser.add_argument("--prefetch-files", type=int, default=2000)
+    parser.add_argument("--fuse", action="store_true", help="also measure a fuse-mount")
+    parser.add_argument("--fuse-reads", type=int, default=200)
+    parser.add_argument("--getattr-seconds", type=float, default=2.0, help="per thread count and mode of the getattr scenario")
+    parser.add_argument("--only", action="append", help="run only these scenarios (parse_listing, list, du_approximate, prefetch_slices, prefetch_big, getattr, fuse)")
+    parser.add_argument("--out", type=Path, default=here / "results.jsonl")
+    parser.add_argument("--compare", type=int, metavar="N", help="print the last N results side by side and exit")
+    a = parser.parse_args()
+    if a.compare:
+        compare(a.out, a.compare)
+        return
+    c = synthetic_server.config_from_args(a)
+    def enabled(name: str) -> bool:
+        return (a.only == None and (name != "fuse" or a.fuse)) or (a.only != None and name in a.only)
+
+    results: dict = {}
+    if enabled("parse_listing"):
+        results["parse_listing"] = bench_parse_listing(c, a.repeat)
+    server = Server(a)
+    try:
+        if enabled("list"):
+            cold_warm(results, "list", server.url, a.repeat, "list", "tifs/00001.tif")
+        if enabled("du_approximate"):
+            cold_warm(results, "du_approximate", server.url, a.repeat, "du_approximate", "")
+        if enabled("prefetch_slices"):
+            throughput(results, "prefetch_slices", server.url, "prefetch-slices", "tifs", f"0:{a.prefetch_files}", "--concurrency", "50")
+        if enabled("prefetch_big"):
+            throughput(results, "prefetch_big", server.url, "prefetch", "big")
+        if enabled("getattr"):
+            bench_getattr(results, server.url, a.getattr_seconds)
+        if enabled("fuse"):
+            bench_fuse(results, server.url, a.fuse_reads)
+    finally:
+        server.stop()
+
+    commit, dirty = git_commit()
+    record = {"time": time(), "commit": commit, "dirty": dirty, "config": {k: v for k, v in vars(a).items() if k in vars(c) or k in {"zarr_size", "prefetch_files"}}, "results": results}
+    with a.out.open("a") as f:
+        f.write(json.dumps(record) + "\n")
+    for k, v in results.items():
+        print(f"{k:30} {v:.4f}" if isinstance(v, float) else f"{k:30} {v}")
+    print(f"appended to {a.out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import socket
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from time import sleep
+
+"""
+regression check of --startup-budget: list on cached metadata stays fast
+
+    python benchmarks/startup_budget.py [--budget 0.5] [--tif-files 20000]
+
+Starts benchmarks/synthetic_server.py, fills a fresh cache directory with one cold
+list, then runs list with --startup-budget in-process and through a daemon (serve).
+Exits 1 if a run failed or took longer than the budget (example-main.py exit code 3).
+"""
+
+here = Path(__file__).resolve().parent
+main_py = here.parent / "example-main.py"
+sys.path.insert(0, str(here))
+
+from run import Server
+import synthetic_server
+
+def run_list(cache: Path, url: str, budget: float) -> tuple[int, str]:
+    r = subprocess.run([sys.executable, str(main_py), "--startup-budget", str(budget), str(cache), url, "list", "tifs/00001.tif"],
+        capture_output=True, text=True)
+    return r.returncode, r.stderr
+
+def wait_for_socket(path: Path, timeout: float = 30) -> bool:
+    for _ in range(int(timeout * 10)):
+        if path.exists():
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                try:
+                    s.connect(str(path))
+                    return True
+                except (ConnectionRefusedError, FileNotFoundError):
+                    pass
+        sleep(0.1)
+    return False
+
+def main():
+    parser = argparse.ArgumentParser(description="list within --startup-budget, in-process and through a daemon")
+    synthetic_server.config_argparser(parser)
+    parser.set_defaults(big_gib=0.01)
+    parser.add_argument("--budget", type=float, default=0.5, help="seconds")
+    parser.add_argument("--repeat", type=int, default=3)
+    a = parser.parse_args()
+
+    failed = []
+    server = Server(a)
+    try:
+        with tempfile.TemporaryDirectory() as d:
+            cache = Path(d)
+            code, err = run_list(cache, server.url, 600)
+            if code != 0:
+                raise Exception(f"cold list failed:\n{err[-2000:]}")
+            for i in range(a.repeat):
+                code, err = run_list(cache, server.url, a.budget)
+                print(f"in-process {i}: exit {code}")
+                if code != 0:
+                    failed.append(f"in-process {i}: exit {code}\n{err[-2000:]}")
+            daemon = subprocess.Popen([sys.executable, str(main_py), str(cache), server.url, "serve"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                if not wait_for_socket(cache / ".daemon.sock"):
+                    raise Exception("daemon didn't start")
+                for i in range(a.repeat):
+                    code, err = run_list(cache, server.url, a.budget)
+                    print(f"daemon {i}: exit {code}")
+                    if code != 0:
+                        failed.append(f"daemon {i}: exit {code}\n{err[-2000:]}")
+            finally:
+                daemon.terminate()
+                daemon.wait()
+    finally:
+        server.stop()
+    for f in failed:
+        print(f, file=sys.stderr)
+    if failed:
+        raise SystemExit(1)
+    print(f"list within {a.budget}s")
+
+if __name__ == "__main__":
+    main()
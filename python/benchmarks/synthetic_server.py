@@ -0,0 +1,257 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import zlib
+from dataclasses import dataclass
+from typing import Optional, Union
+from urllib.parse import quote, unquote
+from aiohttp import web
+
+"""
+local stand-in for dl.ash2txt.org serving a generated tree
+
+    /tifs/00000.tif .. tif-files tif files (20k by default) of tif-size bytes
+    /scroll.zarr/.zgroup, /scroll.zarr/<level>/.zarray, /scroll.zarr/<level>/<z>/<y>/<x>
+        zarr v2 levels with "/" separated chunk folders, level n is shape / 2**n.
+        Chunk sizes vary a bit (compression) and every 7th chunk doesn't exist (404, fill_value)
+    /big/volume.bin  sparse file of big-gib GiB, zeros except a header (Range requests!)
+    /f.txt
+
+Nothing is stored, listings and bodies are generated from the path so that huge trees
+are cheap. Listings look like the nginx fancyindex pages of the real server
+(#list tbody tr with name, approximate size, date) so parse_directory_html is exercised.
+
+Supports GET, HEAD (Content-Length), Range (206, 416), If-Range with the ETag (seed, path,
+size) or Last-Modified, injected latency and 429 replies.
+
+    python benchmarks/synthetic_server.py --port 8766 --latency-ms 20 --error-429 0.01
+"""
+
+LAST_MODIFIED = "Mon, 01 Jan 2024 00:00:00 GMT"
+
+@dataclass
+class Config:
+    tif_files: int = 20000
+    tif_size: int = 64 * 1024
+    zarr_levels: int = 3
+    zarr_shape: tuple[int, int, int] = (512, 512, 512)
+    zarr_chunk: int = 128
+    big_gib: float = 4.0
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_429: float = 0.0
+    seed: int = 0
+
+@dataclass
+class Dir:
+    entries: list[tuple[str, Optional[int]]] # name, size (None for folders)
+
+@dataclass
+class File:
+    size: int
+    path: str
+
+Node = Union[Dir, File]
+
+def format_size(n: int) -> str:
+    """ like the listings of the real server: approximate above 1 KiB """
+    if n < 1024:
+        return f"{n} B"
+    for unit in ["KiB", "MiB", "GiB", "TiB"]:
+        n /= 1024
+        if n < 1024 or unit == "TiB":
+            return f"{n:.1f} {unit}"
+    raise Exception("unreachable")
+
+def stable_random(path: str, seed: int) -> random.Random:
+    return random.Random(hashlib.md5(f"{seed}:{path}".encode()).digest())
+
+class Tree:
+
+    def __init__(self, c: Config):
+        self.c = c
+
+    def level_shape(self, level: int) -> list[int]:
+        return [max(1, s // 2 ** level) for s in self.c.zarr_shape]
+
+    def grid(self, level: int) -> list[int]:
+        return [-(-s // self.c.zarr_chunk) for s in self.level_shape(level)]
+
+    def zarray(self, level: int) -> bytes:
+        return json.dumps({
+            "zarr_format": 2, "shape": self.level_shape(level), "chunks": [self.c.zarr_chunk] * 3,
+            "dtype": "|u1", "compressor": {"id": "blosc", "cname": "zstd", "clevel": 5, "shuffle": 1, "blocksize": 0},
+            "fill_value": 0, "order": "C", "filters": None, "dimension_separator": "/",
+        }).encode()
+
+    def chunk_size(self, key: str) -> Optional[int]:
+        """ None for chunks which don't exist """
+        r = stable_random(key, self.c.seed)
+        if r.randrange(7) == 0:
+            return None
+        return int(self.c.zarr_chunk ** 3 * r.uniform(0.2, 0.6))
+
+    def small_files(self) -> dict[str, bytes]:
+        files = {"/f.txt": b"hello world", "/scroll.zarr/.zgroup": b'{"zarr_format": 2}'}
+        for level in range(self.c.zarr_levels):
+            files[f"/scroll.zarr/{level}/.zarray"] = self.zarray(level)
+        return files
+
+    def node(self, path: str) -> Optional[Node]:
+        c = self.c
+        small = self.small_files()
+        # the client asks for //f.txt in the root
+        parts = [p for p in path.split("/") if p]
+        path = "/" + "/".join(parts)
+        if path in small:
+            return File(len(small[path]), path)
+        if parts == []:
+            return Dir([("tifs", None), ("scroll.zarr", None), ("big", None), ("f.txt", len(small["/f.txt"]))])
+        if parts[0] == "tifs":
+            if len(parts) == 1:
+                return Dir([(f"{i:05d}.tif", c.tif_size) for i in range(c.tif_files)])
+            if len(parts) == 2 and parts[1].endswith(".tif") and parts[1][:-4].isdigit() and int(parts[1][:-4]) < c.tif_files:
+                return File(c.tif_size, path)
+            return None
+        if parts[0] == "big":
+            if len(parts) == 1:
+                return Dir([("volume.bin", int(c.big_gib * 1024 ** 3))])
+            if parts[1:] == ["volume.bin"]:
+                return File(int(c.big_gib * 1024 ** 3), path)
+            return None
+        if parts[0] == "scroll.zarr":
+            if len(parts) == 1:
+                return Dir([(".zgroup", len(small["/scroll.zarr/.zgroup"])), *[(str(l), None) for l in range(c.zarr_levels)]])
+            if not parts[1].isdigit() or int(parts[1]) >= c.zarr_levels:
+                return None
+            level = int(parts[1])
+            grid = self.grid(level)
+            idx = parts[2:]
+            if not all(p.isdigit() and int(p) < g for p, g in zip(idx, grid)) or len(idx) > 3:
+                return None
+            if len(idx) == 0:
+                return Dir([(".zarray", len(self.zarray(level))), *[(str(z), None) for z in range(grid[0])]])
+            if len(idx) < 3:
+                return Dir([(str(i), None) for i in range(grid[len(idx)])] if len(idx) == 1 else
+                    [(str(x), s) for x in range(grid[2]) if (s := self.chunk_size(f"{level}/{idx[0]}/{idx[1]}/{x}")) != None])
+            size = self.chunk_size("/".join(parts[1:]))
+            return File(size, path) if size != None else None
+        return None
+
+    def body(self, f: File, start: int, end: int) -> bytes:
+        """ bytes [start, end) """
+        small = self.small_files()
+        if f.path in small:
+            return small[f.path][start:end]
+        # deterministic, cheap, not all zeros so that hashes differ per file
+        header = hashlib.sha256(f.path.encode()).digest()
+        data = bytearray(end - start)
+        for i in range(max(start, 0), min(end, len(header))):
+            data[i - start] = header[i]
+        return bytes(data)
+
+def listing_html(path: str, d: Dir) -> str:
+    rows = ['<tr><td class="link"><a href="../" title="Parent directory">Parent directory/</a></td><td class="size">-</td><td class="date">-</td></tr>']
+    for name, size in d.entries:
+        if size == None:
+            rows.append(f'<tr><td class="link"><a href="{quote(name)}/" title="{name}">{name}/</a></td><td class="size">-</td><td class="date">2024-Jan-01 00:00</td></tr>')
+        else:
+            rows.append(f'<tr><td class="link"><a href="{quote(name)}" title="{name}">{name}</a></td><td class="size">{format_size(size)}</td><td class="date">2024-Jan-01 00:00</td></tr>')
+    return f'<html><body><h1>Index of {path}</h1><table id="list"><thead><tr><th>File Name</th><th>File Size</th><th>Date</th></tr></thead><tbody>{"".join(rows)}</tbody></table></body></html>'
+
+def parse_range(header: str, size: int) -> Optional[tuple[int, int]]:
+    """ "bytes=a-b" / "bytes=a-" / "bytes=-n" -> [start, end) """
+    if not header.startswith("bytes=") or "," in header:
+        return None
+    a, _, b = header[6:].partition("-")
+    if a == "":
+        return max(0, size - int(b)), size
+    return int(a), min(size, int(b) + 1) if b else size
+
+def make_app(c: Config) -> web.Application:
+    tree = Tree(c)
+    rng = random.Random(c.seed)
+    stats = {"requests": 0, "429": 0, "bytes": 0}
+
+    async def handle(req: web.Request) -> web.StreamResponse:
+        stats["requests"] += 1
+        if c.latency_ms or c.jitter_ms:
+            await asyncio.sleep((c.latency_ms + rng.uniform(0, c.jitter_ms)) / 1000)
+        if c.error_429 and rng.random() < c.error_429:
+            stats["429"] += 1
+            return web.Response(status=429, headers={"Retry-After": "1"})
+        path = unquote(req.path)
+        n = tree.node(path)
+        if n == None:
+            return web.Response(status=404)
+        if isinstance(n, Dir):
+            # the real server redirects to path/ first, that round trip isn't interesting here
+            return web.Response(text=listing_html(path, n), content_type="text/html")
+        start, end, status = 0, n.size, 200
+        etag = f'"{c.seed:x}-{zlib.crc32(path.encode()):08x}-{n.size:x}"'
+        r = req.headers.get("Range")
+        if_range = req.headers.get("If-Range")
+        if if_range != None and if_range != etag and if_range != LAST_MODIFIED:
+            # changed since: the whole file
+            r = None
+        if r:
+            rr = parse_range(r, n.size)
+            if rr == None or rr[0] >= n.size:
+                return web.Response(status=416, headers={"Content-Range": f"bytes */{n.size}"})
+            start, end, status = rr[0], rr[1], 206
+        headers = {"Content-Length": str(end - start), "Accept-Ranges": "bytes", "ETag": etag, "Last-Modified": LAST_MODIFIED}
+        if status == 206:
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{n.size}"
+        if req.method == "HEAD":
+            return web.Response(status=status, headers=headers)
+        resp = web.StreamResponse(status=status, headers=headers)
+        await resp.prepare(req)
+        block = 4 * 1024 * 1024
+        for s in range(start, end, block):
+            data = tree.body(n, s, min(end, s + block))
+            stats["bytes"] += len(data)
+            await resp.write(data)
+        await resp.write_eof()
+        return resp
+
+    async def stats_handler(req: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_get("/_stats", stats_handler)
+    app.router.add_route("*", "/{path:.*}", handle)
+    return app
+
+def config_argparser(parser: argparse.ArgumentParser):
+    d = Config()
+    parser.add_argument("--tif-files", type=int, default=d.tif_files)
+    parser.add_argument("--tif-size", type=int, default=d.tif_size)
+    parser.add_argument("--zarr-levels", type=int, default=d.zarr_levels)
+    parser.add_argument("--zarr-size", type=int, default=d.zarr_shape[0], help="edge length of level 0")
+    parser.add_argument("--zarr-chunk", type=int, default=d.zarr_chunk)
+    parser.add_argument("--big-gib", type=float, default=d.big_gib)
+    parser.add_argument("--latency-ms", type=float, default=d.latency_ms)
+    parser.add_argument("--jitter-ms", type=float, default=d.jitter_ms)
+    parser.add_argument("--error-429", type=float, default=d.error_429, help="probability of replying 429")
+    parser.add_argument("--seed", type=int, default=d.seed)
+
+def config_from_args(a: argparse.Namespace) -> Config:
+    return Config(
+        tif_files = a.tif_files, tif_size = a.tif_size,
+        zarr_levels = a.zarr_levels, zarr_shape = (a.zarr_size,) * 3, zarr_chunk = a.zarr_chunk,
+        big_gib = a.big_gib,
+        latency_ms = a.latency_ms, jitter_ms = a.jitter_ms, error_429 = a.error_429, seed = a.seed)
+
+def config_args(a: argparse.Namespace) -> list[str]:
+    """ the options again, to start the server as a subprocess """
+    return [f"--{k.replace('_', '-')}={v}" for k, v in vars(a).items() if k in {
+        "tif_files", "tif_size", "zarr_levels", "zarr_size", "zarr_chunk", "big_gib", "latency_ms", "jitter_ms", "error_429", "seed"}]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="synthetic ash2txt.org like server")
+    parser.add_argument("--port", type=int, default=8766)
+    config_argparser(parser)
+    a = parser.parse_args()
+    web.run_app(make_app(config_from_args(a)), host="127.0.0.1", port=a.port, print=lambda *_: print(f"serving on http://127.0.0.1:{a.port}", flush=True))
@@ -1,21 +1,33 @@
-from argparse import ONE_OR_MORE
+from filesystems import startup
+from argparse import ONE_OR_MORE, ArgumentParser, REMAINDER
 from dataclasses import dataclass
 from os.path import exists
 import traceback
-from typing import Dict, Optional, Tuple, cast, TypeAlias, Protocol, Callable, TypeVar, Awaitable, Callable, ParamSpec
+from typing import IO, Dict, Optional, Tuple, cast, TypeAlias, Protocol, Callable, TypeVar, Awaitable, Callable, ParamSpec
+import os
 import sys
 from pathlib import Path
 import pickle
-from time import time
-import aiohttp
+import signal
+import contextvars
+import json
+from time import time, perf_counter, sleep
 import asyncio
-from filesystems import walking, ash2txtorg_cached
+from filesystems import walking, ash2txtorg_cached, verify, zarr_roi, eviction, leases, daemon
 from filesystems.types import MyPath
 from threading import Thread, Event
 from filesystems.later import later_instance
+from filesystems.progress import Progress
+from filesystems import log
+from filesystems import metrics
+from filesystems import block_cache
+from filesystems import hedging
+from filesystems import disk_writer
+from filesystems import tracing
 
 import nest_asyncio
 nest_asyncio.apply()
+startup.mark("imports")
 
 exiting = Event()
 cancel_tasks = []
@@ -29,18 +41,63 @@ thread_loop = asyncio.new_event_loop()
 
 class LimitByKey:
     # TODO -> bad place
-    def __init__(self, loop):
+    # one task per key (listing, download), shared by its waiters. A task only cancellable
+    # waiters (interactive FUSE requests) wait for is cancelled grace seconds after the
+    # last of them went away, any other waiter (prefetch) keeps it running
+    def __init__(self, loop, grace = 10.0):
         self.loop = loop
+        self.grace = grace
         self.tasks = {}
+        self.waiters: dict[asyncio.Task, int] = {}
+        self.kept: set[asyncio.Task] = set()
+        self.timers: dict[asyncio.Task, asyncio.TimerHandle] = {}
+        self.abandoned = 0
 
-    def by_key(self, key,  a):
+    async def by_key(self, key, a, cancellable = False):
         if not key in self.tasks:
             async def task():
-                r = await a()
-                del self.tasks[key]
+                try:
+                    r = await a()
+                except asyncio.CancelledError:
+                    # abandoned, the next waiter starts again
+                    self.forget(key, me)
+                    raise
+                self.forget(key, me)
                 return r
-            self.tasks[key] = self.loop.create_task(task())
-        return self.tasks[key]
+            me = self.tasks[key] = self.loop.create_task(task())
+        t = self.tasks[key]
+        if not cancellable:
+            self.kept.add(t)
+        self.waiters[t] = self.waiters.get(t, 0) + 1
+        timer = self.timers.pop(t, None)
+        if timer:
+            timer.cancel()
+        try:
+            return await asyncio.shield(t)
+        finally:
+            # gone once the task finished (forget)
+            if t in self.waiters:
+                n = self.waiters[t] = self.waiters[t] - 1
+                if n == 0 and not t.done() and not t in self.kept and self.grace >= 0:
+                    self.timers[t] = self.loop.call_later(self.grace, self.abandon, key, t)
+
+    def abandon(self, key, t: asyncio.Task):
+        self.timers.pop(t, None)
+        if self.waiters.get(t) == 0 and not t.done() and not t in self.kept:
+            self.abandoned += 1
+            # a waiter coming while it unwinds starts a new one
+            if self.tasks.get(key) is t:
+                del self.tasks[key]
+            t.cancel()
+
+    def forget(self, key, t: asyncio.Task):
+        if self.tasks.get(key) is t:
+            del self.tasks[key]
+        self.waiters.pop(t, None)
+        self.kept.discard(t)
+        timer = self.timers.pop(t, None)
+        if timer:
+            timer.cancel()
 
 def start_background_loop(loop: asyncio.AbstractEventLoop) -> None:
     """Run the event loop in a background thread and ensure all tasks complete before stopping."""
@@ -89,10 +146,34 @@ R = TypeVar('R')
 def wait_async(f: Callable[P, Awaitable[R]]) -> Callable[P, R]:
     def x(*args, **kwargs) -> R:
         nonlocal f
+        # so that print() inside reaches the client of a daemon request (daemon.current_output)
+        ctx = contextvars.copy_context()
+        submitted = perf_counter()
+        finished = 0.0
+        async def in_context():
+            nonlocal finished
+            started = perf_counter()
+            metrics.observe("loop.hop_in", started - submitted)
+            for var, value in ctx.items():
+                var.set(value)
+            tracing.record("loop.hop_in", submitted, started)
+            try:
+                return await f(*args, **kwargs)
+            finally:
+                finished = perf_counter()
         try:
-            task = asyncio.run_coroutine_threadsafe(f(*args, **kwargs), thread_loop)
+            task = asyncio.run_coroutine_threadsafe(in_context(), thread_loop)
             r = task.result()
+            metrics.observe("loop.hop_out", perf_counter() - finished)
             return r
+        except OSError as e:
+            # expected answers for FUSE (fusepy returns -errno): offline misses (ENOENT),
+            # requester gone (EINTR)
+            if e.errno == None:
+                traceback.print_exc()
+            else:
+                log.debug(f"{f.__name__}: {e!r}")
+            raise
         except:
             traceback.print_exc()
             raise
@@ -100,115 +181,312 @@ def wait_async(f: Callable[P, Awaitable[R]]) -> Callable[P, R]:
 
 mount_point     = ""
 
+# commands which never go to a running daemon (serve)
+in_process_commands = {"serve", "fuse-mount", "fuse_passthrough-mount", "fuse3-mount", "bench-getattr"}
+
+def response_validator(headers) -> Optional[str]:
+    """ strong ETag, else Last-Modified. Weak ETags can't be used in If-Range """
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
 def main():
     app = sys.argv[0]
     def usage():
         print(f"""
         usage:
+        {app} [-v|-vv] [--progress-jsonl FILE] [--offline] [--abandon-grace 10] [--fsync never|downloads|always] [--cache-quota 500GiB [--eviction lru|size] [--partial-max-age 168]] [--block-cache 64MiB] [--hedge 0.95 [--hedge-budget 0.05]] [--request-timeout 30] [--profile-startup] [--startup-budget SECONDS]
+            [--metrics-file FILE.prom] [--sample-profile FILE] [--trace FILE.json] <CACHE_DIR> <URL> <COMMAND> ..
+            kill -USR1 prints latency histograms, kill -USR2 toggles the sampling profiler (not while fuse blocks the main thread)
         export FUSE_LIBRARY_PATH=/nix/store/czxy0x8wrklqswmkg75cncphj9cq893p-fuse-2.9.9/lib/libfuse.so.2
         {app} <CACHE_DIR> <URL> fuse-mount <PATH> <MOUNT_POINT>
         {app} <CACHE_DIR> <URL> fuse_passthrough-mount <PATH> <MOUNT_POINT>
         {app} <CACHE_DIR> <URL> fuse3-mount <PATH> <MOUNT_POINT>
         {app} <CACHE_DIR> <URL> list <PATH>
-        {app} <CACHE_DIR> <URL> prefetch <PATH>
+        {app} <CACHE_DIR> <URL> prefetch <PATH> [--include GLOB].. [--exclude GLOB].. [--zarr-levels 2,3,4,5] [--max-bytes 200GiB] [--order path|smallest|round-robin] [--dry-run]
+        {app} <CACHE_DIR> <URL> prefetch-manifest <FILE> [--max-bytes 2TiB] [--dry-run]
+        {app} <CACHE_DIR> <URL> prefetch-zarr-roi <ZARR_LEVEL> <z0:z1,y0:y1,x0:x1> [--concurrency 20] [--dry-run]
+        {app} <CACHE_DIR> <URL> prefetch-slices <DIR> <start>:<end>[:step] [--ext .tif].. [--concurrency 20] [--dry-run]
         {app} <CACHE_DIR> <URL> du_approximate <PATH>
+        {app} <CACHE_DIR> <URL> estimate-zarr <ZARR_OR_LEVEL> [--rel-error 0.1] [--max-samples 400]
         {app} <CACHE_DIR> <URL> cache_dir_check_sizes <PATH>
-        {app} <CACHE_DIR> <URL> walk_cache_check_download_completness<PATH>
+        {app} <CACHE_DIR> <URL> walk_cache_check_download_completness <PATH> [--exact] [--recount]
+        {app} <CACHE_DIR> <URL> verify <PATH> [--hash] [--repair] [--threads 16]
         {app} <CACHE_DIR> <URL> list_special_and_approximate_size_fast <PATH>
+        {app} <CACHE_DIR> <URL> evict [--dry-run] [--quota 500GiB] [--policy lru|size]
+        {app} <CACHE_DIR> <URL> sync <PATH> [--apply] [--download] [--concurrency 20]
+        {app} <CACHE_DIR> <URL> find <PATH> <GLOB|REGEX> [--regex] [--sync]
+        {app} <CACHE_DIR> <URL> pin <PATH>
+        {app} <CACHE_DIR> <URL> unpin <PATH>
+        {app} <CACHE_DIR> <URL> metrics [--prometheus]
+            latency histograms of this process, useful with a running daemon
+        {app} <CACHE_DIR> <URL> bench-getattr <PATH> [--threads 1,8,32] [--seconds 2] [--json]
+            getattr ops/sec of fusepy threads on the entries of PATH, fast path vs wait_async
+        {app} <CACHE_DIR> <URL> serve
+            keep tree and downloads in memory, other commands (except mounts) are sent to it while it runs
+            -v and --progress-jsonl apply per command, --trace/--metrics-file/--sample-profile run the
+            command in-process, other global options must be the daemon's
         """)
-    cache_directory = Path(sys.argv[1])
-    root_url        = sys.argv[2]
-    argv = sys.argv[3:]
+    global_parser = ArgumentParser(add_help=False)
+    global_parser.add_argument("-v", "--verbose", action="count", default=0, help="-v per folder output, -vv per file/request output")
+    global_parser.add_argument("--progress-jsonl", help="append progress snapshots as json lines to this file")
+    global_parser.add_argument("--cache-quota", type=walking.parse_size, help="evict downloaded files (not metadata, not pinned) above this, eg 500GiB")
+    global_parser.add_argument("--eviction", choices=eviction.eviction_policies, default="lru")
+    global_parser.add_argument("--block-cache", type=walking.parse_size, default=64 * 1024 * 1024, help="memory for hot blocks of cached files (.zarray, tif headers) read by mounts, eg 256MiB, 0 disables")
+    global_parser.add_argument("--partial-max-age", type=float, default=eviction.default_max_partial_age / 3600, help="hours after which eviction removes partial downloads (.tmp) even below the quota")
+    global_parser.add_argument("--abandon-grace", type=float, default=10.0, help="seconds after which a download only gone FUSE requests waited for is cancelled (the partial is resumed later), -1 never")
+    global_parser.add_argument("--fsync", choices=disk_writer.fsync_policies, default="never", help="downloads: fsync downloaded files before renaming them into place, always: also metadata json and directories")
+    global_parser.add_argument("--offline", action="store_true", help="only answer from the cache directory, no requests: uncached folders and files are hidden, misses fail at once (ENOENT)")
+    global_parser.add_argument("--hedge", type=float, help="send listing and HEAD requests again when slower than this percentile of recent ones, eg 0.95")
+    global_parser.add_argument("--hedge-budget", type=float, default=0.05, help="at most this fraction of extra requests for --hedge")
+    global_parser.add_argument("--request-timeout", type=float, help="seconds per listing / HEAD request attempt")
+    global_parser.add_argument("--profile-startup", action="store_true", help="print import and first operation timings to stderr")
+    global_parser.add_argument("--startup-budget", type=float, help="fail (exit code 3) if the command took longer, eg to keep list on cached metadata fast")
+    global_parser.add_argument("--metrics-file", help="write latency histograms in Prometheus text format every 10s and at exit")
+    global_parser.add_argument("--sample-profile", help="sample stacks of all threads, written as collapsed stacks (flamegraph) at exit and when toggled off by SIGUSR2")
+    global_parser.add_argument("--trace", help="write trace spans (fuse op > walk > folder_fetch > http > disk) as Chrome trace json for ui.perfetto.dev at exit")
+    global_parser.add_argument("cache_directory")
+    global_parser.add_argument("root_url")
+    global_parser.add_argument("argv", nargs=REMAINDER)
+    if len(sys.argv) < 4:
+        usage()
+        raise Exception("missing arguments")
+    g = global_parser.parse_args(sys.argv[1:])
+    cache_directory = Path(g.cache_directory)
+    root_url        = g.root_url
+    argv = g.argv
+    log.verbosity = g.verbose
+    progress_jsonl = open(g.progress_jsonl, "a") if g.progress_jsonl else None
+    # --progress-jsonl of a daemon request
+    request_jsonl: contextvars.ContextVar[Optional[IO]] = contextvars.ContextVar("request_jsonl", default=None)
+    block_cache.configure(g.block_cache)
+    hedging.configure(g.hedge, g.hedge_budget, g.request_timeout)
+    disk_writer.configure(g.fsync)
+
+    def progress(name: str) -> Progress:
+        return Progress(name, jsonl = request_jsonl.get() or progress_jsonl)
+
+    def print_metrics(*_):
+        print(metrics.table(), file=sys.stderr)
+    signal.signal(signal.SIGUSR1, print_metrics)
+    if g.metrics_file:
+        def write_metrics():
+            while not exiting.wait(10):
+                metrics.write_prometheus(g.metrics_file)
+        Thread(target=write_metrics, daemon=True).start()
+    profiler = metrics.SamplingProfiler()
+    def toggle_profiler(*_):
+        profiler.toggle()
+        if not profiler.running() and g.sample_profile:
+            profiler.write_collapsed(g.sample_profile)
+        print(f"sampling profiler {'on' if profiler.running() else 'off'}, {profiler.samples} samples", file=sys.stderr)
+    signal.signal(signal.SIGUSR2, toggle_profiler)
+    if g.sample_profile:
+        profiler.start()
+    if g.trace:
+        tracing.enable()
+    def write_metrics_and_profile():
+        if g.trace:
+            tracing.write(g.trace)
+        if g.metrics_file:
+            metrics.write_prometheus(g.metrics_file)
+        if g.sample_profile and profiler.running():
+            profiler.stop()
+            profiler.write_collapsed(g.sample_profile)
+
+    access_log = eviction.AccessLog(cache_directory)
+    pins = eviction.Pins(cache_directory)
+    generation = eviction.Generation(cache_directory)
+
+    name_index_ = None
+    def name_index():
+        # sqlite, opened on the first metadata write or find
+        nonlocal name_index_
+        if name_index_ == None:
+            from filesystems.name_index import NameIndex
+            name_index_ = NameIndex(cache_directory)
+        return name_index_
+
+    root_folder = None
+    # .tmp of the downloads of this process, see new_root_folder
+    in_flight = lambda: set()
 
     def get_folder(cache_directory: Path, root_url: str):
+        # one tree, session and download scheduler per process, shared by daemon requests
+        nonlocal root_folder
+        if root_folder == None:
+            root_folder = new_root_folder(cache_directory, root_url)
+        return root_folder
+
+    def new_root_folder(cache_directory: Path, root_url: str):
+        nonlocal in_flight
         loop = thread_loop
         fetch_limiter = asyncio.Semaphore(20) # 80 yields too many requests
-        limit = 100
-        connector = aiohttp.TCPConnector(limit = limit, limit_per_host= limit, loop = thread_loop)
-        session = aiohttp.ClientSession(connector=connector)
+        def in_flight():
+            # fetch_once also dedupes listings, keyed by url
+            return {f"{k.relative_to(cache_directory)}.tmp" for k in fetch_once.tasks.keys() if isinstance(k, Path)}
+        quota = None
+        if g.cache_quota:
+            quota = eviction.Quota(loop, cache_directory, g.cache_quota, g.eviction, access_log, pins, in_flight, generation, g.partial_max_age * 3600)
+            loop.call_soon_threadsafe(quota.evict_soon)
+        session_ = None
+        def session():
+            # commands working on cached metadata don't need aiohttp
+            nonlocal session_
+            if session_ == None:
+                with startup.timed("import aiohttp"):
+                    import aiohttp
+                limit = 100
+                connector = aiohttp.TCPConnector(limit = limit, limit_per_host= limit, loop = thread_loop)
+                session_ = aiohttp.ClientSession(connector=connector)
+            return session_
 
         def build_url (*parts: str):
             return '/'.join([x for x in parts])
 
+        # request -> started, span. Where all the time goes: --trace
         fetching = {}
+        slow_fetch = 30
         async def forever_show_fetching():
             while not exiting.is_set():
                 await later_instance.do_regularly()
                 await asyncio.sleep(10)
+                if log.verbosity < 1:
+                    continue
                 t = time()
-                if len(fetching) > 0:
-                    x = "\n".join([f"{k} {t-v:.1f}sec" for k, v in fetching.items()])
-                    print(f"FETCHING STATE SUMMARY {len(fetching)}\n{x}")
-
-                pending_tasks = [t for t in asyncio.all_tasks(loop) if not t.done()]
-                print(f"running tasks in loop... {len(pending_tasks)}")
+                for k, (started, span) in list(fetching.items()):
+                    if t - started > slow_fetch:
+                        print(f"SLOW {k} {t - started:.1f}sec {tracing.path(span)}")
         cancel_tasks.append(loop.create_task(forever_show_fetching()))
 
         async def fetch_text(url:str):
-            async with fetch_limiter:
+            with metrics.timed("net.queue"):
+                await fetch_limiter.acquire()
+            try:
                 m = f"fetching text {url}"
-                print(m)
-                fetching[m] = time()
+                log.debug(m)
+                fetching[m] = (time(), tracing.current_span.get())
+                async def request():
+                    with metrics.timed("net.listing"):
+                        async with session().get(url) as response:
+                            response.raise_for_status()
+                            startup.mark("first listing fetched")
+                            return  await response.text()  # Get text content
                 try:
-                    async with session.get(url) as response:
-                        response.raise_for_status()
-                        return  await response.text()  # Get text content
+                    return await hedging.shared.run("listing", request)
                 finally:
                     del fetching[m]
+            finally:
+                fetch_limiter.release()
 
-        async def fetch_bytes(url:str, f):
-            async with fetch_limiter:
+        async def fetch_bytes(url:str, f: disk_writer.FileWriter, offset = 0, validator: Optional[str] = None):
+            """ offset: resume, appends to f from there if the server answers the Range with 206.
+                validator: If-Range, ETag or Last-Modified of the response the partial came from,
+                another version of the file comes whole (200). The validator of the response is
+                kept on f (ash2txtorg_cached.PARTIAL_VALIDATOR) before its bytes are written
+            """
+            with metrics.timed("net.queue"):
+                await fetch_limiter.acquire()
+            try:
                 m = f"fetching bytes {url}"
-                print(m)
-                fetching[m] = time()
+                log.debug(m)
+                fetching[m] = (time(), tracing.current_span.get())
                 try:
-                    async with session.get(url) as response:
-                        response.raise_for_status()
-                        try:
-                            async for chunk in response.content.iter_chunked(10 * 1024 * 1024):  # 10 MB chunks
-                                f.write(chunk)
-                        finally:
-                            response.close()
+                    while True:
+                        headers = {"Range": f"bytes={offset}-", "If-Range": validator} if offset and validator else None
+                        with metrics.timed("net.download"):
+                            async with session().get(url, headers = headers) as response:
+                                if headers and response.status == 416:
+                                    # bytes */size: the partial may already be complete
+                                    if response.headers.get("Content-Range", "").endswith(f"/{offset}"):
+                                        return
+                                    log.info(f"partial of {offset} bytes doesn't fit {url}, downloading it again")
+                                    f.truncate(0)
+                                    offset = 0
+                                    continue
+                                response.raise_for_status()
+                                startup.mark("first download started")
+                                if offset and response.status != 206:
+                                    # whole file, changed since the partial was written
+                                    f.truncate(0)
+                                    offset = 0
+                                v = response_validator(response.headers)
+                                if v and v != validator:
+                                    f.set_xattr(ash2txtorg_cached.PARTIAL_VALIDATOR, v.encode("utf-8"))
+                                if response.content_length:
+                                    f.preallocate(offset + response.content_length)
+                                try:
+                                    # the writer pool writes while the next chunk arrives
+                                    async for chunk in response.content.iter_chunked(10 * 1024 * 1024):  # 10 MB chunks
+                                        await f.write(chunk)
+                                finally:
+                                    response.close()
+                                return
                 finally:
                     del fetching[m]
+            finally:
+                fetch_limiter.release()
 
         async def fetch_headers(url:str):
-             async with fetch_limiter:
-                 m = f"fetching header {url}"
-                 print(m)
-                 fetching[m] = time()
-                 try:
-                     async with session.head(url) as response:
-                         response.raise_for_status()
-                         return response.headers
-                 finally:
+            with metrics.timed("net.queue"):
+                await fetch_limiter.acquire()
+            try:
+                m = f"fetching header {url}"
+                log.debug(m)
+                fetching[m] = (time(), tracing.current_span.get())
+                async def request():
+                    with metrics.timed("net.head"):
+                        async with session().head(url) as response:
+                            response.raise_for_status()
+                            return response.headers
+                try:
+                    return await hedging.shared.run("head", request)
+                finally:
                     del fetching[m]
+            finally:
+                fetch_limiter.release()
 
         async def folder_fetch(folder: MyPath):
+            with tracing.span("folder_fetch", path = str(folder)):
+                return await folder_fetch_(folder)
+
+        async def folder_fetch_(folder: MyPath):
             nonlocal cache_directory
             f = cache_directory / str(folder)
+            cache_file_json = f / ash2txtorg_cached.METADATA_FILE
+            if g.offline and not cache_file_json.exists():
+                raise ash2txtorg_cached.OfflineMiss(f"listing of {folder}/")
             f.mkdir(exist_ok=True, parents=True)
 
-            cache_file_json = f / ".directory_contents_cached_v2.json"
+            # to notice another process having written the json since we read/wrote it
+            known_mtime = None
 
             async def store_data(data):
-                tmp = cache_file_json.with_suffix('.tmp')
-                with tmp.open('w') as f:
-                    # dataclasses_json
-                    f.write(data.to_json())
-                tmp.rename(cache_file_json)
-                print(f"stored {cache_file_json}")
+                nonlocal known_mtime
+                lease = await leases.acquire(cache_file_json)
+                try:
+                    if cache_file_json.exists() and cache_file_json.stat().st_mtime_ns != known_mtime:
+                        theirs = ash2txtorg_cached.CachedFolderData.from_json(cache_file_json.read_text())
+                        ash2txtorg_cached.merge_folder_data(data, theirs)
+                    with metrics.timed("disk.metadata_write"):
+                        # serialized here, the loop keeps changing data
+                        known_mtime = await disk_writer.shared.replace_file(cache_file_json, data.to_json())
+                finally:
+                    lease.release()
+                log.debug(f"stored {cache_file_json}")
+                # copy, the loop keeps changing data meanwhile
+                snapshot = ash2txtorg_cached.CachedFolderData(files = dict(data.files), folders = list(data.folders))
+                try:
+                    await loop.run_in_executor(None, name_index().update_folder, str(folder), snapshot, known_mtime)
+                except Exception as e:
+                    log.info(f"name index update of {folder} failed {e!r}")
 
             async def frech_fetch():
-                print(f"frech_fetch ")
+                log.debug(f"frech_fetch {folder}")
                 url = build_url(root_url, str(folder))
                 async def fetch():
-                    html = await fetch_text(url)
-                    parsed = ash2txtorg_cached.parse_directory_html(html)
-                    cached = ash2txtorg_cached.CachedFolderData(
-                        files = {k: ash2txtorg_cached.CachedFileData(size = ash2txtorg_cached.exact_size_bytes_from_str(v.size), size_approximate = ash2txtorg_cached.approximate_size_bytes_from_str(v.size))  for k, v in parsed.files.items()},
-                        folders = parsed.folders
-                    )
+                    cached = await folder_listing(folder)
                     store = ash2txtorg_cached.AutoStore(loop, cached, store_data)
                     store.changed()
                     return store
@@ -216,44 +494,133 @@ def main():
 
             # cache_file_v1 = f / ".directory_contents_cached"
             if cache_file_json.exists():
-                with cache_file_json.open('r') as f:
+                known_mtime = cache_file_json.stat().st_mtime_ns
+                with metrics.timed("disk.metadata_read"), cache_file_json.open('r') as f:
                     js = f.read()
-                    print(f"js {cache_file_json} {cache_file_json}")
+                    log.debug(f"js {cache_file_json}")
                     data = ash2txtorg_cached.CachedFolderData.from_json(js)
+                startup.mark("first cached metadata read")
                 store = ash2txtorg_cached.AutoStore(loop, data, store_data)
             else:
                 store = await frech_fetch()
             return store
 
+        async def folder_listing(folder: MyPath):
+            if g.offline:
+                raise ash2txtorg_cached.OfflineMiss(f"listing of {folder}/")
+            html = await fetch_text(build_url(root_url, str(folder)))
+            parsed = ash2txtorg_cached.parse_directory_html(html)
+            return ash2txtorg_cached.CachedFolderData(
+                files = {k: ash2txtorg_cached.CachedFileData(size = ash2txtorg_cached.exact_size_bytes_from_str(v.size), size_approximate = ash2txtorg_cached.approximate_size_bytes_from_str(v.size), date = v.date)  for k, v in parsed.files.items()},
+                folders = parsed.folders
+            )
+
         async def file_fetch_size(folder: MyPath, name: str):
+            if g.offline:
+                # the size of the cached file is exact, downloads are renamed once complete
+                try:
+                    return (cache_directory / str(folder) / name).stat().st_size
+                except FileNotFoundError:
+                    raise ash2txtorg_cached.OfflineMiss(f"size of {folder / name}")
             headers = await fetch_headers(build_url(root_url, str(folder), name))
             return int(headers['Content-Length'])
 
-        fetch_once = LimitByKey(loop)
+        fetch_once = LimitByKey(loop, g.abandon_grace)
+        resumed = 0
+        metrics.value("downloads_abandoned", "counter", lambda: fetch_once.abandoned)
+        metrics.value("downloads_resumed", "counter", lambda: resumed)
 
         async def file_ensure_fetched(folder: MyPath, name: str):
-            print(f"ensuring fetched {folder} {name}")
+            log.debug(f"ensuring fetched {folder} {name}")
             # TODO .. only start this once for large files !
             file = cache_directory / str(folder) / name
             if not file.exists():
-                async def fetch():
-                    tmp = file.with_suffix(".tmp")
-                    # TODO some files are large like 800 MB ! use streaming ?
-                    with tmp.open("wb") as f:
-                        await fetch_bytes(build_url(root_url, str(folder), name), f)
+                if g.offline:
+                    raise ash2txtorg_cached.OfflineMiss(str(folder / name))
+                @tracing.traced("download")
+                async def download():
+                    nonlocal resumed
+                    # not with_suffix, zarr chunks 0.0.1 and 0.0.2 would share 0.0.tmp
+                    tmp = file.with_name(f"{file.name}.tmp")
+                    # partial of an abandoned download, only resumed if the version it came from is known
+                    offset = tmp.stat().st_size if tmp.exists() else 0
+                    validator = disk_writer.get_xattr(tmp, ash2txtorg_cached.PARTIAL_VALIDATOR) if offset else None
+                    if validator == None:
+                        offset = 0
+                    hasher = ash2txtorg_cached.new_hasher()
+                    try:
+                        # a resumed file is hashed once complete
+                        async with disk_writer.shared.open(tmp, "ab" if offset else "wb", None if offset else hasher) as f:
+                            await fetch_bytes(build_url(root_url, str(folder), name), f, offset, validator.decode("utf-8") if validator else None)
+                    except asyncio.CancelledError:
+                        # kept for resuming
+                        raise
+                    except:
+                        tmp.unlink(missing_ok=True)
+                        raise
+                    digest = hasher.hexdigest()
+                    if offset:
+                        resumed += 1
+                        digest = await loop.run_in_executor(None, verify.hash_file, tmp)
                     tmp.rename(file)
-                return await fetch_once.by_key(file, fetch)
+                    await disk_writer.shared.renamed(file)
+                    st = file.stat()
+                    if quota:
+                        quota.added(st.st_size)
+                    return ash2txtorg_cached.Downloaded(size = st.st_size, hash = digest, mtime = st.st_mtime_ns)
+
+                async def fetch():
+                    # zarr roi fetches chunks of folders which were never listed
+                    file.parent.mkdir(parents=True, exist_ok=True)
+                    while True:
+                        lease = leases.try_acquire(file)
+                        if lease:
+                            try:
+                                if file.exists():
+                                    return None
+                                lease.keep_alive()
+                                return await download()
+                            finally:
+                                lease.release()
+                        # another process is downloading it, use its result
+                        await leases.wait_released(file)
+                        if file.exists():
+                            return None
+                # downloads of FUSE requests only run while someone waits for them, not those of prefetch
+                return await fetch_once.by_key(file, fetch, ash2txtorg_cached.requester_alive.get() != None)
 
         async def file_cache_path(folder: MyPath, name: str):
             await file_ensure_fetched(folder, name)
             return cache_directory / str(folder) / name
 
+        async def cached_file_sizes(folder: MyPath):
+            def scan():
+                try:
+                    with os.scandir(cache_directory / str(folder)) as it:
+                        return {e.name: e.stat().st_size for e in it if e.is_file() and e.name != ash2txtorg_cached.METADATA_FILE}
+                except FileNotFoundError:
+                    return {}
+            return await loop.run_in_executor(None, scan)
+
+        async def offline_entries(folder: MyPath):
+            def scan():
+                listed, cached = set(), set()
+                try:
+                    with os.scandir(cache_directory / str(folder)) as it:
+                        for e in it:
+                            if e.is_dir():
+                                if os.path.exists(os.path.join(e.path, ash2txtorg_cached.METADATA_FILE)):
+                                    listed.add(e.name)
+                            elif e.is_file():
+                                cached.add(e.name)
+                except FileNotFoundError:
+                    pass
+                return listed, cached
+            return await loop.run_in_executor(None, scan)
+
         async def file_bytes(folder: MyPath, name: str, offset: int, size: int):
             await file_ensure_fetched(folder, name)
-            file = cache_directory / str(folder) / name
-            with file.open("rb") as f:
-                    f.seek(offset)
-                    return f.read(size)
+            return block_cache.shared.read_path(cache_directory / str(folder) / name, offset, size)
 
         lfo = ash2txtorg_cached.FolderOpts(
                 loop = loop,
@@ -261,125 +628,561 @@ def main():
                 file_fetch_size = file_fetch_size,
                 file_ensure_fetched = file_ensure_fetched,
                 file_bytes = file_bytes,
-                file_cache_path = file_cache_path
+                file_cache_path = file_cache_path,
+                file_accessed = lambda folder, name: access_log.touch(str(folder / name)),
+                cached_file_sizes = cached_file_sizes,
+                folder_listing = folder_listing,
+                cache_generation = lambda path: generation.changed_at(str(path)),
+                offline_entries = offline_entries if g.offline else None,
             )
         folder = ash2txtorg_cached.LazyFolder(MyPath(""), lfo)
         return folder
 
-    if argv[0] == "fuse-mount":
-        from filesystems import fuse
-        path = argv[1]
-        mountpoint = argv[2]
-        print(f" {path} mountpoint={mountpoint}")
-        # TODO multi threading ..
-        folder = get_folder(cache_directory, root_url)
-        folder = wait_async(walking.walk_path_find_folder)(folder, MyPath(path))
-        assert folder
-        fuse.mount(folder, mountpoint, wait_async)
-
-    if argv[0] == "fuse_passthrough-mount":
-        from filesystems import fuse_passthrough
-        path = argv[1]
-        mountpoint = argv[2]
-        print(f" {path} mountpoint={mountpoint}")
-        # TODO multi threading ..
-        folder = get_folder(cache_directory, root_url)
-        folder = wait_async(walking.walk_path_find_folder)(folder, MyPath(path))
-        assert folder
-        fuse_passthrough.mount(folder, mountpoint, wait_async)
-
-
-    if argv[0] == "fuse3-mount":
-        from filesystems import fuse3
-        print("WARNING UNFINISHED!")
-        path = argv[1]
-        mountpoint = argv[2]
-        print(f" {path} mountpoint={mountpoint}")
-        # TODO multi threading ..
-        folder = get_folder(cache_directory, root_url)
-        folder = wait_async(walking.walk_path_find_folder)(folder, MyPath(path))
-        assert folder
-        fuse3.mount(folder, mountpoint, wait_async)
-
-
-    elif argv[0] == "list":
-        path = argv[1]
-        async def list_():
+    def run_command(argv: list[str]):
+        if argv[0] == "fuse-mount":
+            from filesystems import fuse
+            path = argv[1]
+            mountpoint = argv[2]
+            print(f" {path} mountpoint={mountpoint}")
+            # TODO multi threading ..
             folder = get_folder(cache_directory, root_url)
-            fof = await walking.walk_path(folder, MyPath(path))
+            folder = wait_async(walking.walk_path_find_folder)(folder, MyPath(path))
             assert folder
-            print(await walking.info(fof))
-        wait_async(list_)()
+            fuse.mount(folder, mountpoint, wait_async)
 
-    elif argv[0] == "prefetch":
-        path = argv[1]
-        async def prefetch():
-            folder = get_folder(cache_directory, root_url)
-            folder = await walking.walk_path_find_folder(folder, MyPath(path))
-            assert folder
-            limiter = asyncio.Semaphore(120)
-            errors = walking.Errors()
-            await walking.prefetch(folder, limiter, errors, True)
-            errors.print_all()
-        wait_async(prefetch)()
-
-    elif argv[0] == "du_approximate":
-        limiter = asyncio.Semaphore(50)
-        path = argv[1]
-        async def du_approximate():
-            folder = get_folder(cache_directory, root_url)
-            folder = await walking.walk_path_find_folder(folder, MyPath(path))
-            assert folder
-            size = await walking.list_and_size_approximate_fast_parallel(folder, limiter)
-            print(f"size {walking.format_size_MiB(size)}")
-        wait_async(du_approximate)()
-
-    elif argv[0] == "cache_dir_check_sizes":
-        limiter = asyncio.Semaphore(50)
-        path = argv[1]
-        async def du_approximate():
+        if argv[0] == "fuse_passthrough-mount":
+            from filesystems import fuse_passthrough
+            path = argv[1]
+            mountpoint = argv[2]
+            print(f" {path} mountpoint={mountpoint}")
+            # TODO multi threading ..
             folder = get_folder(cache_directory, root_url)
-            folder = await walking.walk_path_find_folder(folder, MyPath(path))
+            folder = wait_async(walking.walk_path_find_folder)(folder, MyPath(path))
             assert folder
-            errors = walking.Errors()
-            await walking.walk_cache_dir_check_sizes(folder, cache_directory / path, errors)
-        wait_async(du_approximate)()
-
-    elif argv[0] == "walk_cache_check_download_completness":
-        limiter = asyncio.Semaphore(50)
-        path = argv[1]
-        async def du_approximate():
-            folder = get_folder(cache_directory, root_url)
-            folder = await walking.walk_path_find_folder(folder, MyPath(path))
-            assert folder
-            errors = walking.Errors()
-            await walking.walk_cache_check_download_completness(folder, cache_directory / path, errors)
-        wait_async(du_approximate)()
+            fuse_passthrough.mount(folder, mountpoint, wait_async)
 
 
-    elif argv[0] == "list_special_and_approximate_size_fast":
-        limiter = asyncio.Semaphore(50)
-        path = argv[1]
-        async def du_approximate():
+        if argv[0] == "fuse3-mount":
+            from filesystems import fuse3
+            print("WARNING UNFINISHED!")
+            path = argv[1]
+            mountpoint = argv[2]
+            print(f" {path} mountpoint={mountpoint}")
+            # TODO multi threading ..
             folder = get_folder(cache_directory, root_url)
-            folder = await walking.walk_path_find_folder(folder, MyPath(path))
+            folder = wait_async(walking.walk_path_find_folder)(folder, MyPath(path))
             assert folder
-            total, lines = await walking.list_special_and_approximate_size_fast(folder)
-            [ print(l) for l in lines ]
-        wait_async(du_approximate)()
-    else:
-        usage()
-        raise Exception(f"bad command {argv[0]}")
+            fuse3.mount(folder, mountpoint, wait_async)
+
+
+        elif argv[0] == "list":
+            path = argv[1]
+            async def list_():
+                folder = get_folder(cache_directory, root_url)
+                fof = await walking.walk_path(folder, MyPath(path))
+                assert folder
+                print(await walking.info(fof))
+            wait_async(list_)()
+
+        elif argv[0] == "prefetch":
+            parser = ArgumentParser(prog=f"{app} <CACHE_DIR> <URL> prefetch")
+            parser.add_argument("path")
+            parser.add_argument("--include", action="append", default=[], help="glob relative to PATH, * matches / too, eg '*.zarr/2/*'")
+            parser.add_argument("--exclude", action="append", default=[], help="glob relative to PATH, excluded folders are not listed")
+            parser.add_argument("--zarr-levels", help="comma separated levels to fetch of zarr archives eg 2,3,4,5")
+            parser.add_argument("--max-bytes", type=walking.parse_size, help="stop planning once approximate sizes reach this, eg 200GiB")
+            parser.add_argument("--order", choices=walking.prefetch_orders, default="path")
+            parser.add_argument("--dry-run", action="store_true", help="only print what would be fetched")
+            a = parser.parse_args(argv[1:])
+            selection = walking.PrefetchSelection(
+                include = a.include,
+                exclude = a.exclude,
+                zarr_levels = set(a.zarr_levels.split(",")) if a.zarr_levels else None,
+                max_bytes = a.max_bytes,
+                order = a.order,
+            )
+            async def prefetch():
+                folder = get_folder(cache_directory, root_url)
+                folder = await walking.walk_path_find_folder(folder, MyPath(a.path))
+                assert folder
+                limiter = asyncio.Semaphore(120)
+                errors = walking.Errors()
+                p = progress("prefetch")
+                if selection.is_default() and not a.dry_run:
+                    pins.pin(str(folder.path))
+                    reporter = p.start(thread_loop)
+                    try:
+                        await walking.prefetch(folder, limiter, errors, True, p)
+                    finally:
+                        reporter.cancel()
+                else:
+                    plan = await walking.plan_prefetch(folder, selection, limiter)
+                    print(f"planned {len(plan)} files {walking.format_size_MiB(walking.plan_size(plan))} (approximate)")
+                    if not a.dry_run:
+                        # only what was selected, the rest below stays evictable
+                        pins.pin_many(str(f.path()) for f in plan)
+                        reporter = p.start(thread_loop)
+                        try:
+                            await walking.prefetch_planned(plan, 120, errors, True, p)
+                        finally:
+                            reporter.cancel()
+                errors.print_all()
+            wait_async(prefetch)()
+
+        elif argv[0] == "prefetch-manifest":
+            parser = ArgumentParser(prog=f"{app} <CACHE_DIR> <URL> prefetch-manifest", description="format see filesystems/walking.py PREFETCH MANIFEST")
+            parser.add_argument("file")
+            parser.add_argument("--max-bytes", type=walking.parse_size, help="total budget over all entries")
+            parser.add_argument("--dry-run", action="store_true")
+            a = parser.parse_args(argv[1:])
+            entries = walking.parse_prefetch_manifest(daemon.user_path(a.file).read_text())
+            async def prefetch_manifest():
+                folder = get_folder(cache_directory, root_url)
+                limiter = asyncio.Semaphore(120)
+                errors = walking.Errors()
+                plan = await walking.plan_prefetch_manifest(folder, entries, limiter, errors)
+                plan = walking.cut_plan(plan, a.max_bytes)
+                planned = walking.plan_size(plan)
+                print(f"planned {len(plan)} files {walking.format_size_MiB(planned)} (approximate) from {len(entries)} entries")
+                if not a.dry_run:
+                    pins.pin_many(str(f.path()) for f in plan)
+                    p = progress("prefetch-manifest")
+                    reporter = p.start(thread_loop)
+                    try:
+                        await walking.prefetch_planned(plan, 120, errors, True, p)
+                    finally:
+                        reporter.cancel()
+                errors.print_all()
+            wait_async(prefetch_manifest)()
+
+        elif argv[0] == "prefetch-zarr-roi":
+            parser = ArgumentParser(prog=f"{app} <CACHE_DIR> <URL> prefetch-zarr-roi", description="fetch the chunks of a zarr level intersecting a bounding box without listing chunk folders")
+            parser.add_argument("level", help="path of the level folder containing .zarray eg ...Scroll1A.zarr/2")
+            parser.add_argument("roi", help="z0:z1,y0:y1,x0:x1 half open voxel ranges of that level, empty bounds mean whole axis")
+            parser.add_argument("--concurrency", type=int, default=20)
+            parser.add_argument("--dry-run", action="store_true")
+            a = parser.parse_args(argv[1:])
+            async def prefetch_zarr_roi():
+                root = get_folder(cache_directory, root_url)
+                level = MyPath(a.level.strip("/"))
+                zarray = await zarr_roi.read_zarray(root.opts, level)
+                roi = zarr_roi.parse_roi(a.roi, zarray["shape"])
+                ranges = zarr_roi.chunk_ranges(zarray, roi)
+                count = zarr_roi.chunk_count(ranges)
+                ratio = zarr_roi.measured_compression_ratio(cache_directory, level)
+                chunk_bytes = round(zarr_roi.estimated_chunk_size(zarray, ratio))
+                print(f"roi {roi} chunks {[(r.start, r.stop) for r in ranges]} planned {count} chunk keys ~{walking.format_size_MiB(count * chunk_bytes)} (estimated)")
+                if a.dry_run:
+                    return
+                pins.pin_many(f"{level}/{key}" for key in zarr_roi.chunk_keys(zarray, ranges))
+                errors = walking.Errors()
+                p = progress("prefetch-zarr-roi")
+                p.plan(count, count * chunk_bytes)
+                reporter = p.start(thread_loop)
+                try:
+                    missing = await zarr_roi.prefetch_keys(root.opts, level, zarr_roi.chunk_keys(zarray, ranges), a.concurrency, errors, p, chunk_bytes)
+                finally:
+                    reporter.cancel()
+                    # chunks were downloaded without the folders knowing
+                    generation.bump_subtree(str(level))
+                print(f"chunks not on server (fill_value) {missing}")
+                errors.print_all()
+            wait_async(prefetch_zarr_roi)()
+
+        elif argv[0] == "prefetch-slices":
+            parser = ArgumentParser(prog=f"{app} <CACHE_DIR> <URL> prefetch-slices", description="fetch a range of slices of a tif stack folder in slice order")
+            parser.add_argument("path")
+            parser.add_argument("slices", type=walking.parse_slice_range, help="start:end[:step] of the number in the file names, end excluded")
+            parser.add_argument("--ext", action="append", help="file extensions to consider, default .tif .tiff")
+            parser.add_argument("--concurrency", type=int, default=20)
+            parser.add_argument("--dry-run", action="store_true")
+            a = parser.parse_args(argv[1:])
+            async def prefetch_slices():
+                root = get_folder(cache_directory, root_url)
+                folder = await walking.walk_path_find_folder(root, MyPath(a.path))
+                assert folder
+                plan = await walking.plan_slices(folder, a.slices, tuple(a.ext) if a.ext else (".tif", ".tiff"))
+                if len(plan) > 0:
+                    print(f"planned {len(plan)} slices {plan[0].name} .. {plan[-1].name} {walking.format_size_MiB(walking.plan_size(plan))} (approximate)")
+                else:
+                    print("no slices in range")
+                if a.dry_run:
+                    return
+                pins.pin_many(str(f.path()) for f in plan)
+                errors = walking.Errors()
+                p = progress("prefetch-slices")
+                reporter = p.start(thread_loop)
+                try:
+                    await walking.prefetch_planned(plan, a.concurrency, errors, True, p)
+                finally:
+                    reporter.cancel()
+                errors.print_all()
+            wait_async(prefetch_slices)()
+
+        elif argv[0] == "du_approximate":
+            limiter = asyncio.Semaphore(50)
+            path = argv[1]
+            async def du_approximate():
+                folder = get_folder(cache_directory, root_url)
+                folder = await walking.walk_path_find_folder(folder, MyPath(path))
+                assert folder
+                p = progress("du_approximate")
+                reporter = p.start(thread_loop)
+                try:
+                    size = await walking.list_and_size_approximate_fast_parallel(folder, limiter, progress = p)
+                finally:
+                    reporter.cancel()
+                print(f"size {walking.format_size_MiB(size)}")
+            wait_async(du_approximate)()
+
+        elif argv[0] == "estimate-zarr":
+            parser = ArgumentParser(prog=f"{app} <CACHE_DIR> <URL> estimate-zarr", description="measure compression of zarr levels by HEAD requests of sampled chunks")
+            parser.add_argument("path", help="zarr folder (all levels) or one level folder")
+            parser.add_argument("--rel-error", type=float, default=0.1, help="target relative error of the mean chunk size at 95%% confidence")
+            parser.add_argument("--max-samples", type=int, default=400)
+            a = parser.parse_args(argv[1:])
+            async def estimate_zarr():
+                root = get_folder(cache_directory, root_url)
+                folder = await walking.walk_path_find_folder(root, MyPath(a.path))
+                assert folder
+                async def chunk_size(folder: MyPath, name: str):
+                    try:
+                        return await root.opts.file_fetch_size(folder, name)
+                    except Exception as e:
+                        if getattr(e, "status", None) == 404:
+                            return None
+                        raise
+                await walking.estimate_zarr_sampled(folder, chunk_size, a.rel_error, a.max_samples)
+            wait_async(estimate_zarr)()
+
+        elif argv[0] == "cache_dir_check_sizes":
+            limiter = asyncio.Semaphore(50)
+            path = argv[1]
+            async def du_approximate():
+                folder = get_folder(cache_directory, root_url)
+                folder = await walking.walk_path_find_folder(folder, MyPath(path))
+                assert folder
+                errors = walking.Errors()
+                p = progress("cache_dir_check_sizes")
+                reporter = p.start(thread_loop)
+                try:
+                    await walking.walk_cache_dir_check_sizes(folder, cache_directory / path, errors, p)
+                finally:
+                    reporter.cancel()
+                errors.print_all()
+            wait_async(du_approximate)()
+
+        elif argv[0] == "walk_cache_check_download_completness":
+            parser = ArgumentParser(prog=f"{app} <CACHE_DIR> <URL> walk_cache_check_download_completness", description="cached bytes / total bytes of a subtree, from the rollups in the metadata")
+            parser.add_argument("path")
+            parser.add_argument("--exact", action="store_true", help="HEAD requests for sizes not in the listings and compare each cached file (slow)")
+            parser.add_argument("--recount", action="store_true", help="count cached files again, after changing the cache directory by hand")
+            a = parser.parse_args(argv[1:])
+            path = a.path
+            async def du_approximate():
+                folder = get_folder(cache_directory, root_url)
+                folder = await walking.walk_path_find_folder(folder, MyPath(path))
+                assert folder
+                errors = walking.Errors()
+                p = progress("walk_cache_check_download_completness")
+                reporter = p.start(thread_loop)
+                try:
+                    if a.exact:
+                        await walking.walk_cache_check_download_completness(folder, cache_directory / path, errors, p)
+                    else:
+                        if a.recount:
+                            generation.bump_subtree(path.strip("/"))
+                        walking.print_completeness(await walking.rollup(folder, p))
+                finally:
+                    reporter.cancel()
+                errors.print_all()
+            wait_async(du_approximate)()
+
+
+        elif argv[0] == "verify":
+            parser = ArgumentParser(prog=f"{app} <CACHE_DIR> <URL> verify", description="check cached files against cached metadata sizes, no network")
+            parser.add_argument("path")
+            parser.add_argument("--repair", action="store_true", help="unlink partial, oversized and corrupt files and download them again")
+            parser.add_argument("--hash", action="store_true", help="rehash files whose mtime changed since they were downloaded")
+            parser.add_argument("--threads", type=int, default=16)
+            a = parser.parse_args(argv[1:])
+            path = a.path.strip("/")
+            async def verify_():
+                p = progress("verify")
+                reporter = p.start(thread_loop)
+                try:
+                    report = await thread_loop.run_in_executor(None, verify.verify_tree, cache_directory / path, f"{path}/" if path else "", a.threads, p, a.hash, cache_directory)
+                finally:
+                    reporter.cancel()
+                report.print_all()
+                if a.repair:
+                    bad = verify.unlink_bad(report, cache_directory)
+                    if bad:
+                        generation.bump(bad)
+                    root = get_folder(cache_directory, root_url)
+                    # intact but touched files: remember the new mtime so they aren't rehashed again
+                    for x, mtime in report.hash_ok:
+                        folder, name = await walking.walk_path(root, MyPath(x))
+                        if folder and name:
+                            c = await folder.cached()
+                            c.data.files[name].mtime = mtime
+                            c.changed()
+                    plan = []
+                    for x in bad:
+                        folder, name = await walking.walk_path(root, MyPath(x))
+                        if folder and name:
+                            plan.append(walking.PlannedFile(folder, name, await folder.file_size_bytes_approximate(name)))
+                    print(f"repairing {len(plan)} files")
+                    errors = walking.Errors()
+                    await walking.prefetch_planned(plan, 20, errors)
+                    errors.print_all()
+            wait_async(verify_)()
+
+        elif argv[0] == "evict":
+            parser = ArgumentParser(prog=f"{app} <CACHE_DIR> <URL> evict", description="remove downloaded files above the quota, see filesystems/eviction.py")
+            parser.add_argument("--quota", type=walking.parse_size, default=g.cache_quota)
+            parser.add_argument("--policy", choices=eviction.eviction_policies, default=g.eviction)
+            parser.add_argument("--dry-run", action="store_true")
+            a = parser.parse_args(argv[1:])
+            if a.quota == None:
+                raise Exception("evict needs --quota or --cache-quota")
+            async def evict():
+                files = await thread_loop.run_in_executor(None, eviction.scan_cache, cache_directory, access_log)
+                usage = sum(f.size for f in files)
+                # downloads of a daemon running this, of other processes: leases and recent mtimes
+                evict = eviction.plan_eviction(files, a.quota, pins, a.policy, in_flight(), max_partial_age = g.partial_max_age * 3600)
+                size = sum(f.size for f in evict)
+                MiB = 1024 * 1024
+                for f in evict:
+                    log.info(f"evict {f.rel} {f.size / MiB:.2f} MiB")
+                print(f"cache {usage / MiB:.2f} MiB quota {a.quota / MiB:.2f} MiB pinned {len(pins.data)} paths")
+                print(f"{'would evict' if a.dry_run else 'evicting'} {len(evict)} files {size / MiB:.2f} MiB")
+                if not a.dry_run:
+                    eviction.remove(cache_directory, evict)
+                    access_log.forget(f.rel for f in evict)
+                    generation.bump(f.rel for f in evict)
+            wait_async(evict)()
+
+        elif argv[0] == "sync":
+            parser = ArgumentParser(prog=f"{app} <CACHE_DIR> <URL> sync", description="list the cached folders below PATH again and print what changed on the server, see filesystems/sync.py")
+            parser.add_argument("path")
+            parser.add_argument("--apply", action="store_true", help="update the metadata, move cached files of removed and changed entries to .trash")
+            parser.add_argument("--download", action="store_true", help="--apply and download new and changed files and new folders")
+            parser.add_argument("--concurrency", type=int, default=20)
+            a = parser.parse_args(argv[1:])
+            async def sync_():
+                from filesystems import sync
+                root = get_folder(cache_directory, root_url)
+                folder = await walking.walk_path_find_folder(root, MyPath(a.path))
+                assert folder
+                def listed(p: MyPath):
+                    return (cache_directory / str(p) / ash2txtorg_cached.METADATA_FILE).exists()
+                report = sync.SyncReport()
+                trash = sync.Trash(cache_directory) if a.apply or a.download else None
+                p = progress("sync")
+                reporter = p.start(thread_loop)
+                try:
+                    await sync.sync(folder, listed, report, print, a.apply, a.download, trash, p)
+                finally:
+                    reporter.cancel()
+                print(report.summary())
+                for e in report.errors:
+                    print(e)
+                if a.download:
+                    plan = await sync.plan_download(report, asyncio.Semaphore(50))
+                    print(f"downloading {len(plan)} files {walking.format_size_MiB(walking.plan_size(plan))} (approximate)")
+                    errors = walking.Errors()
+                    p = progress("sync download")
+                    reporter = p.start(thread_loop)
+                    try:
+                        await walking.prefetch_planned(plan, a.concurrency, errors, False, p)
+                    finally:
+                        reporter.cancel()
+                    errors.print_all()
+            wait_async(sync_)()
+
+        elif argv[0] == "find":
+            parser = ArgumentParser(prog=f"{app} <CACHE_DIR> <URL> find", description="files below PATH matching a glob or regex, from the index of cached listings (folders never listed aren't found)")
+            parser.add_argument("path")
+            parser.add_argument("pattern", help="glob, * also matches /, without / only file names are matched. Or a regex with --regex")
+            parser.add_argument("--regex", action="store_true", help="re.search on the path relative to PATH")
+            parser.add_argument("--sync", action="store_true", help="first index metadata json written by other tools (the Go version)")
+            a = parser.parse_args(argv[1:])
+            path = a.path.strip("/")
+            async def find():
+                index = name_index()
+                def run():
+                    if a.sync or index.empty():
+                        seen, updated = index.sync(path)
+                        log.info(f"name index: {seen} folders, {updated} reindexed")
+                    matches = index.find_regex(path, a.pattern) if a.regex else index.find_glob(path, a.pattern)
+                    count = 0
+                    size = 0
+                    for p, s in matches:
+                        print(f"{walking.format_size_MiB(s):>14} {p}")
+                        count += 1
+                        size += s
+                    print(f"{count} files {walking.format_size_MiB(size)} (approximate)")
+                # streams from the executor so the loop (and daemon) keep going, print goes to the client
+                await thread_loop.run_in_executor(None, contextvars.copy_context().run, run)
+            wait_async(find)()
+
+        elif argv[0] == "bench-getattr":
+            parser = ArgumentParser(prog=f"{app} <CACHE_DIR> <URL> bench-getattr", description="getattr ops/sec of fusepy threads on the entries of PATH, as fuse.py does them, without mounting")
+            parser.add_argument("path")
+            parser.add_argument("--threads", default="1,8,32", help="comma separated thread counts")
+            parser.add_argument("--seconds", type=float, default=2.0, help="per thread count and mode")
+            parser.add_argument("--json", action="store_true", help="one json object of the results")
+            a = parser.parse_args(argv[1:])
+            root = get_folder(cache_directory, root_url)
+            path = MyPath(a.path)
+            faf = walking.folders_and_files_sync(root, path, wait_async)
+            assert faf != None, f"not a folder {path}"
+            folders, files = faf
+            paths = [path / x for x in [*folders.keys(), *files]] or [path]
+            def getattr_(p: MyPath):
+                folder, fname = walking.walk_path_sync(root, p, wait_async)
+                assert folder != None
+                if fname != None:
+                    walking.file_size_bytes_exact_sync(folder, fname, wait_async)
+            # loads the listing and sizes, the benchmark is about answering them
+            for p in paths:
+                getattr_(p)
+            results = {}
+            for fast in [True, False]:
+                walking.fast_path = fast
+                for n in [int(x) for x in a.threads.split(",")]:
+                    counts = [0] * n
+                    stop = Event()
+                    def worker(i: int):
+                        k = i
+                        while not stop.is_set():
+                            getattr_(paths[k % len(paths)])
+                            k += 1
+                            counts[i] += 1
+                    threads = [Thread(target=worker, args=(i,)) for i in range(n)]
+                    started = perf_counter()
+                    for x in threads:
+                        x.start()
+                    sleep(a.seconds)
+                    stop.set()
+                    for x in threads:
+                        x.join()
+                    # the main thread may get the GIL back well after the sleep
+                    key = f"getattr_{'fast' if fast else 'loop'}_{n}t"
+                    results[key] = sum(counts) / (perf_counter() - started)
+                    if not a.json:
+                        print(f"{key:24} {results[key]:12.0f} ops/s")
+            walking.fast_path = True
+            if a.json:
+                print(json.dumps(results))
+
+        elif argv[0] == "metrics":
+            if "--prometheus" in argv[1:]:
+                print(metrics.prometheus(), end="")
+            else:
+                print(metrics.table())
+
+        elif argv[0] == "pin":
+            pins.pin(argv[1].strip("/"))
+            print(f"pinned {pins.data}")
+
+        elif argv[0] == "unpin":
+            pins.unpin(argv[1].strip("/"))
+            print(f"pinned {pins.data}")
+
+        elif argv[0] == "list_special_and_approximate_size_fast":
+            limiter = asyncio.Semaphore(50)
+            path = argv[1]
+            async def du_approximate():
+                folder = get_folder(cache_directory, root_url)
+                folder = await walking.walk_path_find_folder(folder, MyPath(path))
+                assert folder
+                await walking.list_special_and_approximate_size_fast(folder)
+            wait_async(du_approximate)()
+        else:
+            usage()
+            raise Exception(f"bad command {argv[0]}")
+
+    # global options of a client of the daemon (see serve): applied per request
+    request_options = ["verbose", "progress_jsonl"]
+    # configure the daemon process, a client may only repeat the daemon's values
+    process_options = ["offline", "cache_quota", "eviction", "partial_max_age", "block_cache", "abandon_grace", "fsync", "hedge", "hedge_budget", "request_timeout"]
+    # measure the command itself, not the daemon: the command runs in-process
+    measuring_options = ["trace", "metrics_file", "sample_profile"]
+
+    def option_text(k: str, v) -> str:
+        flag = "--" + k.replace("_", "-")
+        if v == None or v == False:
+            return f"no {flag}"
+        return flag if v == True else f"{flag} {v}"
+
+    def check_options(options: dict) -> Optional[str]:
+        for k in process_options:
+            if k in options and options[k] != getattr(g, k):
+                return (f"the daemon serving {cache_directory} runs with {option_text(k, getattr(g, k))}, this command asks for {option_text(k, options[k])}: "
+                    f"leave the option out, or stop the daemon to run with it")
+        return None
+
+    def serve_command(argv: list[str]):
+        options = daemon.current_options.get()
+        log.request_verbosity.set(options.get("verbose", 0))
+        jsonl = open(daemon.user_path(options["progress_jsonl"]), "a") if options.get("progress_jsonl") else None
+        request_jsonl.set(jsonl)
+        try:
+            run_command(argv)
+        finally:
+            if jsonl:
+                jsonl.close()
+
+    if argv[0] == "serve":
+        # daemon.py
+        sock = daemon.socket_path(cache_directory)
+        daemon.install_output_proxies()
+        server = wait_async(daemon.start_server)(sock, root_url, serve_command, check_options)
+        print(f"serving {root_url} on {sock}, stop by ctrl-c or SIGTERM")
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        try:
+            Event().wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            thread_loop.call_soon_threadsafe(server.close)
+            sock.unlink(missing_ok=True)
+            write_metrics_and_profile()
+        return
+
+    code = None
+    if not argv[0] in in_process_commands and not any(getattr(g, k) for k in measuring_options):
+        options = {k: getattr(g, k) for k in request_options}
+        options.update({k: getattr(g, k) for k in process_options if getattr(g, k) != global_parser.get_default(k)})
+        code = daemon.run_in_daemon(daemon.socket_path(cache_directory), root_url, argv, options)
+    if code == None:
+        try:
+            run_command(argv)
+        finally:
+            write_metrics_and_profile()
+    startup.mark("command done")
+    done = startup.elapsed()
+    if g.profile_startup:
+        startup.report()
+    if code:
+        raise SystemExit(code)
+    if g.startup_budget != None and done > g.startup_budget:
+        print(f"startup budget exceeded: {argv[0]} took {done:.3f}s > {g.startup_budget:.3f}s", file=sys.stderr)
+        raise SystemExit(3)
 
 
 try:
     main()
+except SystemExit:
+    raise
 except:
     traceback.print_exc()
 finally:
     [x.cancel() for x in cancel_tasks]
     exiting.set()
-    thread_loop.stop()
+    thread_loop.call_soon_threadsafe(thread_loop.stop)
     print(f"waiting for thread to join")
     loop_thread.join()
     print(f"done")
@@ -1,12 +1,17 @@
 from typing import TypeVar, Generic, Union, Callable, Any, IO, cast, Protocol, overload, Awaitable, Callable, Optional
 from .later import later_instance
-from bs4 import BeautifulSoup
-from dataclasses import dataclass, field
-from dataclasses_json import dataclass_json, config
+from dataclasses import dataclass
 from urllib.parse import unquote
 import asyncio
+import contextvars
+import errno
+import hashlib
+import json
+import os
+from time import time_ns
 from . import types as t
 from . import async_refreshable_weakref
+from .startup import timed
 
 # FETCHING FOLDER AND FILE DETAILS FROM ASH2TXT.ORG
 @dataclass
@@ -38,6 +43,9 @@ def approximate_size_bytes_from_str(size: str) -> int:
     raise NotImplementedError(unit)
 
 def parse_directory_html(html: str) -> FetchResultFolder:
+    # only needed when listing from the network, not for cached metadata
+    with timed("import bs4"):
+        from bs4 import BeautifulSoup
     soup = BeautifulSoup(html, 'html.parser')
     rows = soup.select("#list tbody tr")
     # print(f"processing/fetching path {path}")
@@ -67,17 +75,145 @@ def parse_directory_html(html: str) -> FetchResultFolder:
 
 
 # CACHING DATA TYPES
-@dataclass_json
+# one per folder in the cache directory, same format as the Go version uses
+METADATA_FILE = ".directory_contents_cached_v2.json"
+
+# content hash of downloaded files, sha256 so that sha256sum can be used to check by hand
+HASH_ALGORITHM = "sha256"
+
+def new_hasher():
+    return hashlib.new(HASH_ALGORITHM)
+
+# extended attribute of a download's .tmp: the version (If-Range) its bytes are of, only
+# partials having it can be resumed
+PARTIAL_VALIDATOR = "user.ash2txt.validator"
+
+class OfflineMiss(FileNotFoundError):
+    """ --offline: a listing, size or file which isn't in the cache, ENOENT for FUSE """
+
+    def __init__(self, what: str):
+        super().__init__(errno.ENOENT, f"not cached (offline): {what}")
+
+# set by the FUSE layers around operations which may download: is the requesting process
+# still there. Downloads only such requests wait for are cancelled once they are all gone
+requester_alive: contextvars.ContextVar[Optional[Callable[[], bool]]] = contextvars.ContextVar("requester_alive", default=None)
+
+def process_alive(pid: int) -> Optional[Callable[[], bool]]:
+    """ for requester_alive, pid of the FUSE request (0 if unknown) """
+    if pid <= 0:
+        return None
+    def alive() -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+    return alive
+
+async def while_requester_alive(aw: Awaitable, poll = 0.5):
+    """ awaits aw, gives up (InterruptedError, EINTR) once requester_alive says the requester is gone """
+    alive = requester_alive.get()
+    task = asyncio.ensure_future(aw)
+    try:
+        while alive != None:
+            done, _ = await asyncio.wait([task], timeout = poll)
+            if done:
+                break
+            if not alive():
+                raise InterruptedError(errno.EINTR, "requesting process is gone")
+        return await task
+    finally:
+        if not task.done():
+            task.cancel()
+
+@dataclass
+class Downloaded:
+    size: int
+    hash: str
+    mtime: int # st_mtime_ns of the cache file
+
+# (de)serialized by hand, the same json dataclasses_json wrote, but without importing it on each start
 @dataclass
 class CachedFileData:
-    size_approximate: int = field(metadata=config(field_name="a"))
-    size: Optional[int]   = field(metadata=config(field_name="s"), default = None)
+    size_approximate: int # "a"
+    size: Optional[int]   = None # "s"
+    # only set if downloaded by this tool: HASH_ALGORITHM hex digest computed while downloading
+    # and mtime of the cache file then. Files whose mtime didn't change needn't be rehashed.
+    hash: Optional[str]   = None # "h", omitted if None
+    mtime: Optional[int]  = None # "m", omitted if None
+    # date column of the listing, to notice files replaced by ones of the same size (sync)
+    date: Optional[str]   = None # "d", omitted if None
+
+    def to_dict(self) -> dict:
+        d = {"a": self.size_approximate, "s": self.size}
+        if self.hash != None:
+            d["h"] = self.hash
+        if self.mtime != None:
+            d["m"] = self.mtime
+        if self.date != None:
+            d["d"] = self.date
+        return d
+
+    @staticmethod
+    def from_dict(d: dict) -> "CachedFileData":
+        return CachedFileData(size_approximate = d["a"], size = d.get("s"), hash = d.get("h"), mtime = d.get("m"), date = d.get("d"))
+
+rollup_keys = {"a": "size", "e": "exact_bytes", "n": "files", "ne": "exact_files", "c": "cached_bytes", "nc": "cached_files", "x": "estimated", "g": "generation"}
+
+def rollup_to_dict(r: t.Rollup) -> dict:
+    return {k: getattr(r, v) for k, v in rollup_keys.items()}
+
+def rollup_from_dict(d: dict) -> t.Rollup:
+    return t.Rollup(**{v: d[k] for k, v in rollup_keys.items()})
 
-@dataclass_json
 @dataclass
 class CachedFolderData:
     files:   dict[str, CachedFileData]
     folders: list[str]
+    # folders containing .zarray: compression ratio measured by sampling chunk sizes
+    # see zarray_estimation.estimate_zarray_contents_size_sampled
+    zarr_ratio: Optional[float] = None # "zr", omitted if None
+    # aggregates of the whole subtree, None when something below changed. See walking.rollup
+    rollup: Optional[t.Rollup] = None # "r", omitted if None
+
+    def to_json(self) -> str:
+        d = {"files": {k: v.to_dict() for k, v in self.files.items()}, "folders": self.folders}
+        if self.zarr_ratio != None:
+            d["zr"] = self.zarr_ratio
+        if self.rollup != None:
+            d["r"] = rollup_to_dict(self.rollup)
+        return json.dumps(d)
+
+    @staticmethod
+    def from_json(s: str) -> "CachedFolderData":
+        d = json.loads(s)
+        return CachedFolderData(
+            files = {k: CachedFileData.from_dict(v) for k, v in d["files"].items()},
+            folders = d["folders"],
+            zarr_ratio = d.get("zr"),
+            rollup = rollup_from_dict(d["r"]) if "r" in d else None)
+
+
+def merge_folder_data(mine: CachedFolderData, theirs: CachedFolderData):
+    """ keep what another process learned about the same files (exact sizes, newer hashes)
+        when writing the json it changed since we read it. The listing itself stays ours.
+    """
+    for name, f in mine.files.items():
+        o = theirs.files.get(name)
+        if o == None:
+            continue
+        if f.size == None:
+            f.size = o.size
+        if o.hash != None and (f.mtime == None or (o.mtime or 0) > f.mtime):
+            f.hash = o.hash
+            f.mtime = o.mtime
+    if mine.zarr_ratio == None:
+        mine.zarr_ratio = theirs.zarr_ratio
+    # one of us saw a change below the other doesn't know about
+    if mine.rollup != theirs.rollup:
+        mine.rollup = None
 
 
 # CACHED FS IMPLEMENTATION
@@ -111,23 +247,41 @@ class FolderOpts:
     loop: asyncio.AbstractEventLoop
     folder_fetch:    Callable[[t.MyPath], Awaitable[AutoStore[CachedFolderData]]]
     file_fetch_size: Callable[[t.MyPath, str], Awaitable[int]]
-    file_ensure_fetched: Callable[[t.MyPath, str], Awaitable]
+    # returns Downloaded if the file had to be downloaded
+    file_ensure_fetched: Callable[[t.MyPath, str], Awaitable[Optional[Downloaded]]]
     file_bytes: Callable[[t.MyPath, str, int, int], Awaitable[bytes]]
     file_cache_path: Callable[[t.MyPath, str], Awaitable[str]]
+    # called when file contents are used (FUSE open/read), for cache eviction
+    file_accessed: Optional[Callable[[t.MyPath, str], None]] = None
+    # name -> size of the files of a folder in the cache directory, for rollups
+    cached_file_sizes: Optional[Callable[[t.MyPath], Awaitable[dict[str, int]]]] = None
+    # fresh listing from the server, not cached (sync)
+    folder_listing: Optional[Callable[[t.MyPath], Awaitable[CachedFolderData]]] = None
+    # time (ns) files below the folder were last removed or added bypassing the folders
+    # (eviction, repair, zarr roi), rollups taken before are stale. See eviction.Generation
+    cache_generation: Callable[[t.MyPath], int] = lambda path: 0
+    # --offline: (listed subfolders, cached files) of a folder, the other entries are hidden
+    offline_entries: Optional[Callable[[t.MyPath], Awaitable[tuple[set[str], set[str]]]]] = None
 
 
 class LazyFolder(t.Folder):
 
-    def __init__(self, path: t.MyPath, opts: FolderOpts):
+    def __init__(self, path: t.MyPath, opts: FolderOpts, parent: Optional["LazyFolder"] = None):
         self.path = path
         self.opts = opts
+        # to invalidate the rollups of the folders above
+        self.parent = parent
         self.cache = None
         self.wait_size = {}
         self.ensure_fetched = {}
         async def recreate():
             c = await self.cached()
-            folders = {k: LazyFolder(self.path / k .lstrip('/'), self.opts)  for k in c.data.folders}
+            folders = {k: LazyFolder(self.path / k .lstrip('/'), self.opts, self)  for k in c.data.folders}
             files   = c.data.files
+            if self.opts.offline_entries:
+                listed, cached = await self.opts.offline_entries(self.path)
+                folders = {k: v for k, v in folders.items() if k in listed}
+                files = {k: v for k, v in files.items() if k in cached}
             return t.FoldersAndFilesDC(folders = folders, files = files)
 
         ## is it wrorth it ? I if you keep mount running then yes
@@ -146,6 +300,17 @@ class LazyFolder(t.Folder):
         x = await self.faf.get()
         return x.folders, list(x.files.keys())
 
+    def folders_and_files_nowait(self) -> Optional[t.FoldersAndFiles]:
+        x = self.faf.peek()
+        return (x.folders, x.files) if x != None else None
+
+    def file_size_bytes_exact_nowait(self, name: str) -> Optional[int]:
+        c = self.cache
+        if c == None or not c.done() or c.cancelled() or c.exception() != None:
+            return None
+        file = c.result().data.files.get(name)
+        return file.size if file != None else None
+
     async def file_size_bytes_approximate(self, name) -> int:
         c = await self.cached()
         file = c.data.files[name]
@@ -153,6 +318,11 @@ class LazyFolder(t.Folder):
             return file.size
         return file.size_approximate
 
+    async def file_sizes_approximate(self) -> t.FileSizeColumns:
+        c = await self.cached()
+        files = c.data.files
+        return list(files.keys()), [f.size if f.size != None else f.size_approximate for f in files.values()]
+
     async def file_size_bytes_exact(self, name: str) -> int:
         c = await self.cached()
 
@@ -167,6 +337,7 @@ class LazyFolder(t.Folder):
                 size = await task
                 c.data.files[name].size = size
                 c.changed()
+                self.invalidate_rollup()
                 del self.wait_size[name]
             self.opts.loop.create_task(clean())
 
@@ -190,14 +361,97 @@ class LazyFolder(t.Folder):
 
         return await self.wait_size[name]
 
-    def file_bytes(self, name, offset: int, size: int) -> Awaitable[bytes]:
-        return self.opts.file_bytes(self.path, name, offset, size)
+    async def file_bytes(self, name, offset: int, size: int) -> bytes:
+        await self.file_ensure_fetched(name)
+        return await self.opts.file_bytes(self.path, name, offset, size)
 
-    def file_ensure_fetched(self, name):
-        return self.opts.file_ensure_fetched(self.path, name)
+    def file_accessed(self, name: str):
+        if self.opts.file_accessed:
+            self.opts.file_accessed(self.path, name)
 
-    def file_cache_path(self, name):
-        return self.opts.file_cache_path(self.path, name)
+    async def file_ensure_fetched(self, name):
+        d = await self.opts.file_ensure_fetched(self.path, name)
+        if d != None:
+            await self.file_set_downloaded(name, d)
+
+    async def file_set_downloaded(self, name: str, d: Downloaded):
+        c = await self.cached()
+        file = c.data.files.get(name)
+        if file != None:
+            file.size = d.size
+            file.hash = d.hash
+            file.mtime = d.mtime
+            c.changed()
+            self.invalidate_rollup()
+
+    async def file_cache_path(self, name):
+        await self.file_ensure_fetched(name)
+        return await self.opts.file_cache_path(self.path, name)
+
+    async def zarr_compression_ratio(self) -> Optional[float]:
+        c = await self.cached()
+        return c.data.zarr_ratio
+
+    async def set_zarr_compression_ratio(self, ratio: float):
+        c = await self.cached()
+        c.data.zarr_ratio = ratio
+        c.changed()
+        self.invalidate_rollup()
+
+    async def replace_listing(self, data: CachedFolderData):
+        """ after sync: keeps the LazyFolder of folders still listed """
+        c = await self.cached()
+        c.data = data
+        c.changed()
+        x = await self.faf.get()
+        x.folders = {k: x.folders[k] if k in x.folders else LazyFolder(self.path / k, self.opts, self) for k in data.folders}
+        x.files = data.files
+        self.invalidate_rollup()
+
+    def invalidate_rollup(self):
+        """ drops the rollups of this folder and all folders above, they were all loaded to get here """
+        f = self
+        while f != None:
+            if f.cache and f.cache.done() and not f.cache.cancelled() and f.cache.exception() == None:
+                c = f.cache.result()
+                if c.data.rollup != None:
+                    c.data.rollup = None
+                    c.changed()
+            f = f.parent
+
+    async def rollup(self) -> Optional[t.Rollup]:
+        if self.opts.offline_entries:
+            # offline a folder shows only part of its entries, neither reuse nor keep sums
+            return None
+        c = await self.cached()
+        r = c.data.rollup
+        if r != None and r.generation >= self.opts.cache_generation(self.path):
+            return r
+        return None
+
+    async def set_rollup(self, r: t.Rollup):
+        if self.opts.offline_entries:
+            return
+        c = await self.cached()
+        c.data.rollup = r
+        c.changed()
+
+    async def files_rollup(self) -> t.Rollup:
+        # taken before looking at the cache directory, a change meanwhile makes it stale
+        r = t.Rollup(generation = time_ns())
+        # the files shown, offline only the cached ones
+        files = (await self.faf.get()).files
+        cached = await self.opts.cached_file_sizes(self.path) if self.opts.cached_file_sizes else {}
+        for name, f in files.items():
+            r.files += 1
+            r.size += f.size if f.size != None else f.size_approximate
+            if f.size != None:
+                r.exact_bytes += f.size
+                r.exact_files += 1
+            if name in cached:
+                r.cached_bytes += cached[name]
+                r.cached_files += 1
+        return r
 
     async def file_exists(self, name: str) -> bool:
         raise NotImplementedError()
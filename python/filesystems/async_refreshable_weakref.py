@@ -17,8 +17,14 @@ class AsyncRefreshableWeakRef(Generic[T]):
         self._weak_ref = None
         self._delay = delay
         self._recreate = recreate
+        # set by peek (other threads), keeps the object strong for another round
+        self._peeked = False
 
     def do_later(self):
+        if self._peeked and self._strong_ref is not None:
+            self._peeked = False
+            later_instance.once(self, ticks = 60)
+            return
         self.to_weak()
 
     def to_weak(self):
@@ -38,6 +44,16 @@ class AsyncRefreshableWeakRef(Generic[T]):
         self.refresh()
         return obj
 
+    def peek(self) -> Optional[T]:
+        """ the object if it is alive, without recreating it. Only reads, so safe from other threads """
+        obj = self._strong_ref
+        if obj is None:
+            w = self._weak_ref
+            obj = w() if w else None
+        if obj is not None:
+            self._peeked = True
+        return obj
+
     def refresh(self):
         """Manually refresh the timer."""
         if self._strong_ref is not None or (self._weak_ref and self._weak_ref() is not None):
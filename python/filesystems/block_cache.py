@@ -0,0 +1,138 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+from . import metrics
+
+"""
+bounded in-memory cache of file blocks in front of the reads of cached files
+
+Viewers reread the small files (.zarray, .zattrs, meta.json) and the headers of
+tifs all the time. Each FUSE read used to open and read the cache file again.
+
+Blocks (block_size) are keyed by (st_dev, st_ino, st_mtime_ns, block) of the cache
+file, so a file downloaded again (renamed in place) or removed is never served
+stale, its blocks just age out. Only block 0 of every file and all blocks of files
+up to small_file are admitted, so reading a 4 GiB volume doesn't flush the cache.
+Least recently used blocks go first once capacity is exceeded.
+
+One cache per process (shared), sized by --block-cache, hits / misses are in the
+metrics table and Prometheus export.
+"""
+
+KiB = 1024
+MiB = 1024 * KiB
+
+class BlockCache:
+
+    def __init__(self, capacity: int = 64 * MiB, block_size: int = 64 * KiB, small_file: int = 1 * MiB):
+        self.capacity = capacity
+        self.block_size = block_size
+        self.small_file = small_file
+        self.lock = threading.Lock()
+        self.blocks: OrderedDict[tuple, bytes] = OrderedDict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def cacheable(self, file_size: int, block: int) -> bool:
+        return self.capacity > 0 and (block == 0 or file_size <= self.small_file)
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        with self.lock:
+            data = self.blocks.get(key)
+            if data != None:
+                self.blocks.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return data
+
+    def put(self, key: tuple, data: bytes):
+        with self.lock:
+            if key in self.blocks:
+                return
+            self.blocks[key] = data
+            self.used += len(data)
+            while self.used > self.capacity and self.blocks:
+                _, old = self.blocks.popitem(last = False)
+                self.used -= len(old)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.used = 0
+
+    def hit_ratio(self) -> Optional[float]:
+        n = self.hits + self.misses
+        return self.hits / n if n else None
+
+    def _blocks(self, st: os.stat_result, offset: int, size: Optional[int]) -> tuple[tuple, int, int]:
+        """ key prefix, end, last block. size None reads to the end of the file """
+        end = st.st_size if size == None else min(st.st_size, offset + size)
+        return (st.st_dev, st.st_ino, st.st_mtime_ns), end, (end - 1) // self.block_size
+
+    def _cached_only(self, st: os.stat_result, offset: int, size: Optional[int]) -> Optional[bytes]:
+        """ the bytes if all blocks are cached, so that the file needn't be opened """
+        key, end, last = self._blocks(st, offset, size)
+        if offset >= end:
+            return b""
+        first = offset // self.block_size
+        if not all(self.cacheable(st.st_size, b) for b in range(first, last + 1)):
+            return None
+        with self.lock:
+            parts = [self.blocks.get((*key, b)) for b in range(first, last + 1)]
+            if any(p == None for p in parts):
+                return None
+            for b in range(first, last + 1):
+                self.blocks.move_to_end((*key, b))
+            self.hits += len(parts)
+        start = offset - first * self.block_size
+        return b"".join(parts)[start:start + end - offset]
+
+    def read_fd(self, fd: int, offset: int, size: Optional[int]) -> bytes:
+        st = os.fstat(fd)
+        key, end, last = self._blocks(st, offset, size)
+        if offset >= end:
+            return b""
+        first = offset // self.block_size
+        if not any(self.cacheable(st.st_size, b) for b in range(first, last + 1)):
+            with metrics.timed("disk.read"):
+                return os.pread(fd, end - offset, offset)
+        parts = []
+        for b in range(first, last + 1):
+            data = self.get((*key, b)) if self.cacheable(st.st_size, b) else None
+            if data == None:
+                with metrics.timed("disk.read"):
+                    data = os.pread(fd, self.block_size, b * self.block_size)
+                if self.cacheable(st.st_size, b):
+                    self.put((*key, b), data)
+            parts.append(data)
+        start = offset - first * self.block_size
+        return b"".join(parts)[start:start + end - offset]
+
+    def read_path(self, path, offset: int, size: Optional[int]) -> bytes:
+        st = os.stat(path)
+        data = self._cached_only(st, offset, size)
+        if data != None:
+            return data
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            # fstat again, the file may have been replaced since
+            return self.read_fd(fd, offset, size)
+        finally:
+            os.close(fd)
+
+shared = BlockCache()
+
+def configure(capacity: int):
+    shared.capacity = capacity
+    shared.clear()
+
+metrics.value("block_cache_hits", "counter", lambda: shared.hits)
+metrics.value("block_cache_misses", "counter", lambda: shared.misses)
+metrics.value("block_cache_evictions", "counter", lambda: shared.evictions)
+metrics.value("block_cache_bytes", "gauge", lambda: shared.used)
+metrics.value("block_cache_hit_ratio", "gauge", lambda: round(shared.hit_ratio() or 0.0, 3))
@@ -0,0 +1,177 @@
+import asyncio
+import contextvars
+import json
+import os
+import socket
+import sys
+import traceback
+from pathlib import Path
+from typing import Callable, Optional
+
+"""
+long running process serving commands over a unix socket in the cache directory
+
+`serve` keeps the session, the LazyFolder tree (hot for some minutes after each use,
+see AsyncRefreshableWeakRef) and the download scheduler (fetch_once, limiters) in
+memory. Other invocations of example-main.py first try to connect to the socket and
+only run in-process if no daemon is running.
+
+protocol: one json line per direction
+    request:  {"argv": [...], "root_url": "...", "cwd": "...", "options": {...}}
+    response: {"out": "..."} / {"err": "..."} lines while running, finally {"exit": 0}
+
+print() inside a request goes to its client: sys.stdout/sys.stderr are replaced by
+proxies writing to the output in the current_output contextvar, which wait_async
+passes on to the coroutines it starts on the loop.
+
+options: global options of the client (current_options). Those the daemon can't apply
+to one request are checked by check_options, a request asking for other values than
+the daemon runs with is refused.
+
+This module only uses the standard library so that clients start fast.
+"""
+
+SOCKET_FILE = ".daemon.sock"
+
+class RequestOutput:
+    """ forwards output of one request to its connection, writable from any thread """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, writer: asyncio.StreamWriter):
+        self.loop = loop
+        self.writer = writer
+
+    def send(self, msg: dict):
+        data = (json.dumps(msg) + "\n").encode("utf-8")
+        self.loop.call_soon_threadsafe(self.writer.write, data)
+
+current_output: contextvars.ContextVar[Optional[RequestOutput]] = contextvars.ContextVar("current_output", default=None)
+# working directory of the client, for relative paths given on its command line
+current_cwd: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("current_cwd", default=None)
+# global options of the client
+current_options: contextvars.ContextVar[dict] = contextvars.ContextVar("current_options", default={})
+
+class OutputProxy:
+
+    def __init__(self, default, key: str):
+        self.default = default
+        self.key = key
+
+    def write(self, s: str):
+        out = current_output.get()
+        if out == None:
+            return self.default.write(s)
+        if s:
+            out.send({self.key: s})
+        return len(s)
+
+    def flush(self):
+        if current_output.get() == None:
+            self.default.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.default, name)
+
+def install_output_proxies():
+    if not isinstance(sys.stdout, OutputProxy):
+        sys.stdout = OutputProxy(sys.stdout, "out")
+        sys.stderr = OutputProxy(sys.stderr, "err")
+
+def user_path(p: str) -> Path:
+    """ path given by the user, relative to the client's working directory when serving """
+    cwd = current_cwd.get()
+    return Path(cwd) / p if cwd else Path(p)
+
+def socket_path(cache_directory: Path) -> Path:
+    return cache_directory / SOCKET_FILE
+
+def is_running(path: Path) -> bool:
+    if not path.exists():
+        return False
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(str(path))
+        return True
+    except (ConnectionRefusedError, FileNotFoundError):
+        return False
+    finally:
+        s.close()
+
+async def start_server(path: Path, root_url: str, run_command: Callable[[list[str]], None],
+        check_options: Callable[[dict], Optional[str]] = lambda options: None) -> asyncio.AbstractServer:
+    """ run_command runs in an executor thread, it may block on wait_async
+        check_options: error message if the daemon can't run a request with these options
+    """
+    loop = asyncio.get_running_loop()
+    if is_running(path):
+        raise Exception(f"a daemon is already serving {path}")
+    path.unlink(missing_ok=True)
+
+    def run(argv: list[str]) -> int:
+        try:
+            run_command(argv)
+            return 0
+        except SystemExit as e:
+            # argparse errors, --help
+            return e.code if isinstance(e.code, int) else 1
+        except:
+            traceback.print_exc()
+            return 1
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            line = await reader.readline()
+            if not line:
+                # is_running probing
+                return
+            request = json.loads(line)
+            out = RequestOutput(loop, writer)
+            if request.get("root_url") != root_url:
+                out.send({"err": f"daemon serves {root_url}, not {request.get('root_url')}\n"})
+                out.send({"exit": 1})
+                return
+            options = request.get("options", {})
+            error = check_options(options)
+            if error != None:
+                out.send({"err": error + "\n"})
+                out.send({"exit": 2})
+                return
+            ctx = contextvars.copy_context()
+            ctx.run(current_output.set, out)
+            ctx.run(current_cwd.set, request.get("cwd"))
+            ctx.run(current_options.set, options)
+            code = await loop.run_in_executor(None, ctx.run, run, request["argv"])
+            out.send({"exit": code})
+        finally:
+            # after the queued call_soon_threadsafe writes
+            await asyncio.sleep(0)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+            writer.close()
+
+    server = await asyncio.start_unix_server(handle, path = str(path))
+    os.chmod(path, 0o600)
+    return server
+
+def run_in_daemon(path: Path, root_url: str, argv: list[str], options: dict = {}) -> Optional[int]:
+    """ exit code of the command run by the daemon, None if there is no daemon """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(str(path))
+    except (ConnectionRefusedError, FileNotFoundError):
+        s.close()
+        return None
+    with s, s.makefile("rwb") as f:
+        f.write((json.dumps({"argv": argv, "root_url": root_url, "cwd": os.getcwd(), "options": options}) + "\n").encode("utf-8"))
+        f.flush()
+        for line in f:
+            msg = json.loads(line)
+            if "out" in msg:
+                sys.stdout.write(msg["out"])
+                sys.stdout.flush()
+            elif "err" in msg:
+                sys.stderr.write(msg["err"])
+            elif "exit" in msg:
+                return msg["exit"]
+    raise Exception("daemon closed the connection without exit code")
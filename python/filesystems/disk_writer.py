@@ -0,0 +1,217 @@
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Optional
+from . import metrics
+
+"""
+disk writes of downloads and metadata in a writer thread pool instead of the event loop
+
+The loop serving FUSE requests and HTTP responses only hands chunks over:
+
+    async with disk_writer.shared.open(tmp, "wb", hasher) as f:
+        f.preallocate(size)
+        await f.write(chunk)   # waits only while more than max_buffered bytes are queued
+
+- the operations of one file run in order, those of different files in parallel
+- the hasher is updated in the writer thread too
+- preallocate: fallocate(FALLOC_FL_KEEP_SIZE) on Linux, reserves the blocks (less
+  fragmentation, no space fails at once) without changing the size, so the size of a
+  partial still is what was written (resume). Its reserved blocks stay until it is
+  resumed or removed
+- leaving the block waits for the queued writes, also on errors and cancellation,
+  then closes the file
+- fsync policy (--fsync):
+    never      leave it to the OS (default, as before)
+    downloads  fsync downloaded files before they are renamed into place
+    always     also metadata json, and the directories after the renames
+"""
+
+fsync_policies = ["never", "downloads", "always"]
+
+KiB = 1024
+MiB = 1024 * KiB
+
+FALLOC_FL_KEEP_SIZE = 1
+_fallocate = None
+
+def fallocate_keep_size(fd: int, size: int) -> bool:
+    """ False if not supported (not Linux, file system) """
+    global _fallocate
+    if _fallocate == None:
+        try:
+            f = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True).fallocate
+            f.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+            _fallocate = f
+        except (OSError, AttributeError):
+            _fallocate = False
+    if not _fallocate:
+        return False
+    if _fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+        e = ctypes.get_errno()
+        if e in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+            return False
+        raise OSError(e, os.strerror(e))
+    return True
+
+def get_xattr(path: Path, name: str) -> Optional[bytes]:
+    """ None if not set or not supported """
+    try:
+        return os.getxattr(path, name)
+    except (OSError, AttributeError):
+        return None
+
+def fsync_dir(path: Path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class DiskWriter:
+
+    def __init__(self, threads = 4, max_buffered = 128 * MiB, fsync = "never"):
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix = "disk-writer")
+        self.max_buffered = max_buffered
+        self.fsync = fsync
+        self.buffered = 0
+        self.changed: Optional[asyncio.Condition] = None
+
+    async def reserve(self, n: int):
+        """ waits until n more bytes may be queued, one chunk always fits """
+        if self.changed == None:
+            self.changed = asyncio.Condition()
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.buffered == 0 or self.buffered + n <= self.max_buffered)
+            self.buffered += n
+
+    async def release(self, n: int):
+        self.buffered -= n
+        if self.changed:
+            async with self.changed:
+                self.changed.notify_all()
+
+    async def run(self, f: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, f, *args)
+
+    def open(self, path: Path, mode: str, hasher = None) -> "FileWriter":
+        return FileWriter(self, path, mode, hasher)
+
+    async def replace_file(self, path: Path, text: str) -> int:
+        """ writes text to path.tmp and renames it, st_mtime_ns of the new file """
+        def write():
+            tmp = path.with_suffix(".tmp")
+            with tmp.open("w") as f:
+                f.write(text)
+                if self.fsync == "always":
+                    f.flush()
+                    os.fsync(f.fileno())
+            tmp.rename(path)
+            if self.fsync == "always":
+                fsync_dir(path.parent)
+            return path.stat().st_mtime_ns
+        return await self.run(write)
+
+    async def renamed(self, path: Path):
+        """ after renaming a download into place """
+        if self.fsync == "always":
+            await self.run(fsync_dir, path.parent)
+
+class FileWriter:
+    """ queued operations on one file, see module doc """
+
+    def __init__(self, w: DiskWriter, path: Path, mode: str, hasher):
+        self.w = w
+        self.path = path
+        self.mode = mode
+        self.hasher = hasher
+        self.f = None
+        self.tail: Optional[asyncio.Task] = None
+        self.error: Optional[BaseException] = None
+
+    def _then(self, f: Callable, *args, buffered = 0, always = False) -> asyncio.Task:
+        """ f(*args) in the pool after the operations queued before, never raises:
+            the first error is kept and raised by write / flush, later operations are skipped
+        """
+        prev = self.tail
+        async def run():
+            try:
+                if prev != None:
+                    await asyncio.wait([prev])
+                if self.error == None or always:
+                    await self.w.run(f, *args)
+            except BaseException as e:
+                if self.error == None:
+                    self.error = e
+            finally:
+                if buffered:
+                    await self.w.release(buffered)
+        self.tail = asyncio.get_running_loop().create_task(run())
+        return self.tail
+
+    async def __aenter__(self) -> "FileWriter":
+        self.f = await self.w.run(open, self.path, self.mode)
+        return self
+
+    async def __aexit__(self, type, e, tb):
+        # the queued writes finish before the file is closed, on errors and cancellation
+        # too: the partial stays consistent for resuming
+        if type == None and self.w.fsync != "never":
+            self._then(self._fsync)
+        closed = self._then(self.f.close, always = True)
+        await asyncio.shield(closed)
+        if type == None and self.error != None:
+            raise self.error
+
+    def _fsync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def preallocate(self, size: int):
+        def allocate():
+            self.f.flush()
+            fallocate_keep_size(self.f.fileno(), size)
+        self._then(allocate)
+
+    def truncate(self, size: int):
+        def truncate():
+            self.f.flush()
+            self.f.truncate(size)
+        self._then(truncate)
+
+    def set_xattr(self, name: str, value: bytes):
+        """ after the operations queued before, ignored where not supported (see get_xattr) """
+        def set():
+            try:
+                os.setxattr(self.f.fileno(), name, value)
+            except (OSError, AttributeError):
+                pass
+        self._then(set)
+
+    async def write(self, chunk: bytes):
+        if self.error != None:
+            raise self.error
+        await self.w.reserve(len(chunk))
+        def write():
+            with metrics.timed("disk.write"):
+                self.f.write(chunk)
+            if self.hasher:
+                self.hasher.update(chunk)
+        self._then(write, buffered = len(chunk))
+
+    async def flush(self):
+        if self.tail != None:
+            await asyncio.wait([self.tail])
+        if self.error != None:
+            raise self.error
+
+shared = DiskWriter()
+
+def configure(fsync: str):
+    shared.fsync = fsync
+
+metrics.value("disk_write_buffered_bytes", "gauge", lambda: shared.buffered)
@@ -0,0 +1,355 @@
+import asyncio
+import fcntl
+import json
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from time import time, time_ns
+from typing import Callable, Iterable, Iterator, Optional
+from .ash2txtorg_cached import METADATA_FILE, PARTIAL_VALIDATOR
+from .later import later_instance
+from .verify import scan_tree
+from .leases import LEASE_SUFFIX
+from . import log
+from . import disk_writer
+from .disk_writer import get_xattr
+
+"""
+keep the cache directory below a byte quota by removing downloaded file contents
+
+- never removes metadata (.directory_contents_cached_v2.json, zarr .zarray/.zattrs/.zgroup)
+- never removes files below pinned paths (prefetch pins its roots, see pin/unpin commands)
+- *.tmp files (interrupted downloads) being downloaded by this or (lease, modified within
+  recent_partial) another process stay.
+  Resumable partials (with the If-Range validator xattr) are evicted like other files, at
+  their current size. Those which can't be resumed go first when above the quota. Partials
+  older than max_partial_age go in any case
+- then by policy:
+    lru:  least recently accessed first
+    size: largest * longest unused first, so one big old file goes before many small hot ones
+  access times come from FUSE opens/reads (AccessLog), files never accessed use their mtime
+
+Eviction removes down to low_watermark * quota so it doesn't run again after each download.
+"""
+
+ACCESS_FILE = ".access_times_v1.json"
+PINNED_FILE = ".pinned_v1.json"
+GENERATION_FILE = ".cache_generation_v2.json"
+protected_names = {METADATA_FILE, ACCESS_FILE, PINNED_FILE, GENERATION_FILE, ".zarray", ".zattrs", ".zgroup"}
+eviction_policies = ["lru", "size"]
+low_watermark = 0.9
+default_max_partial_age = 7 * 24 * 3600.0
+# seconds, a .tmp modified more recently is taken to be being downloaded
+recent_partial = 60.0
+
+class JsonState:
+    """ small json file in the cache root, saved by later_instance when changed
+
+    Mounts and commands of other processes change it too: saving (in the disk writer pool)
+    rereads the file and applies the changes of this process since the last save (apply),
+    under a lock so that concurrent saves don't drop each other's changes.
+    """
+
+    def __init__(self, path: Path, default: Callable[[], object]):
+        self.path = path
+        self.default = default
+        self.data = self.load()
+        self.changes = self.new_changes()
+        self.dirty = False
+        # changes with data, also when saving replaced it
+        self.version = 0
+
+    def load(self):
+        return json.loads(self.path.read_text()) if self.path.exists() else self.default()
+
+    def new_changes(self):
+        raise NotImplementedError()
+
+    def apply(self, data, changes):
+        """ changes onto data read from the file """
+        raise NotImplementedError()
+
+    def changed(self):
+        self.version += 1
+        self.dirty = True
+        later_instance.once(self, ticks = 5)
+
+    async def save(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        changes, self.changes = self.changes, self.new_changes()
+        def write():
+            with open(self.path.with_name(f"{self.path.name}.lock"), "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                data = self.load()
+                self.apply(data, changes)
+                tmp = self.path.with_name(f"{self.path.name}.tmp")
+                tmp.write_text(json.dumps(data))
+                tmp.rename(self.path)
+                return data
+        data = await disk_writer.shared.run(write)
+        # changed while writing
+        self.apply(data, self.changes)
+        self.data = data
+        self.version += 1
+
+    async def do_later_async(self):
+        await self.save()
+
+class AccessLog(JsonState):
+    """ relative cache path -> last access time """
+
+    def __init__(self, cache_directory: Path):
+        super().__init__(cache_directory / ACCESS_FILE, dict)
+
+    def new_changes(self):
+        # touched: rel -> time, forgotten
+        return {}, set()
+
+    def apply(self, data: dict, changes):
+        touched, forgotten = changes
+        for rel in forgotten:
+            data.pop(rel, None)
+        for rel, t in touched.items():
+            data[rel] = max(t, data.get(rel, 0))
+
+    def touch(self, rel: str):
+        t = time()
+        self.data[rel] = t
+        self.changes[0][rel] = t
+        self.changes[1].discard(rel)
+        self.changed()
+
+    def forget(self, rels: Iterable[str]):
+        for rel in rels:
+            self.data.pop(rel, None)
+            self.changes[0].pop(rel, None)
+            self.changes[1].add(rel)
+        self.changed()
+
+class Pins(JsonState):
+    """ relative paths of folders whose subtrees and of files which are never evicted.
+        prefetch commands with a selection (include, budget, slice range, roi) pin the
+        files they planned, not their roots
+    """
+
+    def __init__(self, cache_directory: Path):
+        super().__init__(cache_directory / PINNED_FILE, list)
+
+    def new_changes(self):
+        # rel -> pinned
+        return {}
+
+    def apply(self, data: list, changes: dict):
+        present = set(data)
+        for rel, pinned in changes.items():
+            if pinned and not rel in present:
+                data.append(rel)
+                present.add(rel)
+            elif not pinned and rel in present:
+                data.remove(rel)
+                present.discard(rel)
+
+    def pin(self, rel: str):
+        self.pin_many([rel])
+
+    def pin_many(self, rels: Iterable[str]):
+        present = set(self.data)
+        for rel in rels:
+            if not rel in present:
+                self.data.append(rel)
+                present.add(rel)
+                self.changes[rel] = True
+                self.changed()
+
+    def unpin(self, rel: str):
+        if rel in self.data:
+            self.data.remove(rel)
+            self.changes[rel] = False
+            self.changed()
+
+    def pinned(self, rel: str) -> bool:
+        # called per cached file when evicting, there can be many file pins
+        if getattr(self, "_present", (None, None))[0] != self.version:
+            self._present = (self.version, set(self.data))
+        present = self._present[1]
+        return rel in present or any(f in present for f in folders_above(rel))
+
+def folders_above(rel: str) -> Iterator[str]:
+    """ "a/b/c" -> "a/b", "a", "" """
+    while rel:
+        rel = rel.rpartition("/")[0]
+        yield rel
+
+class Generation:
+    """ when files were removed from or added to the cache directory without the folders
+        knowing (eviction, verify --repair, prefetch-zarr-roi), which makes the cached bytes
+        counted in the rollups of the folders above stale. Per folder the time (ns) the cached
+        files below it last changed like that, so only the rollups on the paths from the
+        changed files up to the root are recounted:
+
+            changed:  folder -> time, set for all folders above a changed file
+            subtree:  folder -> time, everything below it (--recount)
+
+        Saved at once, other processes check the mtime.
+    """
+
+    def __init__(self, cache_directory: Path):
+        self.path = cache_directory / GENERATION_FILE
+        self.mtime = None
+        self.data = {"changed": {}, "subtree": {}}
+        self.last = 0
+
+    def load(self) -> dict:
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            if self.mtime == None:
+                self.mtime = 0
+                v1 = self.path.with_name(".cache_generation_v1.json")
+                if v1.exists():
+                    # one generation for the whole cache: rollups taken before it are stale
+                    self.data["subtree"][""] = json.loads(v1.read_text())
+            return self.data
+        if mtime != self.mtime:
+            self.mtime = mtime
+            self.data = json.loads(self.path.read_text())
+        return self.data
+
+    def changed_at(self, rel: str) -> int:
+        """ last change below folder rel, rollups taken before are stale """
+        d = self.load()
+        t = d["changed"].get(rel, 0)
+        for f in [rel, *folders_above(rel)]:
+            t = max(t, d["subtree"].get(f, 0))
+        return t
+
+    def bump(self, rels: Iterable[str]):
+        """ files rels were added or removed """
+        self._update(lambda d, now: d["changed"].update((f, now) for rel in rels for f in folders_above(rel)))
+
+    def bump_subtree(self, rel: str):
+        """ anything below folder rel may have changed """
+        def change(d: dict, now: int):
+            d["subtree"][rel] = now
+            d["changed"].update((f, now) for f in folders_above(rel))
+        self._update(change)
+
+    def _update(self, change: Callable[[dict, int], None]):
+        with open(self.path.with_name(f"{self.path.name}.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            d = self.load()
+            # newer than the rollups taken so far, also if the clock went back
+            now = max(time_ns(), self.last + 1)
+            self.last = now
+            change(d, now)
+            tmp = self.path.with_name(f"{self.path.name}.tmp")
+            tmp.write_text(json.dumps(d))
+            tmp.rename(self.path)
+
+@dataclass
+class CachedFile:
+    rel: str
+    size: int
+    last_access: float
+    mtime: float = 0.0
+    # .tmp with PARTIAL_VALIDATOR
+    resumable: bool = False
+
+def scan_cache(cache_directory: Path, access: AccessLog, threads = 16) -> list[CachedFile]:
+    files = []
+    for d in scan_tree(cache_directory, threads):
+        p = f"{d.rel}/" if d.rel else ""
+        for name, (size, mtime) in d.files.items():
+            # state of this tool in the root (.pinned, .name_index sqlite and its -wal ..)
+            if name in protected_names or LEASE_SUFFIX in name or (p == "" and name.startswith(".")):
+                continue
+            # download of another process
+            if name.endswith(".tmp") and f"{name[:-len('.tmp')]}{LEASE_SUFFIX}" in d.files:
+                continue
+            rel = f"{p}{name}"
+            resumable = name.endswith(".tmp") and get_xattr(cache_directory / rel, PARTIAL_VALIDATOR) != None
+            files.append(CachedFile(rel, size, access.data.get(rel, mtime / 1e9), mtime / 1e9, resumable))
+    return files
+
+def plan_eviction(files: list[CachedFile], quota: int, pins: Pins, policy = "lru", in_flight: Optional[set[str]] = None, now: Optional[float] = None,
+        max_partial_age: float = default_max_partial_age) -> list[CachedFile]:
+    """ files to remove to get below low_watermark * quota, and partials older than max_partial_age seconds """
+    in_flight = in_flight if in_flight != None else set()
+    now = now if now != None else time()
+    usage = sum(f.size for f in files)
+    target = quota * low_watermark
+    # written to right now by a process without lease (the Go version) or before it took one
+    writing = {f.rel for f in files if f.rel.endswith(".tmp") and now - f.mtime < recent_partial}
+    in_flight = in_flight | writing
+    partials = [f for f in files if f.rel.endswith(".tmp") and not f.rel in in_flight]
+    evict = [f for f in partials if now - f.mtime > max_partial_age]
+    usage -= sum(f.size for f in evict)
+    if usage <= quota:
+        return evict
+    # can't be resumed, they only take space
+    evict += [f for f in partials if not f.resumable and now - f.mtime <= max_partial_age]
+    usage = sum(f.size for f in files) - sum(f.size for f in evict)
+    gone = {f.rel for f in evict}
+    candidates = [f for f in files if not f.rel in gone and not f.rel in in_flight and not pins.pinned(f.rel)]
+    if policy == "lru":
+        candidates.sort(key = lambda f: f.last_access)
+    elif policy == "size":
+        candidates.sort(key = lambda f: -f.size * max(1.0, now - f.last_access))
+    else:
+        raise Exception(f"bad eviction policy {policy}, use one of {eviction_policies}")
+    for f in candidates:
+        if usage <= target:
+            break
+        evict.append(f)
+        usage -= f.size
+    return evict
+
+def remove(cache_directory: Path, evict: list[CachedFile]) -> int:
+    freed = 0
+    for f in evict:
+        try:
+            (cache_directory / f.rel).unlink()
+            freed += f.size
+        except FileNotFoundError:
+            pass
+    return freed
+
+class Quota:
+    """ tracks cache usage while running (initial scan + downloads) and evicts when above quota """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, cache_directory: Path, quota: int, policy: str, access: AccessLog, pins: Pins, in_flight: Callable[[], set[str]], generation: Generation,
+            max_partial_age: float = default_max_partial_age):
+        self.loop = loop
+        self.cache_directory = cache_directory
+        self.quota = quota
+        self.policy = policy
+        self.access = access
+        self.pins = pins
+        self.in_flight = in_flight
+        self.generation = generation
+        self.max_partial_age = max_partial_age
+        self.usage: Optional[int] = None # unknown until the first scan finished
+        self.running: Optional[asyncio.Task] = None
+
+    def added(self, size: int):
+        if self.usage != None:
+            self.usage += size
+            if self.usage > self.quota:
+                self.evict_soon()
+
+    def evict_soon(self):
+        if self.running == None or self.running.done():
+            self.running = self.loop.create_task(self.evict())
+
+    async def evict(self):
+        files = await self.loop.run_in_executor(None, scan_cache, self.cache_directory, self.access)
+        evict = plan_eviction(files, self.quota, self.pins, self.policy, self.in_flight(), max_partial_age = self.max_partial_age)
+        freed = await self.loop.run_in_executor(None, remove, self.cache_directory, evict)
+        self.access.forget(f.rel for f in evict)
+        if evict:
+            self.generation.bump(f.rel for f in evict)
+        self.usage = sum(f.size for f in files) - freed
+        if evict:
+            log.info(f"evicted {len(evict)} files {freed / 1024 / 1024:.2f} MiB, cache now {self.usage / 1024 / 1024:.2f} MiB")
@@ -1,11 +1,15 @@
 from collections import defaultdict
 import errno
 import stat
-from fuse import FUSE, FuseOSError, Operations
+from fuse import FUSE, FuseOSError, Operations, fuse_get_context
 import threading
 import asyncio
 from . import types as t
 from . import walking
+from . import log
+from . import metrics
+from . import block_cache
+from . import ash2txtorg_cached as ac
 
 # this works
 # see ./fuse-passthrough.py
@@ -24,8 +28,18 @@ class FS(Operations):
     def _run_async(self, coro):
         return asyncio.run(coro)
 
+    def _while_requester_alive(self, f, *args):
+        """ f(*args) on the loop, EINTR once the process of this request is gone, then the
+            download it started is cancelled unless someone else waits for it
+        """
+        token = ac.requester_alive.set(ac.process_alive(fuse_get_context()[2]))
+        try:
+            return self.wait_async(ac.while_requester_alive)(f(*args))
+        finally:
+            ac.requester_alive.reset(token)
+
     def getattr(self, path, fh=None):
-        folder, fname = self.wait_async(walking.walk_path)(self.folder, t.MyPath(path))
+        folder, fname = walking.walk_path_sync(self.folder, t.MyPath(path), self.wait_async)
 
         if folder == None:
             # print(f"path {path} not found")
@@ -34,8 +48,8 @@ class FS(Operations):
         st = dict()
         if fname != None:
             st['st_mode'] = stat.S_IFREG | 0o444
-            st['st_size'] = self.wait_async(folder.file_size_bytes_exact)(fname)
-            print(f"got size {st['st_size']}")
+            st['st_size'] = walking.file_size_bytes_exact_sync(folder, fname, self.wait_async)
+            log.debug(f"got size {st['st_size']}")
             # print(f"file size: {st['st_size']}")
         else:
             # print(f"path is  dir {path} ")
@@ -49,13 +63,10 @@ class FS(Operations):
     def readdir(self, path, fh):
         # print(f"readdir {path}")
 
-        async def fof(path: t.MyPath):
-            folder = await walking.walk_path_find_folder(self.folder, path)
-            if folder == None:
-                raise FuseOSError(errno.ENOENT) # should never happen
-            return await folder.folders_and_files()
-
-        folders, files = self.wait_async(fof)(t.MyPath(path))
+        faf = walking.folders_and_files_sync(self.folder, t.MyPath(path), self.wait_async)
+        if faf == None:
+            raise FuseOSError(errno.ENOENT) # should never happen
+        folders, files = faf
         # if not isinstance(thing, t.Folder):
         #     # print("thing = None 1")
         #     raise FuseOSError(errno.ENOENT) # should never happen
@@ -63,15 +74,13 @@ class FS(Operations):
         return n
 
     def read(self, path, size, offset, fh):
-        print(f"read {path}")
+        log.debug(f"read {path}")
         folder, fname = self.wait_async(walking.walk_path)(self.folder, t.MyPath(path))
         assert fname != None
 
         # return self.wait_async(thing.bytes)(offset, size)
-        cache_path = self.wait_async(folder.file_cache_path)(fname)
-        with open(cache_path, "rb") as f:
-            f.seek(offset)
-            return f.read(size)
+        cache_path = self._while_requester_alive(walking.file_cache_path_used, folder, fname)
+        return block_cache.shared.read_path(cache_path, offset, size)
 
         raise FuseOSError(errno.ENOENT)
 
@@ -82,6 +91,8 @@ class FS(Operations):
         pass
         # self.client.close(#)
 
+metrics.instrument_operations(FS, "fuse")
+
 def mount(folder: t.Folder, mountpoint: str, wait_async):
     fuse = FUSE( FS( folder, wait_async),
                 mountpoint = mountpoint,
@@ -30,6 +30,10 @@ from collections import defaultdict
 # Assuming these are your custom modules
 from . import types as t
 from . import walking
+from . import log
+from . import metrics
+from . import block_cache
+from .ash2txtorg_cached import OfflineMiss, requester_alive, process_alive, while_requester_alive
 
 # Set up logging
 logging.basicConfig(
@@ -123,7 +127,7 @@ class FS(pyfuse3.Operations):
             attr.attr_timeout  = 5*60.0
 
     async def getattr(self, inode: InodeT, ctx=None):
-        print(f"getattr inode={inode}")
+        log.debug(f"getattr inode={inode}")
         # should be ok - todo test
         # path = fsdecode(inode) 
         if inode == pyfuse3.ROOT_INODE :
@@ -137,7 +141,10 @@ class FS(pyfuse3.Operations):
             raise FUSEError(errno.ENOENT)
         entry = pyfuse3.EntryAttributes()
         # print("_types_from_thing")
-        await self._types_from_thing(entry, (folder, name), inode)
+        try:
+            await self._types_from_thing(entry, (folder, name), inode)
+        except OfflineMiss:
+            raise FUSEError(errno.ENOENT)
         # print("returning entry")
         return entry
 
@@ -148,7 +155,7 @@ class FS(pyfuse3.Operations):
         ctx: "RequestContext"
     ) -> "EntryAttributes":
         try:
-            print(f"lookup {fsdecode(name)}")
+            log.debug(f"lookup {fsdecode(name)}")
             # should be ok - todo test
             parent_path = self.inode_to_path(parent_inode)
             path = join(parent_path, fsdecode(name))
@@ -158,6 +165,8 @@ class FS(pyfuse3.Operations):
             attr = pyfuse3.EntryAttributes()
             await self._types_from_thing(attr, thing, inode)
             return attr
+        except OfflineMiss:
+            raise FUSEError(errno.ENOENT)
         except:
             traceback.print_exc()
             raise
@@ -168,7 +177,7 @@ class FS(pyfuse3.Operations):
         ctx: "RequestContext"
     ) -> FileHandleT:
         try:
-            print(f"opendir inode={inode}")
+            log.debug(f"opendir inode={inode}")
             folder_path = self.inode_to_path(inode)
             folder = await walking.walk_path_find_folder(self.folder, t.MyPath(folder_path))
             if folder == None:
@@ -191,6 +200,8 @@ class FS(pyfuse3.Operations):
                     ]))
             ]
             return FileHandleT(self.open_directories.next((folder_path, folder, all_entries, (folders, files))))
+        except OfflineMiss:
+            raise FUSEError(errno.ENOENT)
         except:
             traceback.print_exc()
             raise
@@ -228,7 +239,7 @@ class FS(pyfuse3.Operations):
         fh: FileHandleT
     ) -> None:
         try:
-            print("releasedir")
+            log.debug("releasedir")
             # should be ok - todo test
             del self.open_directories[fh]
         except:
@@ -261,7 +272,7 @@ class FS(pyfuse3.Operations):
 
     async def open(self, inode, flags, ctx):
         try:
-            print(f"open inode={inode}")
+            log.debug(f"open inode={inode}")
             if flags & (os.O_WRONLY | os.O_RDWR):
                 raise FUSEError(errno.EACCES)
 
@@ -271,22 +282,31 @@ class FS(pyfuse3.Operations):
             if name == None:
                 raise FUSEError(errno.ENOSYS)
 
-            path = await folder.file_cache_path(name)
+            # EINTR once the process opening is gone, then the download it started is cancelled
+            # unless someone else waits for it
+            token = requester_alive.set(process_alive(ctx.pid))
+            try:
+                path = await while_requester_alive(walking.file_cache_path_used(folder, name))
+            finally:
+                requester_alive.reset(token)
 
             fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
             return pyfuse3.FileInfo(fh=FileHandleT(fd))
+        except OfflineMiss:
+            raise FUSEError(errno.ENOENT)
+        except InterruptedError:
+            raise FUSEError(errno.EINTR)
         except:
             traceback.print_exc()
             raise
 
     async def read(self, fh, off, size):
         try:
-            print(f"read {fh} {off} {size}")
-            os.lseek(fh, off, os.SEEK_SET)
-            data = os.read(fh, size)
+            log.debug(f"read {fh} {off} {size}")
+            data = block_cache.shared.read_fd(fh, off, size)
             self.read_count += 1
             path = self.handles.get(fh, "unknown")
-            logging.info(f"read called - path: /{path}, size: {size}, offset: {off}, fd: {fh}, total reads: {self.read_count}")
+            logging.debug(f"read called - path: /{path}, size: {size}, offset: {off}, fd: {fh}, total reads: {self.read_count}")
             return data
         except:
             traceback.print_exc()
@@ -319,6 +339,8 @@ class FS(pyfuse3.Operations):
     async def listxattr(self, inode, ctx):
         return []
 
+metrics.instrument_operations(FS, "fuse")
+
 def init_logging(debug=False):
     formatter = logging.Formatter('%(asctime)s.%(msecs)03d %(threadName)s: [%(name)s] %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
     handler = logging.StreamHandler()
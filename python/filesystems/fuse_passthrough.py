@@ -2,11 +2,15 @@ from collections import defaultdict
 import os
 import errno
 import stat
-from fuse import FUSE, FuseOSError, Operations
+from fuse import FUSE, FuseOSError, Operations, fuse_get_context
 import threading
 import asyncio
 from . import types as t
 from . import walking
+from . import log
+from . import metrics
+from . import block_cache
+from . import ash2txtorg_cached as ac
 
 # like fuse but returns file handles
 # TODO mmap
@@ -26,8 +30,8 @@ class FS(Operations):
         return asyncio.run(coro)
 
     def getattr(self, path, fh=None):
-        print(f"getattr {path}")
-        folder, fname = self.wait_async(walking.walk_path)(self.folder, path.lstrip('/'))
+        log.debug(f"getattr {path}")
+        folder, fname = walking.walk_path_sync(self.folder, t.MyPath(path), self.wait_async)
 
         if folder == None:
             # print(f"path {path} not found")
@@ -36,7 +40,7 @@ class FS(Operations):
         st = dict()
         if fname != None:
             st['st_mode'] = stat.S_IFREG | 0o444
-            st['st_size'] = self.wait_async(folder.fel_size_bytes_exact)(fname)
+            st['st_size'] = walking.file_size_bytes_exact_sync(folder, fname, self.wait_async)
             # print(f"file size: {st['st_size']}")
         else:
             # print(f"path is  dir {path} ")
@@ -48,15 +52,12 @@ class FS(Operations):
         return st
 
     def readdir(self, path, fh):
-        print(f"readdir {path}")
+        log.debug(f"readdir {path}")
 
-        async def fof(path):
-            folder = await walking.walk_path_find_folder(self.folder, path.lstrip('/'))
-            if folder == None:
-                raise FuseOSError(errno.ENOENT)
-            return await folder.folders_and_files()
-
-        folders, files = self.wait_async(fof)(path)
+        faf = walking.folders_and_files_sync(self.folder, t.MyPath(path), self.wait_async)
+        if faf == None:
+            raise FuseOSError(errno.ENOENT)
+        folders, files = faf
         # if not isinstance(thing, t.Folder):
         #     # print("thing = None 1")
         #     raise FuseOSError(errno.ENOENT) # should never happen
@@ -64,17 +65,23 @@ class FS(Operations):
         return n
 
     def open(self, path, flags):
-        print(f"open {path}")
+        log.debug(f"open {path}")
 
         async def cached_file_path() -> str:
             folder, fname = await walking.walk_path(self.folder, path)
             if fname != None:
                 # return self.wait_async(thing.bytes)(offset, size)
-                return await folder.file_cache_path(fname)
+                return await walking.file_cache_path_used(folder, fname)
                 return cache_path
             raise FuseOSError(errno.ENOENT)
 
-        cp = self.wait_async(cached_file_path)()
+        # EINTR once the process opening is gone, then the download it started is cancelled
+        # unless someone else waits for it
+        token = ac.requester_alive.set(ac.process_alive(fuse_get_context()[2]))
+        try:
+            cp = self.wait_async(ac.while_requester_alive)(cached_file_path())
+        finally:
+            ac.requester_alive.reset(token)
         fh = os.open(cp, os.O_RDONLY)
         if raw_fi:
             flags.fh = fh
@@ -82,16 +89,13 @@ class FS(Operations):
             return fh
 
     def read(self, path, size, offset, fh):
-        print(f"read {[path, size, offset]}")
+        log.debug(f"read {[path, size, offset]}")
         if raw_fi:
-            print(f"read raw_fi=True   {fh.fh}")
             f = fh.fh
         else:
-            print(f"read raw_fi+False  {fh}")
             f = fh
         # todo if we have handle we should be able to use os.read
-        os.lseek(f, offset, os.SEEK_SET)
-        return os.read(f, size)
+        return block_cache.shared.read_fd(f, offset, size)
 
         thing = self.wait_async(walking.walk_path)(self.folder, path)
         if (isinstance(thing, t.File)):
@@ -105,7 +109,7 @@ class FS(Operations):
 
 
     def flush(self, path, fip):
-        print(f"flush {path}")
+        log.debug(f"flush {path}")
         if raw_fi:
             fh = fip.fh
         else:
@@ -113,7 +117,7 @@ class FS(Operations):
         os.close(fh)
 
     def release(self, path, fip):
-        print(f"release {path}")
+        log.debug(f"release {path}")
         if raw_fi:
           fh = fip.fh
         else:
@@ -127,6 +131,8 @@ class FS(Operations):
         pass
         # self.client.close(#)
 
+metrics.instrument_operations(FS, "fuse")
+
 def mount(folder: t.Folder, mountpoint: str, wait_async):
     fuse = FUSE( FS( folder, wait_async),
                 mountpoint = mountpoint,
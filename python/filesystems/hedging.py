@@ -0,0 +1,126 @@
+import asyncio
+from collections import deque
+from time import perf_counter
+from typing import Awaitable, Callable, Optional, TypeVar
+from . import log
+from . import metrics
+
+"""
+hedged requests for small idempotent requests (listings, HEAD), see --hedge
+
+Some requests to the server hang for tens of seconds while the same request sent
+again answers in milliseconds. A request still running after the percentile
+(eg 0.95) of the recent latencies of its kind is sent once more, the first response
+wins and the other one is cancelled.
+
+- the threshold comes from the last window successful attempts, no hedging before
+  min_samples of them, never below min_delay
+- budget: each request earns budget hedges (0.05: at most ~5% more requests), up to
+  burst, so a server slow for everyone doesn't get twice the load
+- the hedge runs in the slot (fetch limiter) of the request it duplicates
+- timeout: per attempt, a hedge still running when the first attempt times out
+  can still win
+
+Downloads aren't hedged, they are large and written to a file while streaming.
+"""
+
+T = TypeVar("T")
+
+class Hedger:
+
+    def __init__(self, percentile: Optional[float] = None, budget: float = 0.05, timeout: Optional[float] = None,
+            window = 1000, min_samples = 20, min_delay = 0.05, burst = 10.0):
+        self.percentile = percentile
+        self.budget = budget
+        self.timeout = timeout
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.burst = burst
+        self.window = window
+        self.latencies: dict[str, deque[float]] = {}
+        # recomputed every 32 samples, sorting the window per request is wasted
+        self.thresholds: dict[str, tuple[int, Optional[float]]] = {}
+        self.tokens = 0.0
+        self.requests = 0
+        self.hedges = 0
+        self.hedges_won = 0
+        self.timeouts = 0
+
+    def observe(self, kind: str, seconds: float):
+        d = self.latencies.get(kind)
+        if d == None:
+            d = self.latencies[kind] = deque(maxlen = self.window)
+        d.append(seconds)
+
+    def threshold(self, kind: str) -> Optional[float]:
+        """ seconds after which a request of kind gets a hedge, None: not (yet) """
+        if self.percentile == None:
+            return None
+        d = self.latencies.get(kind)
+        if d == None or len(d) < self.min_samples:
+            return None
+        seen, t = self.thresholds.get(kind, (0, None))
+        if t == None or len(d) - seen >= 32 or len(d) < seen:
+            s = sorted(d)
+            t = max(self.min_delay, s[min(len(s) - 1, int(self.percentile * len(s)))])
+            self.thresholds[kind] = (len(d), t)
+        return t
+
+    def take_token(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    async def attempt(self, kind: str, request: Callable[[], Awaitable[T]]) -> T:
+        started = perf_counter()
+        try:
+            r = await asyncio.wait_for(request(), self.timeout) if self.timeout else await request()
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        self.observe(kind, perf_counter() - started)
+        return r
+
+    async def run(self, kind: str, request: Callable[[], Awaitable[T]]) -> T:
+        """ request() once, and once more if it is slow (see module doc) """
+        self.requests += 1
+        self.tokens = min(self.burst, self.tokens + self.budget)
+        delay = self.threshold(kind)
+        if delay == None:
+            return await self.attempt(kind, request)
+        first = asyncio.ensure_future(self.attempt(kind, request))
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout = delay)
+            if not done and self.take_token():
+                self.hedges += 1
+                log.debug(f"hedging {kind} after {delay:.3f}s")
+                tasks.append(asyncio.ensure_future(self.attempt(kind, request)))
+            pending = set(tasks)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when = asyncio.FIRST_COMPLETED)
+                for x in done:
+                    if x.exception() == None:
+                        if x is not first:
+                            self.hedges_won += 1
+                        return x.result()
+                if not pending:
+                    # both failed, the error of the first attempt
+                    return first.result()
+        finally:
+            for x in tasks:
+                if not x.done():
+                    x.cancel()
+
+shared = Hedger()
+
+def configure(percentile: Optional[float], budget: float, timeout: Optional[float]):
+    shared.percentile = percentile
+    shared.budget = budget
+    shared.timeout = timeout
+
+metrics.value("hedge_requests", "counter", lambda: shared.requests)
+metrics.value("hedge_sent", "counter", lambda: shared.hedges)
+metrics.value("hedge_won", "counter", lambda: shared.hedges_won)
+metrics.value("request_timeouts", "counter", lambda: shared.timeouts)
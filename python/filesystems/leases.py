@@ -0,0 +1,139 @@
+import asyncio
+import json
+import os
+import socket
+from pathlib import Path
+from time import time
+from typing import Optional
+from . import tracing
+
+"""
+cross process leases in the cache directory
+
+LimitByKey only de-duplicates downloads within one process. If the Python tool runs
+several times (mount + prefetch) each process takes a lease file <target>.lease
+(O_CREAT|O_EXCL) before downloading or writing metadata. Others wait until the lease
+is gone and then use the result instead of downloading again.
+
+The holder touches the lease every heartbeat seconds. A lease is stale if its process
+is gone (same host) or it wasn't touched for stale_after seconds (crash, other host),
+then it is taken over: renamed away, and put back if it turns out to be another lease
+than the one seen stale (a process taking it over first).
+
+The Go version doesn't know about leases.
+"""
+
+LEASE_SUFFIX = ".lease"
+heartbeat = 10.0
+stale_after = 60.0
+hostname = socket.gethostname()
+
+def lease_path(target: Path) -> Path:
+    return target.with_name(f"{target.name}{LEASE_SUFFIX}")
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def read_lease(path: Path) -> Optional[tuple[str, int]]:
+    """ contents and st_mtime_ns, None if there is none """
+    try:
+        st = path.stat()
+        return path.read_text(), st.st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def stale(lease: tuple[str, int]) -> bool:
+    text, mtime_ns = lease
+    age = time() - mtime_ns / 1e9
+    try:
+        info = json.loads(text)
+    except ValueError:
+        # being written right now or garbage, only the age tells
+        return age > stale_after
+    if info.get("host") == hostname and not pid_alive(info.get("pid", -1)):
+        return True
+    return age > stale_after
+
+def is_stale(path: Path) -> bool:
+    lease = read_lease(path)
+    return lease != None and stale(lease)
+
+class Lease:
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._heartbeat: Optional[asyncio.Task] = None
+
+    def keep_alive(self):
+        """ touch the lease regularly while the loop runs, until released """
+        async def beat():
+            while True:
+                await asyncio.sleep(heartbeat)
+                try:
+                    os.utime(self.path)
+                except FileNotFoundError:
+                    return
+        self._heartbeat = asyncio.get_running_loop().create_task(beat())
+
+    def release(self):
+        if self._heartbeat:
+            self._heartbeat.cancel()
+        self.path.unlink(missing_ok=True)
+
+def try_acquire(target: Path) -> Optional[Lease]:
+    """ Lease or None if another live process holds it. Stale leases are taken over. """
+    path = lease_path(target)
+    for _ in range(2):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            seen = read_lease(path)
+            if seen == None:
+                continue
+            if not stale(seen):
+                return None
+            # rename first so that only one of the processes seeing it stale removes it
+            taken = path.with_name(f"{path.name}.stale.{os.getpid()}")
+            try:
+                path.rename(taken)
+            except FileNotFoundError:
+                continue
+            if read_lease(taken) != seen:
+                # another process took the stale one over meanwhile and this is its new
+                # lease: put it back (unless there is yet another one) and let it download
+                try:
+                    os.link(taken, path)
+                except FileExistsError:
+                    pass
+                taken.unlink(missing_ok=True)
+                return None
+            taken.unlink(missing_ok=True)
+            continue
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps({"pid": os.getpid(), "host": hostname, "started": time()}))
+        return Lease(path)
+    return None
+
+async def wait_released(target: Path, poll_max = 2.0):
+    """ returns when nobody holds a (non stale) lease on target anymore """
+    path = lease_path(target)
+    poll = 0.05
+    with tracing.span("lease.wait", path = str(target)):
+        while path.exists() and not is_stale(path):
+            await asyncio.sleep(poll)
+            poll = min(poll * 2, poll_max)
+
+async def acquire(target: Path) -> Lease:
+    """ waits until the lease is ours """
+    while True:
+        lease = try_acquire(target)
+        if lease:
+            lease.keep_alive()
+            return lease
+        await wait_released(target)
@@ -0,0 +1,27 @@
+"""
+verbosity for per file / per request output
+
+0: summaries and progress only (default)
+1: + per folder output and periodic fetching state
+2: + per file and per request output
+
+A daemon request runs with the -v of its client (request_verbosity), see daemon.py
+"""
+
+from contextvars import ContextVar
+from typing import Optional
+
+verbosity = 0
+request_verbosity: ContextVar[Optional[int]] = ContextVar("request_verbosity", default=None)
+
+def level() -> int:
+    v = request_verbosity.get()
+    return verbosity if v == None else v
+
+def info(msg: str):
+    if level() >= 1:
+        print(msg)
+
+def debug(msg: str):
+    if level() >= 2:
+        print(msg)
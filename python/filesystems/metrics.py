@@ -0,0 +1,212 @@
+import functools
+import inspect
+import os
+import sys
+import threading
+import traceback
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Callable, Optional
+from . import tracing
+
+"""
+per operation latency histograms, cheap enough for the FUSE hot path
+
+    with metrics.timed("net.listing"): ...
+    @metrics.instrumented("fuse.getattr") / instrument_operations(FS, "fuse")
+
+Operation names are grouped by prefix to see where time goes:
+    fuse.*       FUSE handlers (fuse.py, fuse_passthrough.py, fuse3.py)
+    loop.*       wait_async: waiting for the loop thread to pick up the coroutine (hop_in)
+                 and for the caller thread to get the result back (hop_out)
+    net.*        HTTP requests (listing, head, download)
+    disk.*       reading cached files, writing downloads and metadata
+
+Besides histograms modules register counters and gauges by value() (block_cache hits ..).
+
+export: --metrics-file writes Prometheus text format (textfile collector) every 10s,
+SIGUSR1 prints the table to stderr, the metrics command prints the daemon's.
+
+SamplingProfiler is an opt-in profiler sampling the stacks of all threads
+(sys._current_frames) writing collapsed stacks for flamegraph.pl / speedscope.
+"""
+
+# upper bounds in seconds, 10us .. ~168s doubling
+bucket_bounds = [1e-5 * 2 ** i for i in range(25)]
+
+class Histogram:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = [0] * (len(bucket_bounds) + 1)
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float, error = False):
+        i = bisect_left(bucket_bounds, seconds)
+        with self.lock:
+            self.buckets[i] += 1
+            self.count += 1
+            self.sum += seconds
+            if error:
+                self.errors += 1
+
+    def percentile(self, p: float) -> Optional[float]:
+        """ upper bound of the bucket containing the p-th observation """
+        if self.count == 0:
+            return None
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n > 0:
+                return bucket_bounds[i] if i < len(bucket_bounds) else float("inf")
+        return float("inf")
+
+histograms: dict[str, Histogram] = {}
+histograms_lock = threading.Lock()
+
+def histogram(name: str) -> Histogram:
+    h = histograms.get(name)
+    if h == None:
+        with histograms_lock:
+            h = histograms.setdefault(name, Histogram())
+    return h
+
+# name -> (prometheus type counter / gauge, current value)
+values: dict[str, tuple[str, Callable[[], float]]] = {}
+
+def value(name: str, type: str, get: Callable[[], float]):
+    values[name] = (type, get)
+
+def observe(name: str, seconds: float, error = False):
+    histogram(name).observe(seconds, error)
+
+@contextmanager
+def timed(name: str):
+    """ also a trace span """
+    t = perf_counter()
+    error = False
+    try:
+        with tracing.span(name):
+            yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        observe(name, perf_counter() - t, error)
+
+def instrumented(name: str):
+    """ decorator for sync and async functions """
+    def decorate(f):
+        if inspect.iscoroutinefunction(f):
+            @functools.wraps(f)
+            async def a(*args, **kwargs):
+                with timed(name):
+                    return await f(*args, **kwargs)
+            return a
+        @functools.wraps(f)
+        def s(*args, **kwargs):
+            with timed(name):
+                return f(*args, **kwargs)
+        return s
+    return decorate
+
+def instrument_operations(cls, prefix: str):
+    """ wraps the public methods the class defines itself (the FUSE operations) """
+    for name, f in list(cls.__dict__.items()):
+        if not name.startswith("_") and inspect.isfunction(f):
+            setattr(cls, name, instrumented(f"{prefix}.{name}")(f))
+    return cls
+
+def format_seconds(s: Optional[float]) -> str:
+    if s == None:
+        return "-"
+    if s == float("inf"):
+        return "inf"
+    return f"{s * 1000:.2f}ms" if s < 1 else f"{s:.2f}s"
+
+def table() -> str:
+    lines = [f"{'op':32} {'count':>9} {'errors':>7} {'p50':>10} {'p95':>10} {'p99':>10} {'total':>10}"]
+    for name, h in sorted(histograms.items()):
+        lines.append(f"{name:32} {h.count:9} {h.errors:7} {format_seconds(h.percentile(0.5)):>10} {format_seconds(h.percentile(0.95)):>10} {format_seconds(h.percentile(0.99)):>10} {h.sum:9.2f}s")
+    for name, (_, get) in sorted(values.items()):
+        lines.append(f"{name:32} {get():9}")
+    return "\n".join(lines)
+
+def prometheus(prefix = "ash2txt") -> str:
+    out = [
+        f"# HELP {prefix}_op_seconds latency of operations (fuse.*, loop.*, net.*, disk.*)",
+        f"# TYPE {prefix}_op_seconds histogram",
+    ]
+    for name, h in sorted(histograms.items()):
+        with h.lock:
+            buckets, count, s = list(h.buckets), h.count, h.sum
+        cumulative = 0
+        for bound, n in zip([*bucket_bounds, float("inf")], buckets):
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else f"{bound:.6g}"
+            out.append(f'{prefix}_op_seconds_bucket{{op="{name}",le="{le}"}} {cumulative}')
+        out.append(f'{prefix}_op_seconds_sum{{op="{name}"}} {s}')
+        out.append(f'{prefix}_op_seconds_count{{op="{name}"}} {count}')
+    out.append(f"# HELP {prefix}_op_errors_total operations which raised")
+    out.append(f"# TYPE {prefix}_op_errors_total counter")
+    for name, h in sorted(histograms.items()):
+        out.append(f'{prefix}_op_errors_total{{op="{name}"}} {h.errors}')
+    for name, (type, get) in sorted(values.items()):
+        n = f"{prefix}_{name}_total" if type == "counter" else f"{prefix}_{name}"
+        out.append(f"# TYPE {n} {type}")
+        out.append(f"{n} {get()}")
+    return "\n".join(out) + "\n"
+
+def write_prometheus(path: str):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(prometheus())
+    os.rename(tmp, path)
+
+class SamplingProfiler:
+    """ samples the stacks of all other threads every interval seconds while running """
+
+    def __init__(self, interval = 0.005):
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+        self.stop_event: Optional[threading.Event] = None
+
+    def running(self) -> bool:
+        return self.stop_event != None
+
+    def start(self):
+        if self.running():
+            return
+        stop = self.stop_event = threading.Event()
+        def run():
+            me = threading.get_ident()
+            names = {}
+            while not stop.wait(self.interval):
+                for tid, frame in sys._current_frames().items():
+                    if tid == me:
+                        continue
+                    if not tid in names:
+                        names = {t.ident: t.name for t in threading.enumerate()}
+                    stack = [f"{f.name} ({os.path.basename(f.filename)}:{f.lineno})" for f in traceback.extract_stack(frame)]
+                    self.stacks[";".join([names.get(tid, str(tid)), *stack])] += 1
+                self.samples += 1
+        threading.Thread(target=run, name="sampling-profiler", daemon=True).start()
+
+    def stop(self):
+        if self.stop_event:
+            self.stop_event.set()
+            self.stop_event = None
+
+    def toggle(self):
+        self.stop() if self.running() else self.start()
+
+    def write_collapsed(self, path: str):
+        with open(path, "w") as f:
+            for stack, n in self.stacks.most_common():
+                f.write(f"{stack} {n}\n")
@@ -0,0 +1,198 @@
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Iterator, Optional
+from .ash2txtorg_cached import METADATA_FILE, CachedFolderData
+from . import log
+
+"""
+persistent index of the names in the cached listings for find
+
+    find full-scrolls '*_mask.png'
+    find full-scrolls 'Scroll1/*/volumes/*.tif'
+    find full-scrolls '_mask\\.png$' --regex
+
+sqlite (.name_index_v1.sqlite in the cache root), one row per folder and per file
+with its approximate size (exact if known). Folder paths end with / (root is "")
+so that folder path || name is the path of a file.
+
+Kept up to date by store_data which calls update_folder whenever a folder's
+metadata json is written. sync() builds it (find does if it is empty) or catches up
+with json written by other tools by following the folders lists of the metadata
+json from a root, comparing their mtimes, without listing any directory.
+
+Queries:
+    glob   like prefetch --include, * also matches /. Without / only the file names
+           are matched. The literal head of the pattern restricts the folders by
+           range on the folder path index, a literal tail is looked up reversed
+           in the rname index, so folders whose path can't match aren't read
+    regex  re.search on the path relative to PATH, only restricted to PATH
+"""
+
+NAME_INDEX_FILE = ".name_index_v1.sqlite"
+
+schema = """
+CREATE TABLE IF NOT EXISTS folders (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, mtime INTEGER, subs TEXT NOT NULL DEFAULT '');
+CREATE TABLE IF NOT EXISTS files (folder INTEGER NOT NULL, name TEXT NOT NULL, rname TEXT NOT NULL, size INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS files_folder ON files(folder);
+CREATE INDEX IF NOT EXISTS files_name ON files(name);
+CREATE INDEX IF NOT EXISTS files_rname ON files(rname);
+"""
+
+glob_special = re.compile(r"[*?\[]")
+
+def folder_key(rel: str) -> str:
+    """ "a/b" -> "a/b/", "" -> "" """
+    rel = rel.strip("/")
+    return f"{rel}/" if rel else ""
+
+def after_prefix(prefix: str) -> str:
+    """ smallest string greater than all strings starting with prefix """
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def literal_head(pattern: str) -> str:
+    m = glob_special.search(pattern)
+    return pattern[:m.start()] if m else pattern
+
+def literal_tail(pattern: str) -> str:
+    """ part after the last wildcard, [..] counts as wildcard """
+    m = None
+    for m in glob_special.finditer(pattern):
+        pass
+    if m == None:
+        return pattern
+    tail = pattern[m.end():]
+    # a [..] class: the tail starts after its ]
+    if m.group() == "[":
+        tail = tail[tail.find("]") + 1:] if "]" in tail else ""
+    return tail
+
+def sqlite_glob(pattern: str) -> str:
+    """ fnmatch negation [!x] is [^x] in sqlite """
+    return pattern.replace("[!", "[^")
+
+def below(key: str, column = "folders.path") -> tuple[str, list]:
+    """ condition for the folder key and its subfolders """
+    if key == "":
+        return "1", []
+    return f"{column} >= ? AND {column} < ?", [key, after_prefix(key)]
+
+class NameIndex:
+
+    def __init__(self, cache_directory: Path):
+        self.path = cache_directory / NAME_INDEX_FILE
+        self.cache_directory = cache_directory
+        self.lock = threading.Lock()
+        self.db = self.connect()
+        # several processes (daemon, mounts) write it
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(schema)
+
+    def connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, check_same_thread = False, isolation_level = None)
+        db.execute("PRAGMA busy_timeout=10000")
+        return db
+
+    def empty(self) -> bool:
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM folders LIMIT 1").fetchone() == None
+
+    def update_folder(self, rel: str, data: CachedFolderData, mtime: Optional[int]):
+        """ replaces the files of one folder and drops the folders which aren't listed
+            anymore, called after its metadata json was written
+        """
+        key = folder_key(rel)
+        rows = [(name, name[::-1], f.size if f.size != None else f.size_approximate) for name, f in data.files.items()]
+        listed = set(data.folders)
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT id FROM folders WHERE path = ?", (key,)).fetchone()
+                id = row[0] if row else self.db.execute("INSERT INTO folders (path) VALUES (?)", (key,)).lastrowid
+                self.db.execute("UPDATE folders SET mtime = ?, subs = ? WHERE id = ?", (mtime, "\n".join(data.folders), id))
+                self.db.execute("DELETE FROM files WHERE folder = ?", (id,))
+                self.db.executemany(f"INSERT INTO files (folder, name, rname, size) VALUES ({id}, ?, ?, ?)", rows)
+                cond, args = below(key)
+                for sub_id, path in self.db.execute(f"SELECT id, path FROM folders WHERE {cond} AND path != ?", [*args, key]).fetchall():
+                    if not path[len(key):].split("/", 1)[0] in listed:
+                        self.db.execute("DELETE FROM files WHERE folder = ?", (sub_id,))
+                        self.db.execute("DELETE FROM folders WHERE id = ?", (sub_id,))
+                self.db.execute("COMMIT")
+            except:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def sync(self, rel: str = "") -> tuple[int, int]:
+        """ reindexes the folders below rel whose metadata json changed since, following
+            the folders lists of the json (never lists directories). Returns (seen, updated)
+        """
+        cond, args = below(folder_key(rel))
+        with self.lock:
+            known = {path: (mtime, subs) for path, mtime, subs in self.db.execute(f"SELECT path, mtime, subs FROM folders WHERE {cond}", args)}
+        seen = 0
+        updated = 0
+        stack = [rel.strip("/")]
+        while stack:
+            r = stack.pop()
+            key = folder_key(r)
+            json_file = self.cache_directory / r / METADATA_FILE
+            try:
+                mtime = json_file.stat().st_mtime_ns
+            except FileNotFoundError:
+                # never listed, nothing cached below
+                continue
+            seen += 1
+            if key in known and known[key][0] == mtime:
+                # the folders listed may have been listed themselves since
+                subs = [x for x in known[key][1].split("\n") if x]
+            else:
+                try:
+                    data = CachedFolderData.from_json(json_file.read_text())
+                except Exception as e:
+                    log.info(f"name index: skipping {json_file} {e!r}")
+                    continue
+                self.update_folder(r, data, mtime)
+                updated += 1
+                subs = data.folders
+            stack.extend(f"{key}{s}" for s in subs)
+        return seen, updated
+
+    def find_glob(self, rel: str, pattern: str) -> Iterator[tuple[str, int]]:
+        """ (path, approximate size) of the files below rel matching pattern, see module doc """
+        key = folder_key(rel)
+        if "/" in pattern:
+            full = f"{key}{pattern}"
+            where, args = ["folders.path || files.name GLOB ?"], [sqlite_glob(full)]
+            # folders the literal head reaches, eg a/b/c*/d -> folders starting with a/b/
+            head = literal_head(full)
+            fkey = head[:head.rfind("/") + 1]
+        else:
+            where, args = ["files.name GLOB ?"], [sqlite_glob(pattern)]
+            fkey = key
+        cond, cargs = below(fkey)
+        where.append(cond)
+        args += cargs
+        tail = literal_tail(pattern.rsplit("/", 1)[-1])
+        if tail != "":
+            where.append("files.rname GLOB ?")
+            args.append(f"{tail[::-1]}*")
+        yield from self._query(" AND ".join(where), args)
+
+    def find_regex(self, rel: str, regex: str) -> Iterator[tuple[str, int]]:
+        key = folder_key(rel)
+        r = re.compile(regex)
+        cond, args = below(key)
+        for path, size in self._query(cond, args):
+            if r.search(path[len(key):]):
+                yield path, size
+
+    def _query(self, where: str, args: list) -> Iterator[tuple[str, int]]:
+        """ streamed from its own connection (snapshot), not sorted """
+        db = self.connect()
+        try:
+            cursor = db.execute(f"SELECT folders.path || files.name, files.size FROM files JOIN folders ON files.folder = folders.id WHERE {where}", args)
+            while rows := cursor.fetchmany(1000):
+                yield from rows
+        finally:
+            db.close()
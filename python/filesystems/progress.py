@@ -0,0 +1,112 @@
+import asyncio
+import json
+from collections import deque
+from time import time
+from typing import IO, Optional
+
+"""
+progress of long running commands (prefetch, du_approximate, checks)
+
+planned counts can grow while walking (streaming prefetch) or be known upfront (planned prefetch).
+Throughput is computed over a rolling window of samples taken on each report tick,
+so done() stays cheap even if called for 20k files.
+"""
+
+def format_duration(s: Optional[float]) -> str:
+    if s == None:
+        return "?"
+    s = int(s)
+    return f"{s // 3600}h{s // 60 % 60:02d}m{s % 60:02d}s"
+
+class Progress:
+
+    def __init__(self, name: str, jsonl: Optional[IO] = None, interval: float = 10.0, window: float = 60.0):
+        self.name = name
+        self.jsonl = jsonl
+        self.interval = interval
+        self.window = window
+        self.started = time()
+        self.files_planned = 0
+        self.bytes_planned = 0
+        self.files_done = 0
+        self.bytes_done = 0
+        self.errors = 0
+        self.samples: deque[tuple[float, int]] = deque([(self.started, 0)])
+
+    def plan(self, files: int, bytes: int):
+        self.files_planned += files
+        self.bytes_planned += bytes
+
+    def done(self, files: int = 1, bytes: int = 0, error = False):
+        self.files_done += files
+        self.bytes_done += bytes
+        if error:
+            self.errors += 1
+
+    def sample(self):
+        now = time()
+        self.samples.append((now, self.bytes_done))
+        while len(self.samples) > 2 and self.samples[0][0] < now - self.window:
+            self.samples.popleft()
+
+    def throughput(self) -> float:
+        """ bytes/sec over the rolling window """
+        (t0, b0), (t1, b1) = self.samples[0], self.samples[-1]
+        return (b1 - b0) / (t1 - t0) if t1 > t0 else 0.0
+
+    def eta(self) -> Optional[float]:
+        tp = self.throughput()
+        if tp <= 0 or self.bytes_planned <= self.bytes_done:
+            return None
+        return (self.bytes_planned - self.bytes_done) / tp
+
+    def snapshot(self) -> dict:
+        return {
+            "name": self.name,
+            "time": time(),
+            "elapsed": time() - self.started,
+            "files_done": self.files_done,
+            "files_planned": self.files_planned,
+            "bytes_done": self.bytes_done,
+            "bytes_planned": self.bytes_planned,
+            "errors": self.errors,
+            "bytes_per_sec": self.throughput(),
+            "eta": self.eta(),
+        }
+
+    def line(self) -> str:
+        MiB = 1024 * 1024
+        return (f"{self.name}: {self.files_done}/{self.files_planned} files"
+            f" {self.bytes_done / MiB:.2f}/{self.bytes_planned / MiB:.2f} MiB"
+            f" {self.throughput() / MiB:.2f} MiB/s eta {format_duration(self.eta())}"
+            + (f" errors {self.errors}" if self.errors else ""))
+
+    def report(self):
+        self.sample()
+        print(self.line())
+        if self.jsonl:
+            self.jsonl.write(json.dumps(self.snapshot()) + "\n")
+            self.jsonl.flush()
+
+    async def report_forever(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.report()
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> "Reporter":
+        """ reports every interval until cancelled, then once more """
+        return Reporter(self, loop.create_task(self.report_forever()))
+
+class Reporter:
+
+    def __init__(self, progress: Progress, task: asyncio.Task):
+        self.progress = progress
+        self.task = task
+
+    def cancel(self):
+        """ the last report is written at once, before the command returns (a daemon
+            request's output and --progress-jsonl are closed then)
+        """
+        if not self.task.done():
+            self.task.cancel()
+            self.progress.report()
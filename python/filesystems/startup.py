@@ -0,0 +1,38 @@
+from contextlib import contextmanager
+from time import perf_counter
+import sys
+
+"""
+startup timings of example-main.py for --profile-startup and --startup-budget
+
+Imported first so that `started` is close to the process start. Heavy dependencies
+are imported where they are needed (aiohttp on the first request, bs4 on the first
+listing, numpy for zarr estimation) and timed by `timed`, so that eg list on cached
+metadata doesn't pay for them.
+"""
+
+started = perf_counter()
+# name -> (seconds since started, duration or None)
+marks: dict[str, tuple[float, float | None]] = {}
+
+def elapsed() -> float:
+    return perf_counter() - started
+
+def mark(name: str):
+    """ first time something happened, later calls are ignored """
+    if not name in marks:
+        marks[name] = (elapsed(), None)
+
+@contextmanager
+def timed(name: str):
+    t = perf_counter()
+    try:
+        yield
+    finally:
+        if not name in marks:
+            marks[name] = (t - started, perf_counter() - t)
+
+def report(file = sys.stderr):
+    for name, (at, duration) in sorted(marks.items(), key = lambda x: x[1][0]):
+        took = f" took {duration * 1000:7.1f}ms" if duration != None else ""
+        print(f"startup {at * 1000:8.1f}ms {name}{took}", file = file)
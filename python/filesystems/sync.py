@@ -0,0 +1,181 @@
+import asyncio
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import strftime
+from typing import Callable, Optional
+from . import types as t
+from . import ash2txtorg_cached as ac
+from .progress import Progress
+from .walking import PlannedFile, PrefetchSelection, plan_prefetch, format_size_MiB
+
+"""
+what changed on the server since folders were listed (sync command)
+
+Each folder below PATH which was listed before is listed again, in parallel (the
+fetch limiter of example-main applies), and compared to its cached metadata:
+
+    + name 1.20 MiB           added file
+    - name                    removed file
+    ~ name 1.00 -> 1.20 MiB   size or date in the listing changed
+    + sub/  - sub/            added / removed folder, new folders aren't descended
+
+Folders which were never listed are skipped, so a sync costs one listing per
+cached folder and, with download, only the changed files.
+
+apply: the metadata takes the new listing (exact sizes and hashes of unchanged
+files are kept). Cached contents of removed and changed entries are moved to
+.trash/<time>/<path> in the cache directory, so changed files get downloaded again.
+"""
+
+TRASH_DIR = ".trash"
+
+@dataclass
+class FolderDiff:
+    path: t.MyPath
+    added: list[tuple[str, int]] = field(default_factory=list) # name, size
+    removed: list[str] = field(default_factory=list)
+    changed: list[tuple[str, int, int]] = field(default_factory=list) # name, old size, new size
+    added_folders: list[str] = field(default_factory=list)
+    removed_folders: list[str] = field(default_factory=list)
+
+    def empty(self) -> bool:
+        return not (self.added or self.removed or self.changed or self.added_folders or self.removed_folders)
+
+def size_of(f: ac.CachedFileData) -> int:
+    return f.size if f.size != None else f.size_approximate
+
+def file_changed(old: ac.CachedFileData, new: ac.CachedFileData) -> bool:
+    # both approximate sizes come from listings, exact sizes may come from HEAD
+    if old.size_approximate != new.size_approximate:
+        return True
+    if old.size != None and new.size != None and old.size != new.size:
+        return True
+    # metadata written before dates were kept has none
+    return old.date != None and new.date != None and old.date != new.date
+
+def diff_listing(path: t.MyPath, old: ac.CachedFolderData, new: ac.CachedFolderData) -> FolderDiff:
+    d = FolderDiff(path)
+    for name, f in new.files.items():
+        o = old.files.get(name)
+        if o == None:
+            d.added.append((name, size_of(f)))
+        elif file_changed(o, f):
+            d.changed.append((name, size_of(o), size_of(f)))
+    d.removed = [name for name in old.files if not name in new.files]
+    old_folders = set(old.folders)
+    new_folders = set(new.folders)
+    d.added_folders = [x for x in new.folders if not x in old_folders]
+    d.removed_folders = [x for x in old.folders if not x in new_folders]
+    return d
+
+def merge_listing(old: ac.CachedFolderData, new: ac.CachedFolderData, d: FolderDiff) -> ac.CachedFolderData:
+    """ the new listing, keeping what is known about unchanged files """
+    changed = {name for name, _, _ in d.changed}
+    files = {}
+    for name, f in new.files.items():
+        o = old.files.get(name)
+        if o != None and not name in changed:
+            # dates of metadata written before they were kept
+            o.date = f.date
+            files[name] = o
+        else:
+            files[name] = f
+    return ac.CachedFolderData(files = files, folders = new.folders, zarr_ratio = old.zarr_ratio)
+
+def format_diff(d: FolderDiff) -> list[str]:
+    p = f"{d.path}/" if str(d.path) else ""
+    lines = []
+    lines += [f"- {p}{x}/" for x in d.removed_folders]
+    lines += [f"+ {p}{x}/" for x in d.added_folders]
+    lines += [f"- {p}{x}" for x in d.removed]
+    lines += [f"+ {p}{x} {format_size_MiB(size)}" for x, size in d.added]
+    lines += [f"~ {p}{x} {format_size_MiB(a)} -> {format_size_MiB(b)}" for x, a, b in d.changed]
+    return lines
+
+@dataclass
+class SyncReport:
+    folders: int = 0
+    added: int = 0
+    added_bytes: int = 0
+    removed: int = 0
+    changed: int = 0
+    changed_bytes: int = 0
+    added_folders: int = 0
+    removed_folders: int = 0
+    trashed: int = 0
+    errors: list[str] = field(default_factory=list)
+    # with download: new and changed files, new folders
+    fetch_files: list[PlannedFile] = field(default_factory=list)
+    fetch_folders: list[ac.LazyFolder] = field(default_factory=list)
+
+    def summary(self) -> str:
+        return (f"revalidated {self.folders} folders: {self.added} files added {format_size_MiB(self.added_bytes)}, "
+            f"{self.changed} changed {format_size_MiB(self.changed_bytes)}, {self.removed} removed, "
+            f"folders +{self.added_folders} -{self.removed_folders}, moved {self.trashed} to {TRASH_DIR}")
+
+class Trash:
+    """ .trash/<time of this sync>/<path> """
+
+    def __init__(self, cache_directory: Path):
+        self.cache_directory = cache_directory
+        self.dir = cache_directory / TRASH_DIR / strftime("%Y%m%d-%H%M%S")
+
+    def move(self, rel: str) -> bool:
+        src = self.cache_directory / rel
+        if not os.path.lexists(src):
+            return False
+        dst = self.dir / rel
+        dst.parent.mkdir(parents = True, exist_ok = True)
+        src.rename(dst)
+        return True
+
+async def sync(folder: ac.LazyFolder, listed: Callable[[t.MyPath], bool], report: SyncReport, emit: Callable[[str], None],
+        apply: bool, download: bool, trash: Optional[Trash], progress: Optional[Progress] = None):
+    """ revalidates folder and the folders below it which were listed before """
+    assert folder.opts.folder_listing
+    if progress:
+        progress.plan(1, 0)
+    c = await folder.cached()
+    try:
+        new = await folder.opts.folder_listing(folder.path)
+    except Exception as e:
+        report.errors.append(f"{folder.path} {e!r}")
+        if progress:
+            progress.done(1, 0, True)
+        return
+    old = c.data
+    d = diff_listing(folder.path, old, new)
+    report.folders += 1
+    report.added += len(d.added)
+    report.added_bytes += sum(size for _, size in d.added)
+    report.removed += len(d.removed)
+    report.changed += len(d.changed)
+    report.changed_bytes += sum(b for _, _, b in d.changed)
+    report.added_folders += len(d.added_folders)
+    report.removed_folders += len(d.removed_folders)
+    for line in format_diff(d):
+        emit(line)
+
+    # also stores the dates for metadata written before they were kept
+    if (apply or download) and (not d.empty() or any(f.date == None for f in old.files.values())):
+        if trash:
+            for name in [*d.removed, *d.removed_folders, *[x for x, _, _ in d.changed]]:
+                if trash.move(str(folder.path / name)):
+                    report.trashed += 1
+        await folder.replace_listing(merge_listing(old, new, d))
+    if progress:
+        progress.done(1, 0)
+
+    folders, _ = await folder.folders_and_files()
+    if download:
+        for name in [*[x for x, _ in d.added], *[x for x, _, _ in d.changed]]:
+            report.fetch_files.append(PlannedFile(folder, name, size_of(new.files[name])))
+        report.fetch_folders += [folders[x] for x in d.added_folders if x in folders]
+    subs = [v for k, v in folders.items() if not k in d.added_folders and not k in d.removed_folders and listed(v.path)]
+    await asyncio.gather(*[sync(x, listed, report, emit, apply, download, trash, progress) for x in subs])
+
+async def plan_download(report: SyncReport, limiter: asyncio.Semaphore) -> list[PlannedFile]:
+    """ changed and new files and everything in new folders """
+    plans = await asyncio.gather(*[plan_prefetch(x, PrefetchSelection(), limiter) for x in report.fetch_folders])
+    return [*report.fetch_files, *[x for p in plans for x in p]]
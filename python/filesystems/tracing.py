@@ -0,0 +1,120 @@
+import contextvars
+import functools
+import itertools
+import json
+import os
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from time import perf_counter
+from typing import Optional
+
+"""
+trace spans of logical operations exported as Chrome trace / Perfetto json (--trace FILE)
+
+A span knows its parent through the current_span contextvar. It follows awaits, tasks
+created while it is current (fetch_once.by_key, gather) and wait_async, which passes the
+context of the calling FUSE thread on to the loop. So an open shows up as
+
+    fuse.open > walk_path > folder_fetch > net.queue / net.listing > disk.metadata_write
+
+Spans are written as async events ("b"/"e") with the id of their root span, so each
+root operation gets its own track in Perfetto (ui.perfetto.dev) / chrome://tracing, and
+span/parent ids are in the args. Waiting (net.queue, loop.hop_in, lease.wait) and
+service time (net.*, disk.*) are separate spans.
+
+metrics.timed opens a span too, so every timed operation is traced. When tracing is
+off span() only checks a flag.
+"""
+
+enabled = False
+max_events = 2_000_000
+events: list[dict] = []
+dropped = 0
+started = perf_counter()
+pid = os.getpid()
+_ids = itertools.count(1)
+
+@dataclass
+class Span:
+    id: int
+    name: str
+    parent: Optional["Span"]
+    root: int
+    start: float
+    args: Optional[dict]
+
+current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+def enable():
+    global enabled, started
+    enabled = True
+    started = perf_counter()
+
+def path(s: Optional[Span]) -> str:
+    """ root > .. > s """
+    names = []
+    while s != None:
+        names.append(s.name)
+        s = s.parent
+    return " > ".join(reversed(names))
+
+def _us(t: float) -> float:
+    return (t - started) * 1e6
+
+def _emit(s: Span, end: float, error: Optional[str]):
+    global dropped
+    if len(events) >= max_events:
+        dropped += 1
+        return
+    args = {"span": s.id, "parent": s.parent.id if s.parent else None, "thread": threading.current_thread().name}
+    if s.args:
+        args.update(s.args)
+    common = {"name": s.name, "cat": "op", "id": s.root, "pid": pid, "tid": s.root}
+    events.append({**common, "ph": "b", "ts": _us(s.start), "args": args})
+    events.append({**common, "ph": "e", "ts": _us(end), "args": {"error": error} if error else {}})
+
+def _new(name: str, start: float, args: Optional[dict]) -> Span:
+    parent = current_span.get()
+    i = next(_ids)
+    return Span(i, name, parent, parent.root if parent else i, start, args)
+
+@contextmanager
+def span(name: str, **args):
+    if not enabled:
+        yield None
+        return
+    s = _new(name, perf_counter(), args)
+    token = current_span.set(s)
+    error = None
+    try:
+        yield s
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        current_span.reset(token)
+        _emit(s, perf_counter(), error)
+
+def record(name: str, start: float, end: float, **args):
+    """ span measured elsewhere (perf_counter times) as child of the current one """
+    if enabled:
+        _emit(_new(name, start, args), end, None)
+
+def traced(name: str):
+    """ decorator for async functions, the arguments (str) become span args """
+    def decorate(f):
+        @functools.wraps(f)
+        async def a(*args, **kwargs):
+            if not enabled:
+                return await f(*args, **kwargs)
+            with span(name, args = [str(x) for x in args]):
+                return await f(*args, **kwargs)
+        return a
+    return decorate
+
+def write(file: str):
+    tmp = f"{file}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"dropped_events": dropped}}, f)
+    os.rename(tmp, file)
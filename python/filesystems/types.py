@@ -14,7 +14,8 @@ class MyPath:
     def __truediv__(self, x):
         return MyPath(f"{self.path}/{x}")
     def name(self):
-        return self.split()[-1]
+        ps = self.split()
+        return ps[-1] if ps else ""
     def split(self) -> Sequence[str]:
         ps = self.path.split('/')
         if ps == ['']:
@@ -25,6 +26,7 @@ FoldersLazy: TypeAlias = "Mapping[str, Folder]"
 FoldersAndFiles: TypeAlias = "Tuple[FoldersLazy, Iterable[str]]"
     
 FileOrFolder = Tuple
+FileSizeColumns: TypeAlias = "Tuple[list[str], list[int]]"
 
 A = TypeVar("A")  # Generic type for data
 B = TypeVar("B")  # Generic type for data
@@ -47,6 +49,30 @@ class FoldersAndFilesDC(Generic[A,B]):
 #     async def bytes(self, offset, size) -> bytes:
 #         raise NotImplementedError()
 
+@dataclass
+class Rollup:
+    """ aggregates of a subtree, see walking.rollup """
+    size: int = 0          # approximate bytes, exact where known. zarr levels with measured ratio estimated
+    exact_bytes: int = 0   # bytes of files whose exact size is known
+    files: int = 0
+    exact_files: int = 0
+    cached_bytes: int = 0  # bytes in the cache directory
+    cached_files: int = 0
+    # a zarr level was estimated instead of listed: counts and cached_* only cover what was listed
+    estimated: bool = False
+    # time (ns) the cached_* counts were taken, stale once files below changed since (eviction.Generation)
+    generation: int = 0
+
+    def add(self, o: "Rollup"):
+        self.size += o.size
+        self.exact_bytes += o.exact_bytes
+        self.files += o.files
+        self.exact_files += o.exact_files
+        self.cached_bytes += o.cached_bytes
+        self.cached_files += o.cached_files
+        self.estimated = self.estimated or o.estimated
+        self.generation = min(self.generation, o.generation)
+
 class Folder:
     path: MyPath
     async def folders_and_files(self) -> FoldersAndFiles:
@@ -56,12 +82,41 @@ class Folder:
         raise NotImplementedError()
     async def file_size_bytes_exact(self, name) -> int:
         raise NotImplementedError()
+    # from memory only, callable from other threads (fusepy), None if it would have to await
+    def folders_and_files_nowait(self) -> Optional[FoldersAndFiles]:
+        return None
+    def file_size_bytes_exact_nowait(self, name: str) -> Optional[int]:
+        return None
+    # names and approximate sizes of all files as two columns
+    async def file_sizes_approximate(self) -> FileSizeColumns:
+        folders, files = await self.folders_and_files()
+        names = list(files)
+        return names, [await self.file_size_bytes_approximate(name) for name in names]
     async def filefile__bytes(self, name, offset, size) -> bytes:
         raise NotImplementedError()
     async def file_exists(self, name: str) -> bool:
         raise NotImplementedError()
     async def file_ensure_fetched(self, name: str):
         raise NotImplementedError()
+    # the contents were used (FUSE open/read), for cache eviction
+    def file_accessed(self, name: str):
+        pass
+    # measured compression ratio if folder contains .zarray
+    async def zarr_compression_ratio(self) -> Optional[float]:
+        return None
+    # stored subtree rollup if still valid, folders which don't store them compute them each time
+    async def rollup(self) -> Optional[Rollup]:
+        return None
+    async def set_rollup(self, r: Rollup):
+        pass
+    # rollup of the files of this folder only
+    async def files_rollup(self) -> Rollup:
+        folders, files = await self.folders_and_files()
+        r = Rollup()
+        for name in files:
+            r.size += await self.file_size_bytes_approximate(name)
+            r.files += 1
+        return r
         
 
 FolderOrFile: TypeAlias = 'Tuple[Folder, None | str]'
@@ -0,0 +1,206 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator, Optional
+from .ash2txtorg_cached import METADATA_FILE, new_hasher
+from .progress import Progress
+from .leases import LEASE_SUFFIX
+
+"""
+verify the cache directory against the cached metadata without touching the network
+
+Each directory is read by one os.scandir call in a worker thread (sizes come from
+the DirEntry stat which is cached by scandir on most platforms) together with its
+.directory_contents_cached_v2.json. The join against the metadata then happens in bulk
+per directory. So this is limited by disk and not by HEAD requests like
+walking.walk_cache_dir_check_sizes.
+
+Files only having an approximate size ("12.3 MiB" in the listing) can't be checked
+exactly, they are accepted if they are within approximate_tolerance.
+
+With check_hash files whose mtime differs from the one recorded when they were
+downloaded (and hashed) are rehashed by a thread pool. Untouched files are trusted,
+so a second run doesn't reread terabytes.
+"""
+
+approximate_tolerance = 0.05
+
+@dataclass
+class DirScan:
+    rel: str # relative to the verified root, "" for root
+    files: dict[str, tuple[int, int]] # name -> size, mtime_ns on disk
+    dirs: list[str]
+    metadata: Optional[dict] # raw json of METADATA_FILE
+
+def scan_dir(root: Path, rel: str) -> DirScan:
+    files = {}
+    dirs = []
+    metadata = None
+    with os.scandir(root / rel if rel else root) as it:
+        for e in it:
+            if e.is_dir(follow_symlinks=False):
+                dirs.append(e.name)
+            elif e.name == METADATA_FILE:
+                with open(e.path, "r") as f:
+                    metadata = json.load(f)
+            else:
+                st = e.stat(follow_symlinks=False)
+                files[e.name] = (st.st_size, st.st_mtime_ns)
+    return DirScan(rel, files, dirs, metadata)
+
+def scan_tree(root: Path, threads: int = 16) -> Iterator[DirScan]:
+    """ yields directories as soon as they are scanned, subdirectories are scanned in parallel """
+    def join(rel, name):
+        return f"{rel}/{name}" if rel else name
+    with ThreadPoolExecutor(threads) as ex:
+        pending = {ex.submit(scan_dir, root, "")}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                d = f.result()
+                for sub in d.dirs:
+                    # .trash of sync
+                    if d.rel == "" and sub.startswith("."):
+                        continue
+                    pending.add(ex.submit(scan_dir, root, join(d.rel, sub)))
+                yield d
+
+def expected_size(file_metadata: dict) -> tuple[int, bool]:
+    """ size, is_exact """
+    s = file_metadata.get("s")
+    if s != None:
+        return s, True
+    return file_metadata["a"], False
+
+@dataclass
+class VerifyReport:
+    dirs: int = 0
+    dirs_without_metadata: int = 0
+    # folders in metadata which were never listed / have no directory in the cache
+    unlisted_folders: int = 0
+    ok: int = 0
+    ok_approximate: int = 0
+    missing: int = 0
+    missing_bytes: int = 0
+    partial: list[tuple[str, int, int]] = field(default_factory=list) # path, size, expected
+    oversized: list[tuple[str, int, int]] = field(default_factory=list)
+    # in the cache but not in the metadata, *.tmp are interrupted downloads
+    unknown: list[str] = field(default_factory=list)
+    tmp: list[str] = field(default_factory=list)
+    bytes_expected: int = 0
+    bytes_cached: int = 0
+    # hash checking
+    check_hash: bool = False
+    unhashed: int = 0 # downloaded before hashes were recorded (or by the Go version)
+    hash_candidates: list[tuple[str, str, int, int]] = field(default_factory=list) # path, expected hash, mtime now, size
+    hash_ok: list[tuple[str, int]] = field(default_factory=list) # rehashed and fine: path, mtime now
+    corrupt: list[str] = field(default_factory=list)
+
+    def add_dir(self, d: DirScan, prefix: str):
+        self.dirs += 1
+        if d.metadata == None:
+            self.dirs_without_metadata += 1
+            return
+        p = f"{prefix}{d.rel}/" if d.rel else prefix
+        mfiles = d.metadata["files"]
+        for name, fm in mfiles.items():
+            expected, exact = expected_size(fm)
+            self.bytes_expected += expected
+            on_disk = d.files.get(name)
+            if on_disk == None:
+                self.missing += 1
+                self.missing_bytes += expected
+                continue
+            size, mtime = on_disk
+            if self.check_hash:
+                if fm.get("h") == None:
+                    self.unhashed += 1
+                elif fm.get("m") != mtime:
+                    self.hash_candidates.append((f"{p}{name}", fm["h"], mtime, size))
+            self.bytes_cached += size
+            tolerance = 0 if exact else expected * approximate_tolerance
+            if size < expected - tolerance:
+                self.partial.append((f"{p}{name}", size, expected))
+            elif size > expected + tolerance:
+                self.oversized.append((f"{p}{name}", size, expected))
+            elif exact:
+                self.ok += 1
+            else:
+                self.ok_approximate += 1
+        for name in d.files:
+            # hidden files in the root are state of the tool (access times, pins)
+            if name in mfiles or name.endswith(LEASE_SUFFIX) or (d.rel == "" and prefix == "" and name.startswith(".")):
+                continue
+            (self.tmp if name.endswith(".tmp") else self.unknown).append(f"{p}{name}")
+        dirs = set(d.dirs)
+        self.unlisted_folders += len([x for x in d.metadata["folders"] if not x in dirs])
+
+    def print_all(self, max_lines = 50):
+        MiB = 1024 * 1024
+        for title, l in [("PARTIAL", self.partial), ("OVERSIZED", self.oversized)]:
+            for path, size, expected in l[:max_lines]:
+                print(f"{title} {path} size={size} expected={expected}")
+            if len(l) > max_lines:
+                print(f"{title} .. {len(l) - max_lines} more")
+        for title, l in [("UNKNOWN", self.unknown), ("TMP", self.tmp), ("CORRUPT", self.corrupt)]:
+            for path in l[:max_lines]:
+                print(f"{title} {path}")
+            if len(l) > max_lines:
+                print(f"{title} .. {len(l) - max_lines} more")
+        ratio = self.bytes_cached / self.bytes_expected if self.bytes_expected else 1.0
+        print(f"""
+        dirs: {self.dirs} (without metadata {self.dirs_without_metadata}, folders never listed {self.unlisted_folders})
+        ok: {self.ok} exact, {self.ok_approximate} within approximate size
+        missing: {self.missing} {self.missing_bytes / MiB:.2f} MiB
+        partial: {len(self.partial)} oversized: {len(self.oversized)} unknown: {len(self.unknown)} tmp: {len(self.tmp)}
+        cached {self.bytes_cached / MiB:.2f} MiB / {self.bytes_expected / MiB:.2f} MiB {ratio:.2f}
+        """)
+        if self.check_hash:
+            print(f"""
+        hash: rehashed {len(self.hash_candidates)} files with changed mtime, ok {len(self.hash_ok)} corrupt {len(self.corrupt)}, without recorded hash {self.unhashed}
+        """)
+
+def hash_file(path: Path, block_size = 4 * 1024 * 1024) -> str:
+    h = new_hasher()
+    with open(path, "rb", buffering=0) as f:
+        while b := f.read(block_size):
+            h.update(b) # releases the GIL, so threads help
+    return h.hexdigest()
+
+def verify_hashes(r: VerifyReport, cache_directory: Path, threads: int = 16, progress: Optional[Progress] = None):
+    def check(c):
+        path, expected, mtime, size = c
+        return c, hash_file(cache_directory / path) == expected
+    with ThreadPoolExecutor(threads) as ex:
+        for (path, expected, mtime, size), ok in ex.map(check, r.hash_candidates):
+            if ok:
+                r.hash_ok.append((path, mtime))
+            else:
+                r.corrupt.append(path)
+            if progress:
+                progress.done(1, size, not ok)
+
+def verify_tree(root: Path, prefix: str = "", threads: int = 16, progress: Optional[Progress] = None, check_hash = False, cache_directory: Optional[Path] = None) -> VerifyReport:
+    """ prefix is prepended to reported paths (the path of root relative to cache_directory) """
+    r = VerifyReport(check_hash = check_hash)
+    for d in scan_tree(root, threads):
+        r.add_dir(d, prefix)
+        if progress and d.metadata != None:
+            size = sum(size for size, _ in d.files.values())
+            progress.plan(len(d.metadata["files"]), size)
+            progress.done(len(d.metadata["files"]), size)
+    if check_hash:
+        if progress:
+            progress.plan(len(r.hash_candidates), sum(c[3] for c in r.hash_candidates))
+        verify_hashes(r, cache_directory if cache_directory else root, threads, progress)
+    return r
+
+def unlink_bad(r: VerifyReport, cache_directory: Path) -> list[str]:
+    """ removes partial, oversized and corrupt files so that they get fetched again, returns their paths """
+    # a partial file can be corrupt too, once
+    paths = list(dict.fromkeys([*[p for p, _, _ in [*r.partial, *r.oversized]], *r.corrupt]))
+    for p in paths:
+        (cache_directory / p).unlink(missing_ok=True)
+    return paths
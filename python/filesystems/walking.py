@@ -3,13 +3,19 @@ from typing import TypeVar, Generic, Union, Callable, Any, IO, cast, Protocol, o
 import re
 from collections import defaultdict
 import json
-from .zarray_estimation import estimate_zarray_contents_size
 import os
 from . import ash2txtorg_cached as ac
 from pathlib import Path
 from functools import reduce
 import asyncio
-from typing import Iterable
+from typing import Iterable, Optional
+from dataclasses import dataclass, field, replace
+from fnmatch import fnmatch
+from itertools import zip_longest
+from .progress import Progress
+from . import log
+from . import tracing
+from . import metrics
 
 """
 some implementations to list size or prefetch files
@@ -32,6 +38,22 @@ def format_size_bytes(b):
 def format_size_MiB(b):
     return f"{b / 1024.0 / 1024:.2f} MiB"
 
+size_units = {
+    "": 1, "B": 1,
+    "K": 1024, "KiB": 1024,
+    "M": 1024 ** 2, "MiB": 1024 ** 2,
+    "G": 1024 ** 3, "GiB": 1024 ** 3,
+    "T": 1024 ** 4, "TiB": 1024 ** 4,
+}
+re_size = re.compile(r'^\s*([0-9.]+)\s*([A-Za-z]*)\s*$')
+
+def parse_size(s: str) -> int:
+    """ "500", "20GiB", "1.5 TiB" or "20G" -> bytes """
+    m = re_size.match(s)
+    if not m or m.group(2) not in size_units:
+        raise ValueError(f"bad size {s}, use eg 500MiB or 2TiB")
+    return round(float(m.group(1)) * size_units[m.group(2)])
+
 re_working_mesh_window = re.compile('^working_mesh_.*window')
 
 def special_folder(folder: t.Folder, folders: Iterable[str], files: Iterable[str]):
@@ -73,101 +95,235 @@ def special_folder(folder: t.Folder, folders: Iterable[str], files: Iterable[str
 async def walk_path(folder: t.Folder, path: t.MyPath) -> t.MaybeFolderOrFile:
     """ finds a subfolder or subfile by walking the path"""
     ps = path.split()
-    for p in ps:
-        folders, files = await folder.folders_and_files()
+    with tracing.span("walk_path", path = str(path)):
+        for p in ps:
+            folders, files = await folder.folders_and_files()
+            if p in folders:
+                folder = folders[p]
+            elif p in files:
+                return (folder, p)
+            else:
+                return (None, None)
+                # raise Exception(f"{p} / {path} not found in {fof.path} folders {folders.keys()}")
+        return (folder, None)
+
+async def walk_path_find_folder(folder: t.Folder, path: t.MyPath) -> t.Folder | None:
+    """ finds a subfolder or subfile by walking the path"""
+    f, file = await walk_path(folder, path)
+    if file != None:
+        raise Exception(f"not a folder maybe file {path}")
+    return f
+
+# fusepy threads: answers from folders already in memory without the hop to the loop
+# thread (wait_async), only misses go there. Counts are approximate under contention
+fast_path = True
+fast_path_hits = 0
+fast_path_misses = 0
+
+metrics.value("fast_path_hits", "counter", lambda: fast_path_hits)
+metrics.value("fast_path_misses", "counter", lambda: fast_path_misses)
+
+def walk_path_nowait(folder: t.Folder, path: t.MyPath) -> Optional[t.MaybeFolderOrFile]:
+    """ walk_path if all folders on the way are loaded, else None. Only reads dicts
+        the loop may change meanwhile, safe from other threads
+    """
+    for p in path.split():
+        faf = folder.folders_and_files_nowait()
+        if faf == None:
+            return None
+        folders, files = faf
         if p in folders:
             folder = folders[p]
         elif p in files:
             return (folder, p)
         else:
             return (None, None)
-            # raise Exception(f"{p} / {path} not found in {fof.path} folders {folders.keys()}")
     return (folder, None)
 
-async def walk_path_find_folder(folder: t.Folder, path: t.MyPath) -> t.Folder | None:
-    """ finds a subfolder or subfile by walking the path"""
-    f, file = await walk_path(folder, path)
-    if file != None:
-        raise Exception(f"not a folder maybe file {path}")
-    return f
+def _fast(r):
+    global fast_path_hits, fast_path_misses
+    if r != None:
+        fast_path_hits += 1
+    else:
+        fast_path_misses += 1
+    return r
 
-async def list_special_and_approximate_size_fast(folder: t.Folder, sums_by_ext = True, print_each = True, print_within_special = False, indent = "") -> tuple[int, list[str]]:
-    """ first list subs so that there is some output ..
-        fast because approximate bytes are given in directory listings found in HTML
+async def file_cache_path_used(folder: ac.LazyFolder, name: str) -> str:
+    """ file_cache_path for FUSE open/read: only these count as access for eviction,
+        not prefetch or reading .zarray for listings
     """
-    folders, files = await folder.folders_and_files()
+    path = await folder.file_cache_path(name)
+    folder.file_accessed(name)
+    return path
+
+def walk_path_sync(folder: t.Folder, path: t.MyPath, wait_async) -> t.MaybeFolderOrFile:
+    r = _fast(walk_path_nowait(folder, path) if fast_path else None)
+    return r if r != None else wait_async(walk_path)(folder, path)
+
+def file_size_bytes_exact_sync(folder: t.Folder, name: str, wait_async) -> int:
+    size = _fast(folder.file_size_bytes_exact_nowait(name) if fast_path else None)
+    return size if size != None else wait_async(folder.file_size_bytes_exact)(name)
+
+def folders_and_files_sync(folder: t.Folder, path: t.MyPath, wait_async) -> Optional[t.FoldersAndFiles]:
+    """ of the folder at path, None if there is none """
+    if fast_path:
+        r = walk_path_nowait(folder, path)
+        f, name = r if r != None else (None, None)
+        if r != None and (f == None or name != None):
+            # known not to be a folder
+            _fast(r)
+            return None
+        faf = f.folders_and_files_nowait() if f != None else None
+        if _fast(faf) != None:
+            return faf
+    async def fof():
+        f, name = await walk_path(folder, path)
+        return await f.folders_and_files() if f != None and name == None else None
+    return wait_async(fof)()
+
+def sums_by_extension(names: list[str], sizes: list[int]) -> list[tuple[str, int, int]]:
+    """ (extension, count, bytes) in order of first appearance, grouped by numpy """
+    if len(names) == 0:
+        return []
+    # numpy, imported when the first folder gets grouped
+    from .zarray_estimation import np
+    a = np.array(names)
+    # os.path.splitext on the whole column: from the last dot unless it is one of the leading dots
+    dot = np.char.rfind(a, ".")
+    leading_dots = np.char.str_len(a) - np.char.str_len(np.char.lstrip(a, "."))
+    parts = np.char.rpartition(a, ".")
+    exts = np.where(dot >= leading_dots, np.char.add(parts[:, 1], parts[:, 2]), "")
+    unique, first, inverse, counts = np.unique(exts, return_index = True, return_inverse = True, return_counts = True)
+    sums = np.bincount(inverse, weights = np.asarray(sizes, dtype = np.float64), minlength = len(unique))
+    return [(str(unique[i]), int(counts[i]), round(sums[i])) for i in np.argsort(first)]
+
+class OrderedOutput:
+    """ lines of subtrees walked concurrently, in subtree order: the first unfinished
+        subtree writes through, later ones are buffered until it is their turn
+    """
+
+    def __init__(self, emit: Callable[[str], None], n: int):
+        self.emit = emit
+        self.buffers: list[list[str]] = [[] for _ in range(n)]
+        self.finished_ = [False] * n
+        self.head = 0
+
+    def writer(self, i: int) -> Callable[[str], None]:
+        def write(line: str):
+            if i == self.head:
+                self.emit(line)
+            else:
+                self.buffers[i].append(line)
+        return write
+
+    def finished(self, i: int):
+        self.finished_[i] = True
+        while self.head < len(self.finished_) and self.finished_[self.head]:
+            self.head += 1
+            if self.head < len(self.buffers):
+                for line in self.buffers[self.head]:
+                    self.emit(line)
+                self.buffers[self.head] = []
+
+async def list_special_and_approximate_size_fast(folder: t.Folder, sums_by_ext = True, print_each = True, print_within_special = False, indent = "", emit: Callable[[str], None] = print) -> int:
+    """ fast because approximate bytes are given in directory listings found in HTML.
+        Lines are emitted as soon as a subtree is done, like du: the contents of a
+        folder first, then the folder with its size.
+    """
+    if not print_each:
+        # nothing to print below, du_approximate might have summed it up already
+        r = await folder.rollup()
+        if r != None:
+            return r.size
 
-    flines: list[str] = []
-    folder_size = 0
+    folders, files = await folder.folders_and_files()
     path = folder.path
 
-    # tmp debugging
-    print(f"debug-path {path}")
+    log.debug(f"debug-path {path}")
 
     if ".zarray" in files:
         # don't recursie into the many folders of a folder containing a zarry file!
         await folder.file_ensure_fetched(".zarray")
         bytes = await folder.file_bytes(".zarray", 0, None)
         o = json.loads(bytes.decode('utf-8'))
-        estimated_directory_size, cr, ch = estimate_zarray_contents_size(o)
-        if print_each:
-            flines.append(f"{indent}{path.name()}/ {format_size_MiB(estimated_directory_size)} {str(path)} compression hint {ch}")
-        folder_size += estimated_directory_size
-
-    else:
-
-        childs = []
-        special = special_folder(folder, folders.keys(), files)
-        pe = print_each and ( special == None or print_within_special)
-        items = await asyncio.gather(
-            *[ list_special_and_approximate_size_fast(v, sums_by_ext, pe, print_within_special, f"{indent}    ") for name, v in folders.items()],
-        )
-
-        for size, lines in items:
-            folder_size += size
-            childs += lines
-
-        sum_by8_ext = defaultdict(lambda: 0)
-        counts_by_ext = defaultdict(lambda: 0)
-        for name in files:
-            r, ext = os.path.splitext(name)
-            file_size = await folder.file_size_bytes_approximate(name)
-            folder_size += file_size
-
-            if pe:
-                if sums_by_ext:
-                    sum_by_ext[ext] += file_size
-                    counts_by_ext[ext] += 1
-                else:
-                    childs.append((f"{indent}    {name} {file_size}"))
-
-        if pe and sums_by_ext:
-            for name, v in sum_by_ext.items():
-                childs.append(f"{indent}{ind}extension={name}: count:{counts_by_ext[name]} {format_size_MiB(v)}")
-
+        # numpy, only imported for folders with zarr archives
+        from .zarray_estimation import estimate_zarray_contents_size
+        estimated_directory_size, cr, ch = estimate_zarray_contents_size(o, await folder.zarr_compression_ratio())
         if print_each:
-            flines.append(f"{indent}{path.name()}/ {format_size_MiB(folder_size)} {str(path)}")
-            flines += childs
+            emit(f"{indent}{path.name()}/ {format_size_MiB(estimated_directory_size)} {str(path)} compression hint {ch}")
+        return estimated_directory_size
+
+    special = special_folder(folder, folders.keys(), files)
+    pe = print_each and ( special == None or print_within_special)
+    subs = list(folders.values())
+    out = OrderedOutput(emit, len(subs))
+    async def sub(i: int, v: t.Folder):
+        try:
+            return await list_special_and_approximate_size_fast(v, sums_by_ext, pe, print_within_special, f"{indent}    ", out.writer(i))
+        finally:
+            out.finished(i)
+    folder_size = sum(await asyncio.gather(*[sub(i, v) for i, v in enumerate(subs)]))
+
+    names, sizes = await folder.file_sizes_approximate()
+    folder_size += sum(sizes)
+
+    if pe:
+        if sums_by_ext:
+            for ext, count, size in sums_by_extension(names, sizes):
+                emit(f"{indent}{ind}extension={ext}: count:{count} {format_size_MiB(size)}")
+        else:
+            for name, size in zip(names, sizes):
+                emit(f"{indent}    {name} {size}")
 
-    # tmp debugging
-    for x in flines:
-        print(f"debug-fline {x}")
+    if print_each:
+        emit(f"{indent}{path.name()}/ {format_size_MiB(folder_size)} {str(path)}")
 
-    return folder_size, flines
+    return folder_size
 
 
-async def list_and_size_approximate_fast_parallel(folder: t.Folder, limiter: asyncio.Semaphore, indent = "") -> int:
+async def rollup(folder: t.Folder, progress: Optional[Progress] = None) -> t.Rollup:
+    """ sizes, file counts and cached bytes of the subtree.
+        Stored in the folder metadata (LazyFolder), so a second call only descends into
+        folders below which something changed: sizes became known, files were downloaded,
+        a zarr ratio was measured (LazyFolder.invalidate_rollup) or files below were removed
+        or added bypassing the folders (eviction.Generation).
+    """
+    r = await folder.rollup()
+    if r != None:
+        if progress:
+            progress.plan(r.files, r.size)
+            progress.done(r.files, r.size)
+        return r
+    folders, files = await folder.folders_and_files()
+    r = await folder.files_rollup()
+    ratio = await folder.zarr_compression_ratio() if ".zarray" in files else None
+    if ratio != None:
+        # measured by estimate-zarr, don't walk all chunk folders
+        o = json.loads((await folder.file_bytes(".zarray", 0, None)).decode('utf-8'))
+        from .zarray_estimation import estimate_zarray_contents_size
+        size, _, _ = estimate_zarray_contents_size(o, ratio)
+        r.size = round(size)
+        r.estimated = True
+        if progress:
+            progress.plan(1, r.size)
+            progress.done(1, r.size)
+    else:
+        if progress:
+            progress.plan(r.files, r.size)
+            progress.done(r.files, r.size)
+        for x in await asyncio.gather(*[rollup(x, progress) for x in folders.values()]):
+            r.add(x)
+    await folder.set_rollup(r)
+    return r
+
+async def list_and_size_approximate_fast_parallel(folder: t.Folder, limiter: asyncio.Semaphore, indent = "", progress: Optional[Progress] = None) -> int:
     """ first list subs so that there is some output ..
-        fast because approximate bytes are given in directory listings found in HTML
+        fast because approximate bytes are given in directory listings found in HTML,
+        and on the next run because the sums are kept in the metadata, see rollup
     """
     # async with limiter: # must be bigger than rec depth!
     # should we have some additional limiting ? ..
-    folders, files = await folder.folders_and_files()
-    file_sizes   = [folder.file_size_bytes_approximate(name) for name in files]
-    folder_sizes = [list_and_size_approximate_fast_parallel(x, limiter, f"{indent}{ind}") for x in folders.values()]
-    all = await asyncio.gather(*[*file_sizes, *folder_sizes])
-    total = reduce(lambda a, b: a + b, all, 0)
-    return total
+    return (await rollup(folder, progress)).size
 
 
 async def list_and_size_exact_slow(folder: t.Folder, indent = "") -> int:
@@ -186,7 +342,21 @@ async def list_and_size_exact_slow(folder: t.Folder, indent = "") -> int:
     print(f"folder {indent}{folder.path} {size}")
     return size
 
-async def prefetch(folder: ac.LazyFolder, limiter: asyncio.Semaphore, errors: Errors, fix = False):
+async def ensure_fetched(folder: ac.LazyFolder, name: str, errors: Errors, fix = False):
+    if fix:
+        cf = Path(await folder.file_cache_path(name))
+        if cf.exists():
+            expected_size = await folder.file_size_bytes_exact(name)
+            size = cf.stat().st_size
+            if size != expected_size:
+                msg = f"UNLINKING {cf} SHOULD{expected_size} WAS {size}"
+                print(msg)
+                errors.append(msg)
+                cf.unlink()
+
+    await folder.file_ensure_fetched(name)
+
+async def prefetch(folder: ac.LazyFolder, limiter: asyncio.Semaphore, errors: Errors, fix = False, progress: Optional[Progress] = None):
     # question is what's correct way to fix ?
     # maybe remove all the .directory_contents_cached_v2.json files and refetch ?
     # because you don't know what's wrong .. :-(
@@ -195,26 +365,253 @@ async def prefetch(folder: ac.LazyFolder, limiter: asyncio.Semaphore, errors: Er
         # should we have some additional limiting ? ..
         folders, files = await folder.folders_and_files()
 
+    sizes = {name: await folder.file_size_bytes_approximate(name) for name in files}
+    if progress:
+        progress.plan(len(sizes), sum(sizes.values()))
+
     async def ensure(folder: ac.LazyFolder, name: str):
         async with limiter: # must be bigger than rec depth !
-            if fix:
-                cf = Path(await folder.file_cache_path(name))
-                if cf.exists():
-                    expected_size = await folder.file_size_bytes_exact(name)
-                    size = cf.stat().st_size
-                    if size != expected_size:
-                        msg = f"UNLINKING {cf} SHOULD{expected_size} WAS {size}"
-                        print(msg)
-                        errors.append(msg)
-                        cf.unlink()
-
-            await folder.file_ensure_fetched(name)
+            try:
+                await ensure_fetched(folder, name, errors, fix)
+            finally:
+                if progress:
+                    progress.done(1, sizes[name])
 
     fetch_files   = [ensure(folder, name) for name in files]
-    fetch_folders = [prefetch(x, limiter, errors) for x in folders.values()]
+    fetch_folders = [prefetch(x, limiter, errors, fix, progress) for x in folders.values()]
     await asyncio.gather(*[*fetch_folders, *fetch_files])
 
 
+# SELECTIVE PREFETCH
+# prefetch above starts downloading while walking. If you only want some levels / slices
+# or want to stay within a byte budget the whole tree has to be planned first.
+
+prefetch_orders = ["path", "smallest", "round-robin"]
+
+@dataclass
+class PrefetchSelection:
+    """ include/exclude are fnmatch globs matched against the path relative to the
+        prefetch root. * also matches / so "*.zarr/2/*" works at any depth.
+        Excluded folders are not listed at all.
+    """
+    include: list[str] = field(default_factory=list)
+    exclude: list[str] = field(default_factory=list)
+    # only descend into these level folders (0 .. 5) of zarr archives, None = all
+    zarr_levels: Optional[set[str]] = None
+    max_bytes: Optional[int] = None
+    order: str = "path" # see prefetch_orders
+
+    def is_default(self):
+        return self == PrefetchSelection()
+
+    def includes(self, rel: str) -> bool:
+        if any(fnmatch(rel, p) for p in self.exclude):
+            return False
+        return len(self.include) == 0 or any(fnmatch(rel, p) for p in self.include)
+
+    def prunes_folder(self, rel: str) -> bool:
+        # trailing / so that "*/0/*" excludes the folder 0 itself
+        return any(fnmatch(f"{rel}/", p) for p in self.exclude)
+
+@dataclass
+class PlannedFile:
+    folder: ac.LazyFolder
+    name: str
+    size: int # approximate
+
+    def path(self) -> t.MyPath:
+        return self.folder.path / self.name
+
+def is_zarr_group(folder: t.Folder, files: Iterable[str]):
+    ps = folder.path.split()
+    return (len(ps) > 0 and ps[-1].endswith(".zarr")) or ".zgroup" in files
+
+async def plan_prefetch_folders(folder: ac.LazyFolder, selection: PrefetchSelection, limiter: asyncio.Semaphore, rel = "") -> list[list[PlannedFile]]:
+    """ selected files grouped by folder, folders in path order """
+    async with limiter:
+        folders, files = await folder.folders_and_files()
+
+    planned = []
+    for name in files:
+        if selection.includes(f"{rel}{name}"):
+            planned.append(PlannedFile(folder, name, await folder.file_size_bytes_approximate(name)))
+
+    zarr = selection.zarr_levels is not None and is_zarr_group(folder, files)
+    subs = [(k, v) for k, v in sorted(folders.items())
+            if not selection.prunes_folder(f"{rel}{k}")
+            and not (zarr and k.isdigit() and k not in selection.zarr_levels)]
+    items = await asyncio.gather(*[plan_prefetch_folders(v, selection, limiter, f"{rel}{k}/") for k, v in subs])
+    return [sorted(planned, key = lambda x: x.name), *[x for l in items for x in l]]
+
+async def plan_prefetch(folder: ac.LazyFolder, selection: PrefetchSelection, limiter: asyncio.Semaphore) -> list[PlannedFile]:
+    """ selected files in download order cut at selection.max_bytes """
+    per_folder = await plan_prefetch_folders(folder, selection, limiter)
+
+    if selection.order == "path":
+        plan = [x for l in per_folder for x in l]
+    elif selection.order == "smallest":
+        plan = sorted([x for l in per_folder for x in l], key = lambda x: x.size)
+    elif selection.order == "round-robin":
+        plan = [x for row in zip_longest(*per_folder) for x in row if x != None]
+    else:
+        raise Exception(f"bad order {selection.order}, use one of {prefetch_orders}")
+
+    return cut_plan(plan, selection.max_bytes)
+
+def cut_plan(plan: list[PlannedFile], max_bytes: Optional[int]) -> list[PlannedFile]:
+    """ keeps the head of plan which fits into max_bytes """
+    if max_bytes == None:
+        return plan
+    total = 0
+    for i, x in enumerate(plan):
+        if total + x.size > max_bytes:
+            return plan[:i]
+        total += x.size
+    return plan
+
+def plan_size(plan: Iterable[PlannedFile]) -> int:
+    return sum(x.size for x in plan)
+
+async def prefetch_planned(plan: list[PlannedFile], concurrency: int, errors: Errors, fix = False, progress: Optional[Progress] = None):
+    """ downloads in plan order, at most concurrency files at a time """
+    if progress:
+        progress.plan(len(plan), plan_size(plan))
+    it = iter(plan)
+    async def worker():
+        for p in it:
+            error = False
+            try:
+                await ensure_fetched(p.folder, p.name, errors, fix)
+            except Exception as e:
+                error = True
+                errors.append(f"{p.path()} {e!r}")
+            if progress:
+                progress.done(1, p.size, error)
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+
+# SLICES OF TIF STACKS
+# "tiff archive" folders (see special_folder) have one file per z slice, eg 01234.tif
+
+re_slice_number = re.compile(r'(\d+)\D*$')
+
+def slice_number(name: str) -> Optional[int]:
+    """ last number in the file name """
+    m = re_slice_number.search(name)
+    return int(m.group(1)) if m else None
+
+def parse_slice_range(s: str) -> range:
+    """ start:end[:step] half open like python, empty end means all """
+    parts = s.split(":")
+    if not 2 <= len(parts) <= 3:
+        raise ValueError(f"bad slice range {s}, use start:end[:step]")
+    start = int(parts[0]) if parts[0] else 0
+    end = int(parts[1]) if parts[1] else 2 ** 63
+    step = int(parts[2]) if len(parts) == 3 and parts[2] else 1
+    return range(start, end, step)
+
+async def plan_slices(folder: ac.LazyFolder, slices: range, extensions = (".tif", ".tiff")) -> list[PlannedFile]:
+    """ files of folder whose slice number is in slices, in slice order """
+    folders, files = await folder.folders_and_files()
+    selected = []
+    for name in files:
+        if not name.lower().endswith(extensions):
+            continue
+        n = slice_number(name)
+        if n != None and n in slices:
+            selected.append((n, name))
+    selected.sort()
+    return [PlannedFile(folder, name, await folder.file_size_bytes_approximate(name)) for n, name in selected]
+
+
+# PREFETCH MANIFEST
+# one line per root, eg
+#   # comment
+#   full-scrolls/Scroll1/PHercParis4.volpkg/volumes_zarr_standardized/54keV_7.91um_Scroll1A.zarr priority=10 zarr_levels=2,3,4,5
+#   full-scrolls/Scroll4 max_bytes=50GiB include=*.tif order=smallest
+# include= and exclude= may be repeated. Higher priority is fetched first.
+
+@dataclass
+class ManifestEntry:
+    path: str
+    priority: int = 0
+    selection: PrefetchSelection = field(default_factory=PrefetchSelection)
+
+def parse_prefetch_manifest(text: str) -> list[ManifestEntry]:
+    entries = []
+    for nr, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+        path, *opts = line.split()
+        e = ManifestEntry(path.strip("/"))
+        for o in opts:
+            k, _, v = o.partition("=")
+            if k == "priority":
+                e.priority = int(v)
+            elif k == "max_bytes":
+                e.selection.max_bytes = parse_size(v)
+            elif k == "include":
+                e.selection.include.append(v)
+            elif k == "exclude":
+                e.selection.exclude.append(v)
+            elif k == "zarr_levels":
+                e.selection.zarr_levels = set(v.split(","))
+            elif k == "order" and v in prefetch_orders:
+                e.selection.order = v
+            else:
+                raise Exception(f"manifest line {nr}: bad option {o}")
+        entries.append(e)
+    return entries
+
+async def plan_prefetch_manifest(root: ac.LazyFolder, entries: list[ManifestEntry], limiter: asyncio.Semaphore, errors: Errors) -> list[PlannedFile]:
+    """ plans all entries in parallel and merges them by priority (stable).
+        Files selected by overlapping entries are only fetched once, for the
+        entry with the higher priority, and only count against that entry's max_bytes.
+    """
+    async def plan(e: ManifestEntry):
+        folder = await walk_path_find_folder(root, t.MyPath(e.path))
+        if folder == None:
+            errors.append(f"manifest: {e.path} not found")
+            return []
+        return await plan_prefetch(folder, replace(e.selection, max_bytes = None), limiter)
+
+    plans = await asyncio.gather(*[plan(e) for e in entries])
+    seen = set()
+    merged = []
+    for e, p in sorted(zip(entries, plans), key = lambda x: -x[0].priority):
+        own = [x for x in p if not str(x.path()) in seen]
+        own = cut_plan(own, e.selection.max_bytes)
+        seen.update(str(x.path()) for x in own)
+        merged += own
+    return merged
+
+
+async def zarr_levels(folder: t.Folder) -> list[t.Folder]:
+    """ folder itself if it contains .zarray else its subfolders containing .zarray """
+    folders, files = await folder.folders_and_files()
+    if ".zarray" in files:
+        return [folder]
+    subs = list(folders.values())
+    contents = await asyncio.gather(*[x.folders_and_files() for x in subs])
+    return [x for x, (_, files) in zip(subs, contents) if ".zarray" in files]
+
+async def estimate_zarr_sampled(folder: ac.LazyFolder, chunk_size: Callable[[t.MyPath, str], Awaitable[Optional[int]]], rel_error = 0.1, max_samples = 400):
+    """ samples chunk sizes of each level, prints the estimates and stores the measured ratio
+        for du_approximate and list_special_and_approximate_size_fast
+    """
+    from .zarray_estimation import estimate_zarray_contents_size, estimate_zarray_contents_size_sampled
+    for level in await zarr_levels(folder):
+        o = json.loads((await level.file_bytes(".zarray", 0, None)).decode('utf-8'))
+        async def size(key: str):
+            sub, _, name = key.rpartition("/")
+            return await chunk_size(level.path / sub if sub else level.path, name)
+        e = await estimate_zarray_contents_size_sampled(o, size, rel_error = rel_error, max_samples = max_samples)
+        if e.size > 0:
+            await level.set_zarr_compression_ratio(e.compression_ratio)
+        assumed, _, ch = estimate_zarray_contents_size(o)
+        print(f"{level.path.name()}/ {format_size_MiB(e.size)} {level.path} {e.hint()} (was {format_size_MiB(assumed)} {ch})")
+
 async def list_special(folder: t.Folder, indent = ""):
     folders, files = await folder.folders_and_files()
     print(f"{indent}{folder.path}")
@@ -246,31 +643,43 @@ async def info(thing: t.FileOrFolder):
     else:
         return "neither file nor directory - not found"
 
-async def walk_cache_dir_check_sizes(folder: t.Folder, cache_dir: Path, errors: Errors):
+async def walk_cache_dir_check_sizes(folder: t.Folder, cache_dir: Path, errors: Errors, progress: Optional[Progress] = None):
     folders, files = await folder.folders_and_files()
     size = 0
     for k, v in folders.items():
-        await walk_cache_dir_check_sizes(v, cache_dir / k, errors)
+        await walk_cache_dir_check_sizes(v, cache_dir / k, errors, progress)
     for name in files:
         cf = cache_dir / name
+        size = 0
         if cf.exists():
             expected_size = await folder.file_size_bytes_exact(name)
             size = cf.stat().st_size
             if (expected_size != size):
                 errors.append(f"{cf} expected={expected_size} size={size}")
-
-async def walk_cache_check_download_completness(folder: t.Folder, cache_dir: Path, errors: Errors):
+        if progress:
+            progress.done(1, size)
+
+def print_completeness(r: t.Rollup):
+    print(f" {format_size_MiB(r.cached_bytes)} / {format_size_MiB(r.size)} {r.cached_bytes / r.size if r.size else 1:.2f}"
+        f" files {r.cached_files} / {r.files}, exact size known for {r.exact_files}")
+    if r.estimated:
+        print(" contains estimated zarr levels, files below them which were never listed aren't counted")
+
+async def walk_cache_check_download_completness(folder: t.Folder, cache_dir: Path, errors: Errors, progress: Optional[Progress] = None):
+    """ exact: HEAD requests for sizes not in the listings, compares each cached file.
+        See rollup for the fast approximate answer.
+    """
     total = 0
     downloaded = 0
 
     async def rec(folder: t.Folder, cache_dir: Path):
         folders, files = await folder.folders_and_files()
         nonlocal total, downloaded
-        total = 0
         await asyncio.gather(*[rec(v, cache_dir / k) for [k,v] in folders.items()])
         for name in files:
             cf = cache_dir / name
             expected_size = await folder.file_size_bytes_exact(name)
+            size = 0
             if cf.exists():
                 size = cf.stat().st_size
                 if size != expected_size:
@@ -279,6 +688,10 @@ async def walk_cache_check_download_completness(folder: t.Folder, cache_dir: Pat
                 total += expected_size
             else:
                 total += expected_size
+            if progress:
+                progress.plan(1, expected_size)
+                progress.done(1, size)
 
     await rec(folder, cache_dir)
-    print(f" {format_size_MiB(downloaded)} / {format_size_MiB(total)} {downloaded/total:.2f}")
+    ratio = f"{downloaded/total:.2f}" if total else "n/a"
+    print(f" {format_size_MiB(downloaded)} / {format_size_MiB(total)} {ratio}")
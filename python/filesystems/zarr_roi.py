@@ -0,0 +1,92 @@
+import asyncio
+import json
+import math
+from itertools import product
+from pathlib import Path
+from typing import Iterator, Optional
+from . import types as t
+from . import ash2txtorg_cached as ac
+from .progress import Progress
+
+"""
+prefetch a region of interest of one zarr (v2) level
+
+The chunk keys are computed from .zarray (shape, chunks, dimension_separator) so
+neither the level folder nor the chunk folders have to be listed, which for the
+large levels means thousands of directory listings.
+
+Chunks which don't exist on the server (all fill_value) reply 404 and are counted as empty.
+"""
+
+def parse_roi(roi: str, shape: list[int]) -> list[tuple[int, int]]:
+    """ "z0:z1,y0:y1,x0:x1" half open, empty bounds mean start/end, "" whole axis, "5" means 5:6 """
+    parts = roi.split(",")
+    if len(parts) != len(shape):
+        raise Exception(f"roi {roi} has {len(parts)} dimensions but array has {len(shape)} (shape {shape})")
+    r = []
+    for p, size in zip(parts, shape):
+        if p.strip() == "":
+            start, end = 0, size
+        elif ":" in p:
+            a, b = p.split(":")
+            start, end = int(a) if a else 0, int(b) if b else size
+        else:
+            start = int(p)
+            end = start + 1
+        start, end = max(0, start), min(size, end)
+        if start >= end:
+            raise Exception(f"empty roi {p} for size {size}")
+        r.append((start, end))
+    return r
+
+def chunk_ranges(zarray: dict, roi: list[tuple[int, int]]) -> list[range]:
+    return [range(start // c, math.ceil(end / c)) for (start, end), c in zip(roi, zarray["chunks"])]
+
+def chunk_count(ranges: list[range]) -> int:
+    return math.prod(len(r) for r in ranges)
+
+def chunk_keys(zarray: dict, ranges: list[range]) -> Iterator[str]:
+    """ keys relative to the level folder in C order, eg 0.3.7 or 0/3/7 """
+    sep = zarray.get("dimension_separator", ".")
+    for idx in product(*ranges):
+        yield sep.join(str(i) for i in idx)
+
+def estimated_chunk_size(zarray: dict, compression_ratio: Optional[float] = None) -> float:
+    """ compression_ratio see measured_compression_ratio, if None a ratio is assumed by compressor """
+    from .zarray_estimation import estimate_zarray_contents_size
+    total, _, _ = estimate_zarray_contents_size(zarray, compression_ratio)
+    return total / math.prod(math.ceil(s / c) for s, c in zip(zarray["shape"], zarray["chunks"]))
+
+def measured_compression_ratio(cache_dir: Path, level: t.MyPath) -> Optional[float]:
+    """ ratio stored by estimate-zarr-sampled in the cached listing of the level,
+        read from disk so that the level doesn't get listed
+    """
+    f = cache_dir / str(level) / ac.METADATA_FILE
+    if not f.exists():
+        return None
+    return ac.CachedFolderData.from_json(f.read_text()).zarr_ratio
+
+async def read_zarray(opts: ac.FolderOpts, level: t.MyPath) -> dict:
+    await opts.file_ensure_fetched(level, ".zarray")
+    return json.loads((await opts.file_bytes(level, ".zarray", 0, None)).decode("utf-8"))
+
+async def prefetch_keys(opts: ac.FolderOpts, level: t.MyPath, keys: Iterator[str], concurrency: int, errors: list, progress: Optional[Progress] = None, chunk_bytes: int = 0) -> int:
+    """ returns count of chunks not on the server. chunk_bytes is only used for progress """
+    missing = 0
+    async def worker():
+        nonlocal missing
+        for key in keys:
+            folder, _, name = key.rpartition("/")
+            error = False
+            try:
+                await opts.file_ensure_fetched(level / folder if folder else level, name)
+            except Exception as e:
+                if getattr(e, "status", None) == 404:
+                    missing += 1
+                else:
+                    error = True
+                    errors.append(f"{level}/{key} {e!r}")
+            if progress:
+                progress.done(1, chunk_bytes, error)
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return missing
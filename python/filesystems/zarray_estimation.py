@@ -1,12 +1,16 @@
 import json
 from pathlib import Path
-import numpy as np
 import math
 import sys
-import numpy as np
-import math
+import asyncio
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+from .startup import timed
+# this module is imported lazily by walking and zarr_roi
+with timed("import numpy"):
+    import numpy as np
 
-def estimate_zarray_contents_size(zarr_metadata: dict) -> float:
+def estimate_zarray_contents_size(zarr_metadata: dict, compression_ratio: Optional[float] = None) -> float:
     """
     Calculates the estimated physical size (in bytes) of a Zarr array 
     based purely on its .zarray metadata dictionary and an assumed 
@@ -14,6 +18,8 @@ def estimate_zarray_contents_size(zarr_metadata: dict) -> float:
 
     Args:
         zarr_metadata (dict): The loaded content of the .zarray JSON file.
+        compression_ratio: measured ratio (see estimate_zarray_contents_size_sampled),
+            if None a ratio is assumed by compressor
 
     Returns:
         float: The estimated physical size in bytes.
@@ -37,7 +43,9 @@ def estimate_zarray_contents_size(zarr_metadata: dict) -> float:
         "raw": 1.0
     }
 
-    compression_ratio = compression_ratios.get(compressor, 1)
+    measured = compression_ratio != None
+    if not measured:
+        compression_ratio = compression_ratios.get(compressor, 1)
 
     # --- 1. Calculate Logical Size (Uncompressed) ---
     
@@ -56,8 +64,106 @@ def estimate_zarray_contents_size(zarr_metadata: dict) -> float:
     # Estimated Physical Size = Logical Size / Compression Ratio
     estimated_physical_size_bytes = logical_size_bytes / compression_ratio
     
+    if measured:
+        return estimated_physical_size_bytes, compression_ratio, f"compression {compressor} measured ratio {compression_ratio:.2f}"
     return estimated_physical_size_bytes, compression_ratio, f"compression {compressor} assumed ratio {compression_ratio}"
 
+
+# SAMPLING
+# The assumed ratios above are far off for some scrolls (Scroll4/5). Fetching the exact
+# size of a random sample of chunk keys (HEAD) gives the mean physical chunk size and
+# with it a confidence interval for the whole array. Chunks missing on the server
+# (fill_value only) count as 0 bytes, so sparse arrays come out right too.
+
+def chunk_grid(zarr_metadata: dict) -> np.ndarray:
+    """ chunks per dimension """
+    return np.ceil(np.asarray(zarr_metadata['shape']) / np.asarray(zarr_metadata['chunks'])).astype(np.int64)
+
+def logical_bytes(zarr_metadata: dict) -> int:
+    return int(np.prod(zarr_metadata['shape'], dtype=np.float64)) * np.dtype(zarr_metadata['dtype']).itemsize
+
+def sample_size(population: int, cv: float, rel_error: float = 0.1, z: float = 1.96) -> int:
+    """ samples needed to estimate the mean within rel_error at confidence z given
+        the coefficient of variation cv, with finite population correction
+    """
+    n0 = (z * cv / rel_error) ** 2
+    if population <= 1 or n0 == 0:
+        # single chunk, or all chunks the same size: one sample is the mean
+        return min(population, 1)
+    n = math.ceil(n0 / (1 + (n0 - 1) / population))
+    return min(population, max(1, n))
+
+def sample_chunk_keys(zarr_metadata: dict, n: int, rng: np.random.Generator) -> list[str]:
+    """ n distinct random chunk keys like 3.0.7 or 3/0/7 """
+    grid = chunk_grid(zarr_metadata)
+    population = int(np.prod(grid))
+    flat = rng.choice(population, size=min(n, population), replace=False)
+    idx = np.stack(np.unravel_index(flat, grid), axis=1)
+    sep = zarr_metadata.get('dimension_separator', '.')
+    return [sep.join(map(str, row)) for row in idx.tolist()]
+
+@dataclass
+class SampledEstimate:
+    size: float # bytes
+    low: float  # confidence interval
+    high: float
+    compression_ratio: float # logical / physical of the whole array, so estimate_zarray_contents_size reproduces size
+    samples: int
+    chunks: int
+    missing: int # sampled chunks not on the server
+
+    def hint(self) -> str:
+        return f"measured ratio {self.compression_ratio:.2f} from {self.samples}/{self.chunks} chunks ({self.missing} missing), 95% {self.low / 1024 / 1024:.2f} .. {self.high / 1024 / 1024:.2f} MiB"
+
+def extrapolate(sizes: np.ndarray, chunks: int, logical: int, z: float = 1.96) -> SampledEstimate:
+    n = len(sizes)
+    mean = float(sizes.mean())
+    std = float(sizes.std(ddof=1)) if n > 1 else 0.0
+    fpc = math.sqrt((chunks - n) / (chunks - 1)) if chunks > 1 else 0.0
+    half = z * chunks * std / math.sqrt(n) * fpc
+    size = chunks * mean
+    return SampledEstimate(
+        size = size,
+        low = max(0.0, size - half),
+        high = size + half,
+        compression_ratio = logical / size if size > 0 else math.inf,
+        samples = n,
+        chunks = chunks,
+        missing = int((sizes == 0).sum()),
+    )
+
+async def estimate_zarray_contents_size_sampled(
+        zarr_metadata: dict,
+        chunk_size: Callable[[str], Awaitable[Optional[int]]],
+        concurrency: int = 16,
+        rel_error: float = 0.1,
+        pilot: int = 30,
+        max_samples: int = 400,
+        rng: Optional[np.random.Generator] = None,
+        ) -> SampledEstimate:
+    """ chunk_size(key) returns the exact size of a chunk or None if it doesn't exist.
+        A pilot sample gives the variation, then more keys are sampled until rel_error
+        at 95% confidence is reached or max_samples is hit.
+    """
+    rng = rng if rng != None else np.random.default_rng()
+    chunks = int(np.prod(chunk_grid(zarr_metadata)))
+    keys = sample_chunk_keys(zarr_metadata, max_samples, rng)
+    limiter = asyncio.Semaphore(concurrency)
+
+    async def size(key):
+        async with limiter:
+            s = await chunk_size(key)
+            return 0 if s == None else s
+
+    sizes = np.asarray(await asyncio.gather(*[size(k) for k in keys[:pilot]]), dtype=np.float64)
+    mean = sizes.mean()
+    cv = float(sizes.std(ddof=1) / mean) if mean > 0 and len(sizes) > 1 else 0.0
+    needed = min(len(keys), sample_size(chunks, cv, rel_error))
+    if needed > len(sizes):
+        more = await asyncio.gather(*[size(k) for k in keys[len(sizes):needed]])
+        sizes = np.concatenate([sizes, np.asarray(more, dtype=np.float64)])
+    return extrapolate(sizes, chunks, logical_bytes(zarr_metadata))
+
 # --- Example Usage (How to call the simplified function) ---
 if __name__ == '__main__':
     # Define a sample .zarray content
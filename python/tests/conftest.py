@@ -0,0 +1,34 @@
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+"""
+tests run example-main.py as a subprocess against benchmarks/synthetic_server.py
+
+    cd python && python -m pytest -q tests
+"""
+
+here = Path(__file__).resolve().parent
+main_py = here.parent / "example-main.py"
+sys.path.insert(0, str(here.parent))
+sys.path.insert(0, str(here.parent / "benchmarks"))
+
+import synthetic_server
+from run import Server
+
+@pytest.fixture(scope="session")
+def server():
+    parser = argparse.ArgumentParser()
+    synthetic_server.config_argparser(parser)
+    s = Server(parser.parse_args(["--tif-files", "50", "--big-gib", "0.01"]))
+    yield s
+    s.stop()
+
+def run_main(cache: Path, url: str, *argv: str, options: tuple[str, ...] = ()) -> str:
+    """ stdout of example-main.py [options] cache url argv, fails the test if the command failed """
+    r = subprocess.run([sys.executable, str(main_py), *options, str(cache), url, *argv], capture_output=True, text=True)
+    assert r.returncode == 0 and "Traceback" not in r.stderr, f"{argv} failed:\n{r.stdout[-2000:]}\n{r.stderr[-2000:]}"
+    return r.stdout
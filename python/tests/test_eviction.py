@@ -0,0 +1,78 @@
+import os
+import urllib.request
+from pathlib import Path
+
+from conftest import run_main
+from filesystems import eviction
+from filesystems.ash2txtorg_cached import PARTIAL_VALIDATOR
+
+def make_partial(cache: Path, url: str, rel: str, keep: int):
+    """ cuts the downloaded rel back to a resumable partial of keep bytes """
+    file = cache / rel
+    data = file.read_bytes()
+    etag = urllib.request.urlopen(urllib.request.Request(f"{url}/{rel}", method="HEAD")).headers["ETag"]
+    tmp = file.with_name(f"{file.name}.tmp")
+    tmp.write_bytes(data[:keep])
+    os.setxattr(tmp, PARTIAL_VALIDATOR, etag.encode("utf-8"))
+    file.unlink()
+    return tmp, data
+
+def test_partial_survives_eviction_below_quota_and_is_resumed(server, tmp_path):
+    run_main(tmp_path, server.url, "prefetch-slices", "tifs", "1:2")
+    run_main(tmp_path, server.url, "unpin", "tifs")
+    tmp, data = make_partial(tmp_path, server.url, "tifs/00001.tif", 1000)
+
+    out = run_main(tmp_path, server.url, "evict", "--quota", "10GiB")
+    assert "evicting 0 files" in out
+    assert tmp.exists()
+
+    metrics = tmp_path.parent / f"{tmp_path.name}.prom"
+    run_main(tmp_path, server.url, "prefetch-slices", "tifs", "1:2", options=("--metrics-file", str(metrics)))
+    assert (tmp_path / "tifs/00001.tif").read_bytes() == data
+    assert not tmp.exists()
+    assert "ash2txt_downloads_resumed_total 1" in metrics.read_text()
+
+def cached(rel: str, size: int, age: float, resumable = False, now = 1e9) -> eviction.CachedFile:
+    return eviction.CachedFile(rel, size, now - age, now - age, resumable)
+
+def test_plan_eviction_partials(tmp_path):
+    pins = eviction.Pins(tmp_path)
+    now = 1e9
+    files = [
+        cached("a.tmp", 100, 1000, resumable = True),
+        cached("b.tmp", 100, 1000),
+        cached("old.tmp", 100, eviction.default_max_partial_age + 1, resumable = True),
+        cached("c", 100, 5),
+        # probably being written by another process
+        cached("new.tmp", 100, 1),
+    ]
+    # below quota only partials older than max_partial_age go
+    assert [f.rel for f in eviction.plan_eviction(files, 10_000, pins, now = now)] == ["old.tmp"]
+    # above: partials which can't be resumed first, then by last access, the resumable one before the newer c
+    assert [f.rel for f in eviction.plan_eviction(files, 250, pins, now = now)] == ["old.tmp", "b.tmp", "a.tmp"]
+    assert [f.rel for f in eviction.plan_eviction(files, 1, pins, now = now)] == ["old.tmp", "b.tmp", "a.tmp", "c"]
+    # being downloaded
+    assert [f.rel for f in eviction.plan_eviction(files, 10_000, pins, in_flight = {"old.tmp"}, now = now)] == []
+
+def test_prefetch_with_selection_pins_only_planned_files(server, tmp_path):
+    run_main(tmp_path, server.url, "prefetch-slices", "tifs", "1:3")
+    # a sibling fetched otherwise (a mount read)
+    sibling = tmp_path / "tifs/00005.tif"
+    sibling.write_bytes(urllib.request.urlopen(f"{server.url}/tifs/00005.tif").read())
+
+    pins = eviction.Pins(tmp_path)
+    assert sorted(pins.data) == ["tifs/00001.tif", "tifs/00002.tif"]
+    assert not pins.pinned("tifs/00005.tif")
+
+    out = run_main(tmp_path, server.url, "evict", "--quota", "1")
+    assert "evicting 1 files" in out
+    assert not sibling.exists()
+    assert (tmp_path / "tifs/00001.tif").exists() and (tmp_path / "tifs/00002.tif").exists()
+
+def test_pinned_folders_and_files(tmp_path):
+    pins = eviction.Pins(tmp_path)
+    pins.pin_many(["a/b", "c/d.tif"])
+    assert pins.pinned("a/b") and pins.pinned("a/b/x/y") and pins.pinned("c/d.tif")
+    assert not pins.pinned("a/bb") and not pins.pinned("c/e.tif") and not pins.pinned("c")
+    pins.unpin("a/b")
+    assert not pins.pinned("a/b/x/y")
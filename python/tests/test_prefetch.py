@@ -0,0 +1,30 @@
+import urllib.request
+
+from conftest import run_main
+from filesystems import ash2txtorg_cached as ac
+from filesystems import zarr_roi
+from filesystems.types import MyPath
+
+def content_length(url: str) -> int:
+    return int(urllib.request.urlopen(urllib.request.Request(url, method="HEAD")).headers["Content-Length"])
+
+def test_manifest_overlapping_entries_dedupe_before_max_bytes(server, tmp_path):
+    # 00001.tif belongs to the first entry, so the second one's budget goes to 00002 and 00003
+    max_bytes = content_length(f"{server.url}/tifs/00002.tif") + content_length(f"{server.url}/tifs/00003.tif")
+    manifest = tmp_path.parent / f"{tmp_path.name}.manifest"
+    manifest.write_text(f"tifs priority=10 include=00001.tif\ntifs max_bytes={max_bytes}\n")
+
+    out = run_main(tmp_path, server.url, "prefetch-manifest", str(manifest), "--dry-run")
+    assert "planned 3 files" in out
+
+def test_zarr_roi_chunk_size_uses_measured_ratio(tmp_path):
+    zarray = {"shape": [256, 256, 256], "chunks": [128, 128, 128], "dtype": "|u1", "compressor": {"id": "blosc"}}
+    level = MyPath("scroll.zarr/0")
+    assert zarr_roi.measured_compression_ratio(tmp_path, level) == None
+    assert zarr_roi.estimated_chunk_size(zarray) == 128 ** 3 / 3
+
+    (tmp_path / "scroll.zarr/0").mkdir(parents=True)
+    (tmp_path / "scroll.zarr/0" / ac.METADATA_FILE).write_text(ac.CachedFolderData(files = {}, folders = [], zarr_ratio = 8.0).to_json())
+    ratio = zarr_roi.measured_compression_ratio(tmp_path, level)
+    assert ratio == 8.0
+    assert zarr_roi.estimated_chunk_size(zarray, ratio) == 128 ** 3 / 8